@@ -0,0 +1,77 @@
+"""
+Compares the throughput of the label XML parsers available to
+SplHistoricalLabels, over the label XML files used by the tests.
+
+Run from the source root:
+    $ PYTHONPATH=. python benchmarks/bench_label_parser.py --iterations=50
+"""
+
+import argparse
+import os
+import tempfile
+import time
+import zipfile
+
+from spl.labels import SplHistoricalLabels
+
+TEST_DATA_DIR = os.path.join("tests", "testdata")
+
+
+class _ParseOnlyLabels(SplHistoricalLabels):
+    """Skips the label download, so that only the parsing is timed."""
+
+    def _fetch_and_process(self):
+        pass
+
+
+def _get_label_files(folder):
+    with zipfile.ZipFile(
+        os.path.join(
+            TEST_DATA_DIR, "1b5e2860-6855-4a65-8bbc-e064172a1adf_1.zip"
+        )
+    ) as zip_obj:
+        xml_names = [x for x in zip_obj.namelist() if x.endswith(".xml")]
+        zip_obj.extractall(folder, members=xml_names)
+    return [os.path.join(folder, x) for x in xml_names] + [
+        os.path.join(TEST_DATA_DIR, "test_label_nested.xml")
+    ]
+
+
+def bench_parser(parser, xml_files, iterations, download_path):
+    spl = {"data": {"spl": {"setid": "bench"}, "history": []}}
+    labels = _ParseOnlyLabels(spl, download_path, parser=parser)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for xml_file in xml_files:
+            labels._parse_label(xml_file)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iterations", type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        xml_files = _get_label_files(folder)
+        total_labels = len(xml_files) * args.iterations
+        total_mb = (
+            sum(os.path.getsize(x) for x in xml_files)
+            * args.iterations
+            / 1024**2
+        )
+        results = {}
+        for label_parser in SplHistoricalLabels.PARSERS:
+            elapsed = bench_parser(
+                label_parser, xml_files, args.iterations, folder
+            )
+            results[label_parser] = elapsed
+            print(
+                f"{label_parser:>5}: {total_labels / elapsed:8.1f} labels/sec "
+                f"{total_mb / elapsed:7.2f} MB/sec ({elapsed:.2f}s)"
+            )
+        print(f"lxml speedup: {results['bs4'] / results['lxml']:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+Compares the write throughput of storing label versions one at a time, with
+a find + upsert per label, against a single bulk_upsert per set ID.
+
+Runs against mongomock by default; pass --mongo_uri to use a local mongod
+instead (a throwaway database is created and dropped).
+
+Run from the source root:
+    $ PYTHONPATH=. python benchmarks/bench_mongo_writes.py --set_ids=200
+    $ PYTHONPATH=. python benchmarks/bench_mongo_writes.py \
+        --mongo_uri=mongodb://localhost:27017
+"""
+
+import argparse
+import json
+import os
+import time
+
+import pymongo
+
+from db.mongo import MongoClient
+from spl.labels import MONGO_INDEXES, MONGO_KEY_FIELDS
+
+TEST_DATA_DIR = os.path.join("tests", "testdata")
+DB_NAME = "bench_mongo_writes"
+COLLECTION_NAME = "labels"
+
+
+def _get_labels(template, set_id, versions):
+    return [
+        {
+            **template,
+            "set_id": set_id,
+            "spl_id": f"{set_id}-spl-{version}",
+            "spl_version": str(version),
+        }
+        for version in range(1, versions + 1)
+    ]
+
+
+def write_one_at_a_time(mongo_client, labels):
+    for label in labels:
+        query = {"spl_id": label["spl_id"], "set_id": label["set_id"]}
+        existing = list(mongo_client.find(COLLECTION_NAME, query))
+        if existing:
+            label = {**existing[0], **label}
+        mongo_client.upsert(COLLECTION_NAME, query, label)
+
+
+def write_bulk(mongo_client, labels):
+    mongo_client.bulk_upsert(COLLECTION_NAME, MONGO_KEY_FIELDS, labels)
+
+
+def bench_writes(write, db_client, template, num_set_ids, versions):
+    db_client.drop_collection(COLLECTION_NAME)
+    mongo_client = MongoClient(db_client)
+    mongo_client.create_indexes(COLLECTION_NAME, MONGO_INDEXES)
+    batches = [
+        _get_labels(template, f"set-{i}", versions) for i in range(num_set_ids)
+    ]
+    start = time.perf_counter()
+    # Write every batch twice, as re-runs update the labels already stored
+    for _ in range(2):
+        for labels in batches:
+            write(mongo_client, [dict(x) for x in labels])
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--set_ids", type=int, default=200)
+    parser.add_argument("--versions", type=int, default=5)
+    parser.add_argument("--mongo_uri", type=str, default=None)
+    args = parser.parse_args()
+
+    if args.mongo_uri:
+        client = pymongo.MongoClient(args.mongo_uri)
+    else:
+        import mongomock
+
+        client = mongomock.MongoClient()
+    db_client = client[DB_NAME]
+
+    with open(os.path.join(TEST_DATA_DIR, "baselines", "test_label.json")) as f:
+        template = json.loads(f.read())[0]
+
+    total = args.set_ids * args.versions * 2
+    results = {}
+    try:
+        for name, write in [
+            ("one at a time", write_one_at_a_time),
+            ("bulk", write_bulk),
+        ]:
+            elapsed = bench_writes(
+                write, db_client, template, args.set_ids, args.versions
+            )
+            results[name] = elapsed
+            print(
+                f"{name:>13}: {total / elapsed:9.1f} labels/sec "
+                f"({elapsed:.2f}s)"
+            )
+    finally:
+        client.drop_database(DB_NAME)
+    print(f"bulk speedup: {results['one at a time'] / results['bulk']:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
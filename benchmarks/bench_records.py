@@ -0,0 +1,123 @@
+"""
+Benchmark of the memory and pickling cost of the data passed between the
+stages, held as the JSON dicts they are made from or as the record types of
+spl/records.py.
+
+    index    the spls of the index, as dicts or SplIndexRecord
+    history  the history of each set ID, as the DailyMed JSON data or
+             SplHistoryRecord
+    labels   the label versions, as MongoDB documents or LabelVersion
+
+For each, the items are decoded from JSON into each representation, and the
+memory they hold (measured with tracemalloc), their pickled size and the time
+to pickle and unpickle them (as when passed to and from a worker process) are
+reported.
+
+Run from the source root:
+    $ PYTHONPATH=. python benchmarks/bench_records.py
+    $ PYTHONPATH=. python benchmarks/bench_records.py --items=100000 \
+        --versions=10
+"""
+
+import argparse
+import gc
+import json
+import os
+import pickle
+import time
+import tracemalloc
+
+from spl.records import LabelVersion, SplHistoryRecord, SplIndexRecord
+
+TEST_DATA_DIR = os.path.join("tests", "testdata")
+
+
+def _read_test_data(*path):
+    with open(os.path.join(TEST_DATA_DIR, *path)) as f:
+        return json.loads(f.read())
+
+
+def make_payloads(items, versions):
+    """Returns the JSON payload of the items of each benchmark, each item with
+    its own set ID."""
+    spl = _read_test_data("baselines", "test_index_page.json")["spls"][0]
+    history = _read_test_data("test_history.json")
+    history["data"]["history"] = [
+        {"spl_version": x, "published_date": "May 02, 2019"}
+        for x in range(versions, 0, -1)
+    ]
+    label = _read_test_data("baselines", "test_label.json")[0]
+    payloads = {"index": [], "history": [], "labels": []}
+    for i in range(items):
+        set_id = f"{i:08d}-a055-4e33-8e92-898d42828cd1"
+        payloads["index"].append({**spl, "setid": set_id})
+        payloads["history"].append(
+            {
+                **history,
+                "data": {
+                    **history["data"],
+                    "spl": {**history["data"]["spl"], "setid": set_id},
+                },
+            }
+        )
+        payloads["labels"].append({**label, "set_id": set_id})
+    return {name: json.dumps(x) for name, x in payloads.items()}
+
+
+CONVERTERS = {
+    "index": lambda x: SplIndexRecord(**x),
+    "history": SplHistoryRecord.from_json,
+    "labels": LabelVersion.from_document,
+}
+
+
+def measure(payload, convert=None):
+    """Decodes the payload, converting each item if given a converter, and
+    returns the memory held by the items, their pickled size and the time
+    to pickle and unpickle them."""
+    gc.collect()
+    tracemalloc.start()
+    items = json.loads(payload)
+    if convert is not None:
+        items = [convert(x) for x in items]
+    gc.collect()
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    pickled = pickle.dumps(items, protocol=pickle.HIGHEST_PROTOCOL)
+    pickle.loads(pickled)
+    return memory, len(pickled), time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument("--items", type=int, default=20000)
+    parser.add_argument("--versions", type=int, default=5)
+    args = parser.parse_args()
+
+    payloads = make_payloads(args.items, args.versions)
+    print(f"{args.items} items, {args.versions} versions per history")
+    for name, payload in payloads.items():
+        results = {
+            "dicts": measure(payload),
+            "records": measure(payload, CONVERTERS[name]),
+        }
+        for kind, (memory, size, seconds) in results.items():
+            print(
+                f"{name:>8} {kind:>8}: {memory / 1024**2:7.1f} MB held, "
+                f"{size / 1024**2:7.1f} MB pickled, "
+                f"{seconds:.3f}s to pickle and unpickle"
+            )
+        dicts, records = results["dicts"], results["records"]
+        print(
+            f"{'':>8} {'saved':>8}: {1 - records[0] / dicts[0]:7.0%} memory, "
+            f"{1 - records[1] / dicts[1]:7.0%} pickled size, "
+            f"{1 - records[2] / dicts[2]:7.0%} pickle time"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+Benchmark of the scheduling of the label stage over a simulated workload,
+where the time taken by a set ID is proportional to its number of versions.
+Most set IDs have a few versions and a few have many, some of which come
+last in the input, as happens with the set IDs of the index.
+
+Compares:
+
+    in order        executor.map over the set IDs in input order, as the
+                    label stage used to
+    longest first   map_longest_first, submitting the set IDs with the most
+                    versions first
+
+and reports the total time of each, against the ideal time of a perfect
+split of the work across the workers.
+
+Run from the source root:
+    $ PYTHONPATH=. python benchmarks/bench_scheduling.py
+    $ PYTHONPATH=. python benchmarks/bench_scheduling.py --set_ids=400 \
+        --workers=8 --seconds_per_version=0.002
+"""
+
+import argparse
+import concurrent.futures
+import random
+import time
+
+from utils.scheduling import map_longest_first
+
+
+def make_version_counts(set_ids, seed=0):
+    """Returns a skewed number of versions per set ID: nearly all have 1 to
+    5 versions, and 1 in 50 has 40 to 80. The input ends with a set ID of 80
+    versions."""
+    rng = random.Random(seed)
+    counts = [
+        rng.randint(40, 80) if rng.random() < 0.02 else rng.randint(1, 5)
+        for _ in range(set_ids - 1)
+    ]
+    return counts + [80]
+
+
+def _process_set_id(task):
+    # Stands in for process_labels_for_set_id
+    versions, seconds_per_version = task
+    time.sleep(versions * seconds_per_version)
+    return versions
+
+
+def run_in_order(executor, tasks):
+    for _ in executor.map(_process_set_id, tasks):
+        pass
+
+
+def run_longest_first(executor, tasks):
+    for _ in map_longest_first(
+        executor, _process_set_id, tasks, lambda x: x[0]
+    ):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument("--set_ids", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--seconds_per_version", type=float, default=0.005)
+    args = parser.parse_args()
+
+    counts = make_version_counts(args.set_ids)
+    tasks = [(x, args.seconds_per_version) for x in counts]
+    total = sum(counts) * args.seconds_per_version
+    print(
+        f"{len(counts)} set IDs, {sum(counts)} versions, max {max(counts)} "
+        f"versions per set ID, {args.workers} workers; "
+        f"ideal time {total / args.workers:.2f}s"
+    )
+
+    results = {}
+    for name, fn in [
+        ("in order", run_in_order),
+        ("longest first", run_longest_first),
+    ]:
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=args.workers
+        ) as executor:
+            # Start the workers before timing
+            list(executor.map(int, range(args.workers)))
+            start = time.perf_counter()
+            fn(executor, tasks)
+            results[name] = time.perf_counter() - start
+        print(f"{name:>14}: {results[name]:.2f}s")
+    print(f"Speedup: {results['in order'] / results['longest first']:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
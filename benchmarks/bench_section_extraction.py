@@ -0,0 +1,66 @@
+"""
+Measures how label parsing scales with the number of sections, over
+synthetic labels holding thousands of nested sections. With a linear
+section extraction, the time per section stays flat as the labels grow.
+
+Run from the source root:
+    $ PYTHONPATH=. python benchmarks/bench_section_extraction.py
+"""
+
+import argparse
+import io
+import time
+
+from spl.labels import SplHistoricalLabels
+from synthetic_spl import LabelShape, make_label
+
+# Each top-level section holds 3 sub-sections of 3 sub-sections each
+SECTION_DEPTH = 2
+SECTION_FANOUT = 3
+
+
+class _ParseOnlyLabels(SplHistoricalLabels):
+    """Skips the label download, so that only the parsing is timed."""
+
+    def _fetch_and_process(self):
+        pass
+
+
+def bench_parser(parser, label, iterations):
+    spl = {"data": {"spl": {"setid": "bench"}, "history": []}}
+    labels = _ParseOnlyLabels(spl, None, parser=parser, in_memory=True)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        labels._parse_label(io.BytesIO(label), "bench")
+    return (time.perf_counter() - start) / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--sections",
+        type=int,
+        nargs="+",
+        default=[250, 500, 1000, 2000, 4000],
+    )
+    parser.add_argument("--iterations", type=int, default=3)
+    args = parser.parse_args()
+
+    block = LabelShape(sections=1, depth=SECTION_DEPTH, fanout=SECTION_FANOUT)
+    for num_sections in args.sections:
+        shape = block._replace(
+            sections=max(num_sections // block.get_section_count(), 1)
+        )
+        num_sections = shape.get_section_count()
+        label = make_label("bench", 1, shape)
+        for label_parser in SplHistoricalLabels.PARSERS:
+            elapsed = bench_parser(label_parser, label, args.iterations)
+            print(
+                f"{num_sections:>6} sections {label_parser:>5}: "
+                f"{elapsed * 1000:9.1f} ms/label "
+                f"{elapsed / num_sections * 10 ** 6:7.1f} us/section"
+            )
+
+
+if __name__ == "__main__":
+    main()
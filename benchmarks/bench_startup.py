@@ -0,0 +1,95 @@
+"""
+Benchmark of the startup time of the CLI, and of the imports of each stage.
+Each command is run in a fresh interpreter, a few times, and the fastest and
+median wall times are reported against the target.
+
+    main.py -h      parsing the args, with nothing else to do
+    index stage     the imports of main.py and the index and history stages
+    label stage     the imports of the label stage (bs4, cleantext, pymongo),
+                    for reference
+
+With --importtime, the modules taking the longest to import for a command
+are listed, from python -X importtime.
+
+Run from the source root:
+    $ PYTHONPATH=. python benchmarks/bench_startup.py
+    $ PYTHONPATH=. python benchmarks/bench_startup.py --runs=10 \
+        --importtime="main.py -h"
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+COMMANDS = {
+    "main.py -h": ["main.py", "-h"],
+    "index stage": ["-c", "import main, spl.index, spl.history"],
+    "label stage": ["-c", "import spl.labels"],
+}
+
+
+def _run(args, importtime=False):
+    return subprocess.run(
+        [sys.executable] + (["-X", "importtime"] if importtime else []) + args,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+        check=True,
+        env={**os.environ, "PYTHONPATH": os.getcwd()},
+    )
+
+
+def time_command(args, runs):
+    """Returns the wall times of running the command in fresh interpreters."""
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        _run(args)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def get_slowest_imports(args, top):
+    """Returns the modules with the longest cumulative import times of the
+    command, in seconds, slowest first."""
+    imports = []
+    for line in _run(args, importtime=True).stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        imports.append((int(cumulative) / 1e6, name.rstrip()))
+    return sorted(imports, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--target", type=float, default=1.0)
+    parser.add_argument("--importtime", choices=COMMANDS)
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args()
+
+    for name, command in COMMANDS.items():
+        times = time_command(command, args.runs)
+        status = "ok" if min(times) < args.target else "SLOW"
+        print(
+            f"{name:>12}: min {min(times):.3f}s, "
+            f"median {statistics.median(times):.3f}s "
+            f"({status}, target {args.target:.1f}s)"
+        )
+
+    if args.importtime:
+        print(f"\nSlowest imports of {args.importtime}:")
+        for seconds, module in get_slowest_imports(
+            COMMANDS[args.importtime], args.top
+        ):
+            print(f"{seconds:8.3f}s  {module}")
+
+
+if __name__ == "__main__":
+    main()
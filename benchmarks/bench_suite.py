@@ -0,0 +1,283 @@
+"""
+Benchmark suite of the label processing, over a synthetic corpus generated by
+synthetic_spl.py. Runs:
+
+    labels   SplHistoricalLabels over the label zip files of each set ID,
+             with each of the label parsers
+    titles   section title matching, with an empty title cache
+    index    SplIndexFile over the SPL index pages
+    history  get_spl over the set ID history pages
+
+and reports items/sec, MB/sec and the peak memory increase of each. Save the
+results with --save and compare a later run against them with --compare to
+catch regressions.
+
+Run from the source root:
+    $ PYTHONPATH=. python benchmarks/bench_suite.py --save=before.json
+    $ PYTHONPATH=. python benchmarks/bench_suite.py --compare=before.json
+    $ PYTHONPATH=. python benchmarks/bench_suite.py --sections=200 --depth=2 \
+        --products=3 --approvals=2 --legacy --only labels
+"""
+
+import argparse
+import io
+import json
+import re
+import time
+import tracemalloc
+import zipfile
+
+from spl.history import get_spl
+from spl.index import SplIndexFile
+from spl.labels import SplHistoricalLabels
+from spl.section_titles import normalize_title
+from synthetic_spl import (
+    LabelShape,
+    make_history_pages,
+    make_index_page,
+    make_label_zip,
+    make_set_ids,
+)
+
+BENCHMARKS = ["labels", "titles", "index", "history"]
+
+_TITLE_REGEX = re.compile(rb"<title>(.*?)</title>", re.S)
+
+
+class _PeakMemory:
+    """
+    Measures the peak increase of the process memory use. On Linux, this is
+    the resident set size, which counts the memory allocated by lxml as well;
+    elsewhere only the Python allocations are traced.
+    """
+
+    def __init__(self):
+        try:
+            self._reset_hwm()
+            self.use_proc = True
+        except OSError:
+            self.use_proc = False
+
+    @staticmethod
+    def _reset_hwm():
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+
+    @staticmethod
+    def _read_status(name):
+        with open("/proc/self/status") as f:
+            return int(re.search(rf"{name}:\s+(\d+)", f.read()).group(1)) * 1024
+
+    def __enter__(self):
+        if self.use_proc:
+            self._reset_hwm()
+            self._start = self._read_status("VmRSS")
+        else:
+            tracemalloc.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.use_proc:
+            self.peak = self._read_status("VmHWM") - self._start
+        else:
+            self.peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+
+class Corpus:
+    """The synthetic data benchmarked, generated once up front."""
+
+    def __init__(self, args):
+        shape = LabelShape(
+            sections=args.sections,
+            depth=args.depth,
+            fanout=args.fanout,
+            products=args.products,
+            approvals=args.approvals,
+            legacy=args.legacy,
+        )
+        self.shape = shape
+        self.set_ids = make_set_ids(args.set_ids)
+        self.label_zips = {
+            set_id: {
+                version: make_label_zip(set_id, version, shape)
+                for version in range(1, args.versions + 1)
+            }
+            for set_id in self.set_ids
+        }
+        self.label_xmls = []
+        for zips in self.label_zips.values():
+            for content in zips.values():
+                with zipfile.ZipFile(io.BytesIO(content)) as zip_obj:
+                    self.label_xmls.extend(
+                        zip_obj.read(x)
+                        for x in zip_obj.namelist()
+                        if x.endswith(".xml")
+                    )
+        self.titles = [
+            x.decode()
+            for xml in self.label_xmls
+            for x in _TITLE_REGEX.findall(xml)
+        ]
+        page_size = 100
+        index_set_ids = make_set_ids(args.index_pages * page_size, seed=1)
+        self.index_pages = [
+            make_index_page(
+                page_num,
+                args.index_pages,
+                index_set_ids[
+                    (page_num - 1) * page_size : page_num * page_size
+                ],
+            )
+            for page_num in range(1, args.index_pages + 1)
+        ]
+        self.history_pages = {
+            set_id: make_history_pages(set_id, args.history_versions)
+            for set_id in make_set_ids(args.history_set_ids, seed=2)
+        }
+
+
+def bench_labels(corpus, parser):
+    for set_id, zips in corpus.label_zips.items():
+        spl = {
+            "data": {
+                "spl": {"setid": set_id},
+                "history": [{"spl_version": x} for x in zips],
+            }
+        }
+        SplHistoricalLabels(
+            spl, None, parser=parser, in_memory=True, zip_contents=zips
+        )
+    return len(corpus.label_xmls), sum(map(len, corpus.label_xmls))
+
+
+def bench_titles(corpus):
+    normalize_title.cache_clear()
+    matcher = SplHistoricalLabels.SECTION_MATCHER
+    for title in corpus.titles:
+        matcher.match(title)
+    return len(corpus.titles), sum(len(x.encode()) for x in corpus.titles)
+
+
+def bench_index(corpus):
+    for page_num, content in enumerate(corpus.index_pages, start=1):
+        SplIndexFile(page_number=page_num, content=content)
+    return len(corpus.index_pages), sum(map(len, corpus.index_pages))
+
+
+def bench_history(corpus):
+    size = 0
+    for set_id, pages in corpus.history_pages.items():
+        get_spl(
+            set_id,
+            content=pages[0],
+            page_contents=dict(enumerate(pages[1:], start=2)),
+        )
+        size += sum(map(len, pages))
+    return len(corpus.history_pages), size
+
+
+def run(name, fn, iterations):
+    """Runs fn iterations times, returning the best rates and the peak
+    memory increase."""
+    best = None
+    with _PeakMemory() as memory:
+        for _ in range(iterations):
+            start = time.perf_counter()
+            items, size = fn()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+    return {
+        "name": name,
+        "items_per_sec": items / best,
+        "mb_per_sec": size / 1024**2 / best,
+        "peak_mb": memory.peak / 1024**2,
+    }
+
+
+def _print_result(result, baseline=None):
+    line = (
+        f"{result['name']:>14}: {result['items_per_sec']:10.1f} items/sec "
+        f"{result['mb_per_sec']:8.2f} MB/sec "
+        f"peak +{result['peak_mb']:7.1f} MB"
+    )
+    if baseline is not None:
+        change = result["items_per_sec"] / baseline["items_per_sec"] - 1
+        line += f"  {change:+7.1%} vs baseline"
+    print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument("--only", nargs="+", choices=BENCHMARKS)
+    parser.add_argument(
+        "--parsers", nargs="+", default=SplHistoricalLabels.PARSERS
+    )
+    parser.add_argument("--iterations", type=int, default=3)
+    parser.add_argument("--set_ids", type=int, default=20)
+    parser.add_argument("--versions", type=int, default=3)
+    parser.add_argument("--sections", type=int, default=20)
+    parser.add_argument("--depth", type=int, default=1)
+    parser.add_argument("--fanout", type=int, default=3)
+    parser.add_argument("--products", type=int, default=1)
+    parser.add_argument("--approvals", type=int, default=1)
+    parser.add_argument(
+        "--legacy",
+        action=argparse.BooleanOptionalAction,
+        help="Whether to use the legacy <manufacturedMedicine> product form",
+    )
+    parser.add_argument("--index_pages", type=int, default=20)
+    parser.add_argument("--history_set_ids", type=int, default=200)
+    parser.add_argument("--history_versions", type=int, default=150)
+    parser.add_argument("--save", help="Saves the results to a JSON file")
+    parser.add_argument(
+        "--compare", help="Compares the results to those saved in a file"
+    )
+    args = parser.parse_args()
+
+    corpus = Corpus(args)
+    print(
+        f"Corpus: {len(corpus.label_xmls)} labels of "
+        f"{corpus.shape.get_section_count()} sections "
+        f"({sum(map(len, corpus.label_xmls)) / 1024**2:.1f} MB), "
+        f"{len(corpus.titles)} titles, {len(corpus.index_pages)} index "
+        f"pages, {len(corpus.history_pages)} histories"
+    )
+
+    baselines = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baselines = {x["name"]: x for x in json.load(f)}
+
+    benchmarks = []
+    selected = args.only or BENCHMARKS
+    if "labels" in selected:
+        for label_parser in args.parsers:
+            benchmarks.append(
+                (
+                    f"labels[{label_parser}]",
+                    lambda p=label_parser: bench_labels(corpus, p),
+                )
+            )
+    if "titles" in selected:
+        benchmarks.append(("titles", lambda: bench_titles(corpus)))
+    if "index" in selected:
+        benchmarks.append(("index", lambda: bench_index(corpus)))
+    if "history" in selected:
+        benchmarks.append(("history", lambda: bench_history(corpus)))
+
+    results = []
+    for name, fn in benchmarks:
+        result = run(name, fn, args.iterations)
+        _print_result(result, baselines.get(name))
+        results.append(result)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
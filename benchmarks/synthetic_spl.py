@@ -0,0 +1,238 @@
+"""
+Generator of synthetic DailyMed data for the benchmarks: SPL label XML
+documents of configurable size and shape, label zip files, SPL index pages
+and set id history pages.
+
+The generated documents follow the layout of the SPL documents published by
+DailyMed, closely enough for every field of the label version data to be
+parsed from them.
+
+Usage:
+    from synthetic_spl import LabelShape, make_label
+    xml = make_label("set-id", 1, LabelShape(sections=100, depth=2))
+"""
+
+import io
+import json
+import random
+from typing import NamedTuple
+import uuid
+import zipfile
+from xml.sax.saxutils import escape
+
+from spl.labels import SplHistoricalLabels
+
+# Titles of sections that are not of interest, as found in real labels
+OTHER_SECTIONS = [
+    "BOXED WARNING",
+    "CONTRAINDICATIONS",
+    "WARNINGS AND PRECAUTIONS",
+    "ADVERSE REACTIONS",
+    "DRUG INTERACTIONS",
+    "OVERDOSAGE",
+    "HOW SUPPLIED/STORAGE AND HANDLING",
+    "PATIENT COUNSELING INFORMATION",
+]
+
+_WORDS = (
+    "the tablets of patients with dose daily mg should be taken oral "
+    "administration hepatic renal impairment clinical studies adverse "
+    "reactions were observed in placebo treated groups"
+).split()
+
+
+class LabelShape(NamedTuple):
+    """The size and shape of a synthetic label."""
+
+    # The number of top-level sections
+    sections: int = 20
+    # The levels of sub-sections under each top-level section
+    depth: int = 1
+    # The number of sub-sections of each section, at each level
+    fanout: int = 3
+    # The number of products in the product data section
+    products: int = 1
+    # The number of NDA approvals of each product
+    approvals: int = 1
+    # Whether to use the legacy <manufacturedMedicine> product form
+    legacy: bool = False
+    # The number of words in each section text
+    words: int = 40
+
+    def get_section_count(self):
+        """Returns the total number of sections, including sub-sections."""
+        return self.sections * sum(
+            self.fanout**x for x in range(self.depth + 1)
+        )
+
+
+def _paragraph(rng, words):
+    return " ".join(rng.choice(_WORDS) for _ in range(words))
+
+
+def _section(rng, shape, number, title, level):
+    children = []
+    if level < shape.depth:
+        for i in range(1, shape.fanout + 1):
+            child_number = f"{number}.{i}"
+            children.append(
+                _section(
+                    rng,
+                    shape,
+                    child_number,
+                    f"{child_number} Subsection",
+                    level + 1,
+                )
+            )
+    return (
+        f'<component><section><id root="{uuid.UUID(int=rng.getrandbits(128))}"/>'
+        f"<title>{escape(title)}</title>"
+        f"<text><paragraph>{_paragraph(rng, shape.words)}</paragraph></text>"
+        f"{''.join(children)}</section></component>"
+    )
+
+
+def _product(rng, shape, index):
+    form = "manufacturedMedicine" if shape.legacy else "manufacturedProduct"
+    approvals = "".join(
+        f"<subjectOf><approval>"
+        f'<id extension="NDA{rng.randint(1, 999999):06d}" '
+        f'root="2.16.840.1.113883.3.150"/>'
+        f'<code code="C73594" codeSystem="2.16.840.1.113883.3.26.1.1" '
+        f'displayName="NDA"/>'
+        f"</approval></subjectOf>"
+        for _ in range(shape.approvals)
+    )
+    return (
+        f"<subject><manufacturedProduct><{form}>"
+        f"<name>Benchamide {index} <suffix>XR</suffix></name>"
+        f"<asEntityWithGeneric><genericMedicine>"
+        f"<name>benchamide hydrochloride</name>"
+        f"</genericMedicine></asEntityWithGeneric>"
+        f'<ingredient classCode="ACTIB"><ingredientSubstance>'
+        f"<name>Benchamide Hydrochloride</name>"
+        f"<activeMoiety><activeMoiety><name>Benchamide</name>"
+        f"</activeMoiety></activeMoiety>"
+        f"</ingredientSubstance></ingredient>"
+        f"</{form}>{approvals}</manufacturedProduct></subject>"
+    )
+
+
+def make_label(set_id, version, shape=LabelShape(), seed=0):
+    """
+    Returns a synthetic SPL label XML document. Every other top-level section
+    has a title of interest (one of SplHistoricalLabels.LABEL_SECTIONS).
+
+    Args:
+        set_id (str): the set id of the label
+        version (int): the spl version of the label
+        shape (LabelShape, optional): the size and shape of the label
+        seed (int, optional): the seed of the generated text
+
+    Returns:
+        bytes: the label XML document
+    """
+    rng = random.Random(f"{seed}-{set_id}-{version}")
+    products = "".join(
+        _product(rng, shape, i) for i in range(1, shape.products + 1)
+    )
+    titles = SplHistoricalLabels.LABEL_SECTIONS
+    sections = "".join(
+        _section(
+            rng,
+            shape,
+            str(i),
+            f"{i} "
+            + (
+                titles[(i // 2) % len(titles)]
+                if i % 2
+                else OTHER_SECTIONS[(i // 2) % len(OTHER_SECTIONS)]
+            ),
+            0,
+        )
+        for i in range(1, shape.sections + 1)
+    )
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<document xmlns="urn:hl7-org:v3" '
+        'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">'
+        f'<id root="{uuid.UUID(int=rng.getrandbits(128))}"/>'
+        '<code code="34391-3" codeSystem="2.16.840.1.113883.6.1" '
+        'displayName="HUMAN PRESCRIPTION DRUG LABEL"/>'
+        "<title>BENCHAMIDE tablets, for oral use</title>"
+        f'<effectiveTime value="2020{version % 12 + 1:02d}15"/>'
+        f'<setId root="{set_id}"/>'
+        f'<versionNumber value="{version}"/>'
+        "<component><structuredBody>"
+        "<component><section>"
+        '<code code="48780-1" codeSystem="2.16.840.1.113883.6.1" '
+        'displayName="SPL PRODUCT DATA ELEMENTS SECTION"/>'
+        f"{products}</section></component>"
+        f"{sections}"
+        "</structuredBody></component></document>"
+    ).encode()
+
+
+def make_label_zip(set_id, version, shape=LabelShape(), seed=0):
+    """Returns the label zip file of the set id version, as downloaded from
+    DailyMed, holding a synthetic label and a product image."""
+    content = io.BytesIO()
+    with zipfile.ZipFile(content, "w", zipfile.ZIP_DEFLATED) as zip_obj:
+        spl_id = uuid.UUID(
+            int=random.Random(f"{set_id}-{version}").getrandbits(128)
+        )
+        zip_obj.writestr(
+            f"{spl_id}.xml", make_label(set_id, version, shape, seed)
+        )
+        zip_obj.writestr("product-01.jpg", bytes(1024))
+    return content.getvalue()
+
+
+def make_set_ids(count, seed=0):
+    """Returns count distinct set ids."""
+    rng = random.Random(seed)
+    return [str(uuid.UUID(int=rng.getrandbits(128))) for _ in range(count)]
+
+
+def make_index_page(page_num, total_pages, set_ids):
+    """Returns a page of the SPL index, listing the set ids."""
+    spls = "".join(
+        f"<spl><setid>{x}</setid><spl_version>1</spl_version>"
+        f"<title>BENCHAMIDE TABLET [BENCH PHARMACEUTICALS INC.]</title>"
+        f"<published_date>May 12, 2021</published_date></spl>"
+        for x in set_ids
+    )
+    return (
+        f"<spls><metadata><total_elements>{total_pages * len(set_ids)}"
+        f"</total_elements><elements_per_page>{len(set_ids)}"
+        f"</elements_per_page><total_pages>{total_pages}</total_pages>"
+        f"<current_page>{page_num}</current_page></metadata>{spls}</spls>"
+    ).encode()
+
+
+def make_history_pages(set_id, versions, page_size=100):
+    """Returns the pages of the set id history, listing versions versions."""
+    total_pages = max((versions - 1) // page_size + 1, 1)
+    pages = []
+    for page in range(1, total_pages + 1):
+        last = versions - (page - 1) * page_size
+        history = [
+            {"spl_version": x, "published_date": "May 02, 2019"}
+            for x in range(last, max(last - page_size, 0), -1)
+        ]
+        pages.append(
+            json.dumps(
+                {
+                    "data": {
+                        "spl": {"title": "BENCHAMIDE", "setid": set_id},
+                        "history": history,
+                    },
+                    "metadata": {
+                        "total_elements": versions,
+                        "total_pages": total_pages,
+                        "current_page": page,
+                    },
+                }
+            ).encode()
+        )
+    return pages
@@ -1,7 +1,11 @@
+import contextlib
 from dotenv import dotenv_values
 import os
 import pymongo
+import threading
+from pymongo import UpdateOne
 
+from utils import metrics
 from utils.logging import getLogger
 
 _logger = getLogger(__name__)
@@ -12,31 +16,135 @@ _config = dict(
     )
 )
 
+# The client of the current process, created on first use
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def _track_write(operation):
+    # Times the write, and counts it as an error if it fails
+    try:
+        with metrics.timer("mongo_write_seconds", operation=operation):
+            yield
+    except Exception as e:
+        metrics.count_error("mongo", e)
+        raise
+
 
 class MongoClient:
     def __init__(self, db_client):
         self.db_client = db_client
 
-    def find(self, collection_name, query):
+    def find(self, collection_name, query, projection=None):
         collection = self.__get_collection(collection_name)
         results = None
         if type(query) == dict:
             query = [query]
         if not len(query):
-            results = collection.find()
+            results = collection.find({}, projection)
         elif len(query) == 1:
-            results = collection.find(query[0])
+            results = collection.find(query[0], projection)
         else:
-            results = collection.find({"$and": query})
+            results = collection.find({"$and": query}, projection)
         return results
 
     def insert(self, collection_name, document):
         collection = self.__get_collection(collection_name)
-        collection.insert(document)
+        with _track_write("insert"):
+            collection.insert(document)
 
     def upsert(self, collection_name, query, document):
         collection = self.__get_collection(collection_name)
-        collection.update(query, document, upsert=True)
+        with _track_write("upsert"):
+            collection.replace_one(query, document, upsert=True)
+
+    def bulk_upsert(self, collection_name, key_fields, documents):
+        """
+        Upserts the documents in a single unordered bulk write. Each document
+        is matched on its key_fields, and its fields are set on the existing
+        document, so other fields already stored are kept.
+
+        Args:
+            collection_name (str): the name of the collection
+            key_fields (list[str]): the fields identifying a document
+            documents (list[dict]): the documents to upsert
+
+        Returns:
+            pymongo.results.BulkWriteResult: the result of the bulk write, or
+                                             None if there are no documents
+        """
+        if not documents:
+            return None
+        collection = self.__get_collection(collection_name)
+        with _track_write("bulk_upsert"):
+            return collection.bulk_write(
+                [
+                    UpdateOne(
+                        {key: document[key] for key in key_fields},
+                        {"$set": document},
+                        upsert=True,
+                    )
+                    for document in documents
+                ],
+                ordered=False,
+            )
+
+    def bulk_insert_new(self, collection_name, key_fields, documents):
+        """
+        Inserts the documents not stored yet in a single unordered bulk
+        write. Each document is matched on its key_fields, and documents
+        already stored are left unchanged.
+
+        Args:
+            collection_name (str): the name of the collection
+            key_fields (list[str]): the fields identifying a document
+            documents (list[dict]): the documents to insert
+
+        Returns:
+            pymongo.results.BulkWriteResult: the result of the bulk write, or
+                                             None if there are no documents
+        """
+        if not documents:
+            return None
+        collection = self.__get_collection(collection_name)
+        with _track_write("bulk_insert_new"):
+            return collection.bulk_write(
+                [
+                    UpdateOne(
+                        {key: document[key] for key in key_fields},
+                        {
+                            "$setOnInsert": {
+                                key: value
+                                for key, value in document.items()
+                                if key not in key_fields
+                            }
+                        },
+                        upsert=True,
+                    )
+                    for document in documents
+                ],
+                ordered=False,
+            )
+
+    def update_many(self, collection_name, query, update):
+        collection = self.__get_collection(collection_name)
+        with _track_write("update_many"):
+            collection.update_many(query, update)
+
+    def create_indexes(self, collection_name, indexes):
+        """
+        Creates the indexes of the collection, if they do not exist yet.
+
+        Args:
+            collection_name (str): the name of the collection
+            indexes (list[tuple]): the (keys, options) of each index, as taken
+                                   by pymongo's create_index
+        """
+        collection = self.__get_collection(collection_name)
+        for keys, options in indexes:
+            collection.create_index(keys, **options)
 
     def __get_collection(self, collection_name):
         return self.db_client[collection_name]
@@ -55,3 +163,16 @@ def connect_mongo():
     except Exception as e:
         _logger.error(f"Error occured {e}")
         return
+
+
+def get_client():
+    """Returns the MongoClient of the current process, connecting on first
+    use. pymongo clients are not fork-safe, so clients are never shared
+    across processes: each worker process gets its own, with its own
+    connection pool."""
+    global _client, _client_pid
+    with _client_lock:
+        if _client is None or _client_pid != os.getpid():
+            _client = MongoClient(connect_mongo())
+            _client_pid = os.getpid()
+        return _client
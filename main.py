@@ -1,15 +1,24 @@
 import argparse
+import contextlib
 import json
 import os
+import sys
 
-from spl.index import process_paginated_index
-from spl.history import process_spl_history
-from spl.labels import process_historical_labels
+from utils import (
+    http_cache,
+    http_client,
+    jsonl,
+    metrics,
+    profiling,
+    rate_limiter,
+)
+from utils.journal import ProgressJournal
 from utils.logging import getLogger
 
 _logger = getLogger("main")
 
 TEMP_DATA_FOLDER = "tempdata"
+PROFILE_FOLDER = os.path.join(TEMP_DATA_FOLDER, "profile")
 
 
 def parse_args():
@@ -46,20 +55,302 @@ def parse_args():
             "If this is set, it takes priority over --start_page and --num_pages."
         ),
     )
+    parser.add_argument(
+        "--bulk_archives",
+        nargs="+",
+        metavar="PATH",
+        help=(
+            "The paths of DailyMed full release archives (e.g. "
+            "dm_spl_release_human_rx_part1.zip) to process the labels of, "
+            "instead of downloading the labels. Nothing is downloaded."
+        ),
+    )
+    parser.add_argument(
+        "--index_data_from_file",
+        type=str,
+        nargs="?",
+        help=(
+            "The path to an index data file written with --write_index_data, "
+            "whose set ids to process instead of downloading the index"
+        ),
+    )
+    parser.add_argument(
+        "--history_data_from_file",
+        type=str,
+        nargs="?",
+        help=(
+            "The path to a history data file written with "
+            "--write_history_data, whose labels to process instead of "
+            "downloading the index and the SPL history"
+        ),
+    )
     parser.add_argument(
         "--write_index_data",
         action=argparse.BooleanOptionalAction,
-        help="Whether to save the downloaded index data as a json file",
+        help=(
+            "Whether to save the downloaded index data as a JSON Lines file, "
+            "written as the pages are processed"
+        ),
     )
     parser.add_argument(
         "--write_history_data",
         action=argparse.BooleanOptionalAction,
         help=(
-            "Whether to save the downloaded SPL history data as a json file. "
-            "Not applicable when set_ids_from_file is used."
+            "Whether to save the downloaded SPL history data as a JSON Lines "
+            "file, written as the histories are fetched"
+        ),
+    )
+    parser.add_argument(
+        "--data_compression",
+        choices=["gzip", "zstd"],
+        help=(
+            "The compression of the files written with --write_index_data "
+            "and --write_history_data. zstd needs the zstandard package. "
+            "Not compressed by default."
+        ),
+    )
+    parser.add_argument(
+        "--label_parser",
+        type=str,
+        choices=["bs4", "lxml"],
+        default="bs4",
+        help=(
+            "The parser used to process the label XML files. "
+            "lxml is faster and produces the same label data as bs4."
+        ),
+    )
+    parser.add_argument(
+        "--in_memory_zip",
+        action=argparse.BooleanOptionalAction,
+        help=(
+            "Whether to read the downloaded label zip files in memory, "
+            "instead of extracting them to the temp data folder"
+        ),
+    )
+    parser.add_argument(
+        "--version_workers",
+        type=int,
+        default=4,
+        help=(
+            "The number of versions of a set ID whose labels are downloaded "
+            "concurrently, within each worker process"
+        ),
+    )
+    parser.add_argument(
+        "--async_fetch",
+        action=argparse.BooleanOptionalAction,
+        help=(
+            "Whether to download the index, history and label data with "
+            "asyncio from a single process, parsing the data in a separate "
+            "pool of processes"
+        ),
+    )
+    parser.add_argument(
+        "--max_concurrency",
+        type=int,
+        default=100,
+        help=(
+            "The maximum number of requests in flight when using "
+            "--async_fetch"
+        ),
+    )
+    parser.add_argument(
+        "--connect_timeout",
+        type=float,
+        nargs="?",
+        help="Seconds to wait for a connection to DailyMed",
+    )
+    parser.add_argument(
+        "--read_timeout",
+        type=float,
+        nargs="?",
+        help="Seconds to wait for response data from DailyMed",
+    )
+    parser.add_argument(
+        "--max_retries",
+        type=int,
+        nargs="?",
+        help=(
+            "The number of times a request is retried, with exponential "
+            "backoff, on connection errors and 429/5xx responses"
         ),
     )
-    return parser.parse_args()
+    parser.add_argument(
+        "--stream",
+        action=argparse.BooleanOptionalAction,
+        help=(
+            "Whether to stream the set IDs from each index page into history "
+            "fetching, and each history into label processing, instead of "
+            "running the stages one after another. Keeps memory use flat "
+            "regardless of the number of pages."
+        ),
+    )
+    parser.add_argument(
+        "--stream_queue_size",
+        type=int,
+        default=100,
+        help="The number of items queued between the stages with --stream",
+    )
+    parser.add_argument(
+        "--incremental",
+        action=argparse.BooleanOptionalAction,
+        help=(
+            "Whether to only process the label versions not yet stored in "
+            "MongoDB"
+        ),
+    )
+    parser.add_argument(
+        "--max_concurrent_requests",
+        type=int,
+        default=32,
+        help=(
+            "The most requests to DailyMed in flight at once, across all "
+            "worker processes. The limit starts lower and adapts to the "
+            "latency and throttling of the responses. Not applicable with "
+            "--async_fetch, which uses --max_concurrency."
+        ),
+    )
+    parser.add_argument(
+        "--max_request_rate",
+        type=float,
+        nargs="?",
+        help=(
+            "The most requests to DailyMed per second, across all worker "
+            "processes. Not limited by default."
+        ),
+    )
+    parser.add_argument(
+        "--dedup_sections",
+        action=argparse.BooleanOptionalAction,
+        help=(
+            "Whether to store each distinct section text once, in the "
+            "label_sections collection, with the labels referencing the "
+            "section texts by hash"
+        ),
+    )
+    parser.add_argument(
+        "--http_cache",
+        action=argparse.BooleanOptionalAction,
+        help=(
+            "Whether to cache the downloaded data on disk, so that re-runs "
+            "only download what has changed"
+        ),
+    )
+    parser.add_argument(
+        "--http_cache_max_mb",
+        type=int,
+        default=2048,
+        help="The size cap of the HTTP cache, in MB",
+    )
+    parser.add_argument(
+        "--http_cache_ttl",
+        type=float,
+        default=24 * 60 * 60,
+        help=(
+            "Seconds for which the cached index and history data are used "
+            "before being revalidated. Label zip files are cached permanently."
+        ),
+    )
+    parser.add_argument(
+        "--resume",
+        action=argparse.BooleanOptionalAction,
+        help=(
+            "Whether to resume the last run, skipping the index pages, "
+            "histories and set IDs it completed, as recorded in its journal"
+        ),
+    )
+    parser.add_argument(
+        "--metrics_folder",
+        default=os.path.join(TEMP_DATA_FOLDER, "metrics"),
+        help=(
+            "The folder to write the metrics of the run to, as a JSON "
+            "summary (metrics.json) and a Prometheus textfile (metrics.prom)"
+        ),
+    )
+    parser.add_argument(
+        "--profile",
+        action=argparse.BooleanOptionalAction,
+        help=(
+            "Whether to profile the run with cProfile, in the parent and each "
+            "worker process. The merged stats are written to "
+            "tempdata/profile/profile.pstats, and the top functions by "
+            "cumulative time to tempdata/profile/profile.txt."
+        ),
+    )
+    args = parser.parse_args()
+    data_files = [
+        args.set_ids_from_file,
+        args.index_data_from_file,
+        args.history_data_from_file,
+    ]
+    if sum(bool(x) for x in data_files) > 1:
+        parser.error(
+            "Only one of --set_ids_from_file, --index_data_from_file and "
+            "--history_data_from_file can be used"
+        )
+    if args.bulk_archives and (
+        args.stream or args.async_fetch or any(data_files)
+    ):
+        parser.error(
+            "--bulk_archives cannot be used with --stream, --async_fetch, "
+            "--set_ids_from_file, --index_data_from_file or "
+            "--history_data_from_file"
+        )
+    if args.stream and (
+        args.async_fetch
+        or args.write_index_data
+        or args.write_history_data
+        or args.index_data_from_file
+        or args.history_data_from_file
+    ):
+        parser.error(
+            "--stream cannot be used with --async_fetch, --write_index_data, "
+            "--write_history_data, --index_data_from_file or "
+            "--history_data_from_file"
+        )
+    if args.write_history_data and args.history_data_from_file:
+        parser.error(
+            "--write_history_data cannot be used with --history_data_from_file"
+        )
+    return args
+
+
+def write_reports(args):
+    http_client.log_stats()
+    metrics.write_reports(
+        os.path.join(args.metrics_folder, "metrics.json"),
+        os.path.join(args.metrics_folder, "metrics.prom"),
+    )
+    if args.profile:
+        profiling.write_report(
+            os.path.join(PROFILE_FOLDER, "profile.pstats"),
+            os.path.join(PROFILE_FOLDER, "profile.txt"),
+        )
+
+
+def open_data_writer(enabled, name, compression):
+    # The data file is written under a provisional name, as its final name
+    # can depend on the outcome of the stage, e.g. the last index page
+    if not enabled:
+        return contextlib.nullcontext()
+    return jsonl.JsonlWriter(
+        jsonl.get_path(os.path.join(TEMP_DATA_FOLDER, name), compression)
+    )
+
+
+def close_data_writer(writer, name, compression):
+    if writer is not None:
+        path = writer.close(
+            jsonl.get_path(os.path.join(TEMP_DATA_FOLDER, name), compression)
+        )
+        _logger.info(f"Wrote {writer.count} records to {path}")
+
+
+def get_data_name(file_path):
+    # Names the data derived from a file after it, e.g. the history of the
+    # set ids of spl_index_pages_1_to_5.jsonl.gz is named pages_1_to_5
+    name = os.path.basename(file_path).split(".")[0]
+    return name[len("spl_index_") :] if name.startswith("spl_index_") else name
 
 
 def get_set_ids_from_file(file_path):
@@ -72,53 +363,194 @@ def get_set_ids_from_file(file_path):
 
 if __name__ == "__main__":
     # Note: For ongoing pipeline, the start_page value can be set based on the
-    # page number that was processed in the last run.
+    # page number that was processed in the last run. To pick up a run that
+    # was interrupted, run it again with the same args and --resume.
     args = parse_args()
     _logger.info(f"Running with args: {args}")
 
+    # The stages are imported once the args are parsed, and only the ones
+    # used, so that -h and the early stages do not wait on the imports of
+    # the label stage (bs4, cleantext, pymongo)
+    from spl.index import (
+        process_paginated_index,
+        process_paginated_index_async,
+    )
+    from spl.history import process_spl_history, process_spl_history_async
+
+    # Set the options of the HTTP client shared by all stages
+    http_client.configure(
+        connect_timeout=args.connect_timeout,
+        read_timeout=args.read_timeout,
+        max_retries=args.max_retries,
+        # Keep a connection alive for each version downloaded concurrently
+        pool_maxsize=max(args.version_workers, 10),
+    )
+    rate_limiter.configure(
+        max_concurrency=args.max_concurrent_requests,
+        rate=args.max_request_rate,
+    )
+
     # Create temp data folder if not exists
     if not os.path.exists(TEMP_DATA_FOLDER):
         os.mkdir(TEMP_DATA_FOLDER)
 
+    if args.http_cache:
+        http_cache.configure(
+            folder=os.path.join(TEMP_DATA_FOLDER, "http_cache"),
+            max_bytes=args.http_cache_max_mb * 1024**2,
+            ttl=args.http_cache_ttl,
+        )
+
+    # Collect the metrics of the worker processes, which must be set up
+    # before any of them are started
+    metrics.configure(os.path.join(args.metrics_folder, "workers"))
+    if args.profile:
+        profiling.configure(os.path.join(PROFILE_FOLDER, "workers"))
+        profiling.start()
+
+    # Record the work completed, so that the run can be resumed
+    journal = ProgressJournal(
+        os.path.join(TEMP_DATA_FOLDER, "journal.sqlite"),
+        resume=bool(args.resume),
+    )
+
+    if args.bulk_archives:
+        from spl.bulk import ingest_archives
+
+        ingest_archives(
+            args.bulk_archives,
+            parser=args.label_parser,
+            dedup_sections=bool(args.dedup_sections),
+        )
+        write_reports(args)
+        sys.exit()
+
+    if args.stream:
+        from spl.pipeline import run_pipeline
+
+        run_pipeline(
+            os.path.join(TEMP_DATA_FOLDER, "label_data"),
+            start_page=args.start_page,
+            num_pages=args.num_pages,
+            set_ids=(
+                get_set_ids_from_file(args.set_ids_from_file)
+                if args.set_ids_from_file
+                else None
+            ),
+            parser=args.label_parser,
+            in_memory=bool(args.in_memory_zip),
+            version_workers=args.version_workers,
+            incremental=bool(args.incremental),
+            dedup_sections=bool(args.dedup_sections),
+            queue_size=args.stream_queue_size,
+            journal=journal,
+        )
+        write_reports(args)
+        sys.exit()
+
     # Fetch set_ids
     all_set_ids = []
-    if args.set_ids_from_file:
+    # Names the history data after the set ids it is for
+    data_name = None
+    if args.history_data_from_file:
+        # The history is read from the file, below
+        pass
+    elif args.set_ids_from_file:
         # Read set ids from the resource file
         all_set_ids = get_set_ids_from_file(args.set_ids_from_file)
-    elif args.start_page and args.num_pages:
-        # Get SPL index data
-        all_spls, end_page = process_paginated_index(
-            start_page=args.start_page, num_pages=args.num_pages
+        data_name = get_data_name(args.set_ids_from_file)
+    elif args.index_data_from_file:
+        # Read set ids from the index data of an earlier run
+        all_set_ids = list(
+            {x["setid"] for x in jsonl.read_records(args.index_data_from_file)}
         )
+        data_name = get_data_name(args.index_data_from_file)
+    elif args.start_page and args.num_pages:
+        # Get SPL index data, and write it to a file as it is processed
+        with open_data_writer(
+            args.write_index_data, "spl_index_pages", args.data_compression
+        ) as index_writer:
+            if args.async_fetch:
+                all_spls, end_page = process_paginated_index_async(
+                    start_page=args.start_page,
+                    num_pages=args.num_pages,
+                    max_concurrency=args.max_concurrency,
+                    journal=journal,
+                    writer=index_writer,
+                )
+            else:
+                all_spls, end_page = process_paginated_index(
+                    start_page=args.start_page,
+                    num_pages=args.num_pages,
+                    journal=journal,
+                    writer=index_writer,
+                )
+            data_name = f"pages_{args.start_page}_to_{end_page}"
+            close_data_writer(
+                index_writer, f"spl_index_{data_name}", args.data_compression
+            )
         # Get unique setids, for the subsequent steps
-        all_set_ids = list(set(map(lambda x: x["setid"], all_spls)))
-        # Write data obtained into a json file
-        if args.write_index_data:
-            with open(
-                os.path.join(
-                    TEMP_DATA_FOLDER,
-                    f"spl_index_pages_{args.start_page}_to_{end_page}.json",
-                ),
-                "w+",
-            ) as f:
-                f.write(json.dumps(all_spls))
-
-    # Get SetID history, for all unique setids retrieved
-    all_setid_history = process_spl_history(all_set_ids)
-
-    # Write data obtained into a json file
-    if args.write_history_data:
-        with open(
-            os.path.join(
-                TEMP_DATA_FOLDER,
-                f"spl_history_pages.json",
-            ),
-            "w+",
-        ) as f:
-            f.write(json.dumps(all_setid_history))
+        all_set_ids = list(set(map(lambda x: x.setid, all_spls)))
+
+    if args.history_data_from_file:
+        # Read the SetID history of an earlier run
+        from spl.records import SplHistoryRecord
+
+        all_setid_history = [
+            SplHistoryRecord.from_json(x)
+            for x in jsonl.read_records(args.history_data_from_file)
+        ]
+    else:
+        # Get SetID history, for all unique setids retrieved, and write it to
+        # a file as it is fetched
+        with open_data_writer(
+            args.write_history_data, "spl_history", args.data_compression
+        ) as history_writer:
+            if args.async_fetch:
+                all_setid_history = process_spl_history_async(
+                    all_set_ids,
+                    max_concurrency=args.max_concurrency,
+                    journal=journal,
+                    writer=history_writer,
+                )
+            else:
+                all_setid_history = process_spl_history(
+                    all_set_ids, journal=journal, writer=history_writer
+                )
+            close_data_writer(
+                history_writer,
+                f"spl_history_{data_name}" if data_name else "spl_history",
+                args.data_compression,
+            )
 
     # Get label text for each SPL version and write to MongoDB if any
     # version contains an association with and NDA number.
-    process_historical_labels(
-        all_setid_history, os.path.join(TEMP_DATA_FOLDER, "label_data")
+    from spl.labels import (
+        process_historical_labels,
+        process_historical_labels_async,
     )
+
+    if args.async_fetch:
+        process_historical_labels_async(
+            all_setid_history,
+            os.path.join(TEMP_DATA_FOLDER, "label_data"),
+            parser=args.label_parser,
+            in_memory=bool(args.in_memory_zip),
+            max_concurrency=args.max_concurrency,
+            incremental=bool(args.incremental),
+            dedup_sections=bool(args.dedup_sections),
+            journal=journal,
+        )
+    else:
+        process_historical_labels(
+            all_setid_history,
+            os.path.join(TEMP_DATA_FOLDER, "label_data"),
+            parser=args.label_parser,
+            in_memory=bool(args.in_memory_zip),
+            version_workers=args.version_workers,
+            incremental=bool(args.incremental),
+            dedup_sections=bool(args.dedup_sections),
+            journal=journal,
+        )
+
+    write_reports(args)
@@ -0,0 +1,200 @@
+"""
+Offline ingestion of the full release archives published by DailyMed, e.g.
+dm_spl_release_human_rx_part1.zip, instead of downloading the label of each
+set ID version.
+
+A full release archive is a zip file of label zip files, one per set ID,
+each holding the label XML file of the current version of the set ID and its
+images. The label zip files are read straight from the archive, without
+extracting it, and their labels are parsed in a pool of processes with the
+same extraction logic as SplHistoricalLabels. The labels are then grouped by
+set ID, and the labels of set IDs with application numbers are stored in
+MongoDB, as in process_historical_labels.
+
+Release archives can be found at:
+https://dailymed.nlm.nih.gov/dailymed/spl-resources-all-drug-labels.cfm
+"""
+
+import concurrent.futures
+import io
+import os
+import zipfile
+
+from spl.labels import (
+    _create_indexes,
+    _set_application_numbers,
+    _store_labels,
+    process_label,
+    read_label_zip,
+)
+from utils import metrics, profiling
+from utils.logging import getLogger
+from utils.scheduling import process_pool
+
+_logger = getLogger(__name__)
+
+# The number of labels stored per bulk write
+BULK_WRITE_SIZE = 1000
+
+# The archives opened by the current process, by path
+_archives = {}
+_archives_pid = None
+
+
+def _open_archive(archive_path):
+    # The archives are opened once per process, as reading the central
+    # directory of a full release archive takes a while. An archive opened
+    # by the parent shares its file position with the forked workers, so
+    # each process opens its own.
+    global _archives_pid
+    if _archives_pid != os.getpid():
+        _archives.clear()
+        _archives_pid = os.getpid()
+    archive = _archives.get(archive_path)
+    if archive is None:
+        archive = _archives[archive_path] = zipfile.ZipFile(archive_path, "r")
+    return archive
+
+
+def get_label_zip_names(archive_path):
+    """Returns the names of the label zip files in the release archive.
+
+    Args:
+        archive_path (str): the path of the release archive
+
+    Returns:
+        list[str]: the names of the label zip files in the archive
+    """
+    with zipfile.ZipFile(archive_path, "r") as archive:
+        return [x for x in archive.namelist() if x.endswith(".zip")]
+
+
+@metrics.flush_after
+@profiling.profile_worker
+def parse_archive_label_zip(archive_path, name, parser="bs4"):
+    """
+    Parses the labels of a label zip file in the release archive.
+
+    Args:
+        archive_path (str): the path of the release archive
+        name (str): the name of the label zip file in the archive
+        parser (str, optional): The label XML parser to use, one of
+                                SplHistoricalLabels.PARSERS. Defaults to "bs4".
+
+    Returns:
+        list[LabelVersion]: the label version data parsed
+    """
+    try:
+        with metrics.timer("unzip_seconds"):
+            content = _open_archive(archive_path).read(name)
+        xml_files = read_label_zip(content)
+    except Exception as e:
+        _logger.error(f"Unable to read {name} from {archive_path}: {e}")
+        metrics.count_error("labels", e)
+        return []
+    labels = [
+        process_label(io.BytesIO(xml), parser, spl_id)
+        for spl_id, xml in xml_files
+    ]
+    return [x for x in labels if x is not None]
+
+
+def _parse_archives(archive_paths, parser, workers):
+    """
+    Parses the labels of the release archives in a pool of processes,
+    yielding them as they are parsed. At most a few label zip files per
+    worker are queued at once, so that the archives are streamed through
+    the pool rather than listed up front.
+    """
+    max_pending = workers * 4
+    with process_pool(workers) as pool:
+        pending = set()
+        for archive_path in archive_paths:
+            names = get_label_zip_names(archive_path)
+            _logger.info(
+                f"Reading {len(names)} label zip files from {archive_path}"
+            )
+            for name in names:
+                if len(pending) >= max_pending:
+                    done, pending = concurrent.futures.wait(
+                        pending,
+                        return_when=concurrent.futures.FIRST_COMPLETED,
+                    )
+                    for future in done:
+                        yield from future.result()
+                pending.add(
+                    pool.submit(
+                        parse_archive_label_zip, archive_path, name, parser
+                    )
+                )
+        for future in concurrent.futures.as_completed(pending):
+            yield from future.result()
+
+
+def _group_by_set_id(labels):
+    """Groups the labels by set ID, keeping one label per SPL ID, as a label
+    can be found in more than one archive."""
+    set_ids = {}
+    for label in labels:
+        set_ids.setdefault(label.set_id, {})[label.spl_id] = label
+    return {set_id: list(labels.values()) for set_id, labels in set_ids.items()}
+
+
+def ingest_archives(
+    archive_paths, parser="bs4", dedup_sections=False, workers=None
+):
+    """
+    Processes the labels in the DailyMed full release archives, without
+    downloading anything. If any label of a given set_id has an association
+    with one or more NDA numbers, the labels of the set_id are saved to
+    MongoDB, like process_historical_labels.
+
+    All the labels parsed are held in memory until they are grouped by set
+    ID, as the labels of a set ID can be spread across several archives
+    (e.g. a full release and the updates published since).
+
+    Args:
+        archive_paths (list[str]): the paths of the release archives
+        parser (str, optional): The label XML parser to use, one of
+                                SplHistoricalLabels.PARSERS. Defaults to "bs4".
+        dedup_sections (bool, optional): Whether to store each section text
+                                         once, in the label_sections
+                                         collection, and reference it from
+                                         the labels. Defaults to False.
+        workers (int, optional): the number of processes parsing the labels.
+                                 Defaults to the number of CPUs.
+
+    Returns:
+        int: the number of set IDs stored
+    """
+    if workers is None:
+        workers = os.cpu_count()
+    if not isinstance(workers, int) or workers < 1:
+        raise ValueError("Workers must be a positive integer")
+    for archive_path in archive_paths:
+        if not zipfile.is_zipfile(archive_path):
+            raise ValueError(f"Not a zip file: {archive_path}")
+
+    _create_indexes()
+    set_ids = _group_by_set_id(_parse_archives(archive_paths, parser, workers))
+
+    stored = 0
+    documents = []
+    for set_id, labels in set_ids.items():
+        application_numbers = set()
+        for label in labels:
+            application_numbers.update(label.application_numbers)
+        labels = _set_application_numbers(labels, application_numbers)
+        if not labels:
+            continue
+        stored += 1
+        documents.extend(labels)
+        if len(documents) >= BULK_WRITE_SIZE:
+            _store_labels(documents, dedup_sections)
+            documents = []
+    _store_labels(documents, dedup_sections)
+    _logger.info(
+        f"Stored the labels of {stored} of {len(set_ids)} set IDs from "
+        f"{len(archive_paths)} archives"
+    )
+    return stored
@@ -1,12 +1,20 @@
+import asyncio
 import concurrent.futures
+import json
 import os
 
-import requests
-
+from spl.records import SplHistoryRecord
+from utils import http_client, metrics, profiling
+from utils.async_http import AsyncFetcher
+from utils.journal import HISTORY_STAGE
 from utils.logging import getLogger
+from utils.scheduling import process_pool
 
 _logger = getLogger(__name__)
 
+# The number of pages of a set id history fetched concurrently
+HISTORY_PAGE_WORKERS = 4
+
 
 class SplHistoryResponse:
     """
@@ -17,14 +25,35 @@ class SplHistoryResponse:
     BASE_URL = "https://dailymed.nlm.nih.gov/dailymed/services/v2/spls"
     RESOURCE_PATH = "history"
 
-    def __init__(self, set_id):
+    def __init__(self, set_id, content=None, page=1):
         if not isinstance(set_id, str):
             raise ValueError("Invalid Set ID")
+        if not isinstance(page, int) or page < 1:
+            raise ValueError("Invalid Page number")
         self.set_id = set_id
+        self.page = page
         # Attributes to store processed data
         self.data = {}
-        # Process
-        self._fetch_and_process()
+        # Process, skipping the download if the content was already fetched
+        if content is None:
+            self._fetch_and_process()
+        else:
+            self._process(content)
+
+    @staticmethod
+    def get_url(set_id, page=1):
+        """Returns the URL of the history JSON data for the set id.
+
+        Args:
+            set_id (str): the set id used by DailyMed
+            page (int, optional): the page number of the history. Defaults to
+                                  1.
+
+        Returns:
+            str: the URL of the set id history
+        """
+        url = f"{SplHistoryResponse.BASE_URL}/{set_id}/{SplHistoryResponse.RESOURCE_PATH}"
+        return url if page == 1 else f"{url}?page={page}"
 
     def get_total_pages(self):
         """Returns the value of the total pages of set id history, from its
@@ -35,59 +64,240 @@ class SplHistoryResponse:
         """
         return int(self.data["metadata"]["total_pages"])
 
+    def extend(self, other):
+        """Appends the history versions of another page of the set id history
+        to the data attribute.
+
+        Args:
+            other (SplHistoryResponse): a later page of the set id history
+        """
+        try:
+            self.data["data"]["history"].extend(other.data["data"]["history"])
+        except Exception as e:
+            _logger.error(
+                f"Missing page {other.page} of set ID {self.set_id} history: {e}"
+            )
+
     def _fetch_and_process(self):
         """
         Fetches the spl history and processes it. The parsed data is stored in the
         spl attribute.
         """
-        url = f"{SplHistoryResponse.BASE_URL}/{self.set_id}/{SplHistoryResponse.RESOURCE_PATH}"
-        r = requests.get(url, allow_redirects=True)
+        r = http_client.get(SplHistoryResponse.get_url(self.set_id, self.page))
+        self._process(r.content)
+
+    def _process(self, content):
+        """
+        Processes the downloaded history JSON data. The parsed data is stored
+        in the data attribute.
+
+        Args:
+            content (bytes): the downloaded history JSON data
+        """
         try:
-            self.data = r.json()
+            with metrics.timer("parse_seconds", stage="history"):
+                self.data = json.loads(content)
         except Exception as e:
             _logger.error(
                 f"Unable to parse JSON data from set ID {self.set_id}"
             )
+            metrics.count_error("history", e)
+
+
+@metrics.flush_after
+@profiling.profile_worker
+def get_spl(set_id, content=None, page_contents=None, first_page=None):
+    """
+    Fetches and processes every page of the set id history, merging the
+    history versions into the data of the first page. The pages after the
+    first are fetched concurrently.
 
+    Args:
+        set_id (str): the set id used by DailyMed
+        content (bytes, optional): the first page of the history, if already
+                                   fetched
+        page_contents (dict, optional): the later pages of the history, by
+                                        page number, if already fetched
+        first_page (SplHistoryResponse, optional): the first page of the
+                                                   history, if already
+                                                   parsed. content is then
+                                                   not used.
 
-def get_spl(set_id):
-    spl_history = SplHistoryResponse(set_id=set_id)
-    # TODO: Handle more than 1 page of set id history data.
-    # For now, simply report it.
+    Returns:
+        SplHistoryRecord: the set id history
+    """
+    spl_history = first_page
+    if spl_history is None:
+        spl_history = SplHistoryResponse(set_id=set_id, content=content)
     total_pages = spl_history.get_total_pages()
     if total_pages > 1:
-        _logger.error(
-            f"Unhandled: there are {total_pages} pages of set_id history"
-        )
-    return spl_history.data
+        page_nums = range(2, total_pages + 1)
+        if page_contents is not None:
+            pages = [
+                SplHistoryResponse(
+                    set_id, content=page_contents.get(x) or b"", page=x
+                )
+                for x in page_nums
+            ]
+        else:
+            with concurrent.futures.ThreadPoolExecutor(
+                max_workers=min(len(page_nums), HISTORY_PAGE_WORKERS)
+            ) as executor:
+                pages = list(
+                    executor.map(
+                        lambda x: SplHistoryResponse(set_id, page=x), page_nums
+                    )
+                )
+        for page in pages:
+            spl_history.extend(page)
+    metrics.inc("items_total", stage="history")
+    return SplHistoryRecord.from_json(spl_history.data)
+
 
+def _record_history(journal, set_id, spl, writer=None):
+    if journal is not None:
+        journal.record(HISTORY_STAGE, set_id, spl.to_json())
+    if writer is not None:
+        writer.write(spl.to_json())
 
-def process_spl_history(set_ids):
+
+def _split_journaled_histories(journal, set_ids):
+    """
+    Splits the set ids into the set ids whose history was already fetched,
+    according to the journal, and the set ids to fetch.
+
+    Args:
+        journal (ProgressJournal): the journal of the run, or None
+        set_ids (list[str]): the set ids
+
+    Returns:
+        (list[SplHistoryRecord], list[str]): The history of the set ids
+                                             already fetched, and the set ids
+                                             to fetch
+    """
+    if journal is None:
+        return [], set_ids
+    completed = journal.get_completed(HISTORY_STAGE)
+    spls = [
+        SplHistoryRecord.from_json(journal.get(HISTORY_STAGE, x))
+        for x in set_ids
+        if x in completed
+    ]
+    remaining = [x for x in set_ids if x not in completed]
+    if spls:
+        _logger.info(f"Skipping {len(spls)} set ID histories already fetched")
+    return spls, remaining
+
+
+def process_spl_history(set_ids, journal=None, writer=None):
     """
     Fetches the history of the input set ids.
 
     Args:
         set_ids (list[str]): a list of set ids used by DailyMed.
+        journal (ProgressJournal, optional): records the histories fetched.
+                                             The histories it already holds
+                                             are not downloaded again.
+                                             Defaults to None.
+        writer (JsonlWriter, optional): writes each history as it is
+                                        fetched. Defaults to None.
 
     Raises:
         ValueError: When set_ids is not set or is not a list
 
     Returns:
-        (list[dict]): The list of spls processed from the set_id's history
+        (list[SplHistoryRecord]): The list of spls processed from the set_id's
+                                  history
     """
     if set_ids is not None and not isinstance(set_ids, list):
         raise ValueError("Set ID data provided is incompatible.")
 
     # Fetch and process all set IDs in parallel
     _logger.info(f"Fetching and processing {len(set_ids)} set IDs")
-    spls = []
-    with concurrent.futures.ProcessPoolExecutor() as executor:
+    spls, set_ids = _split_journaled_histories(journal, set_ids)
+    if writer is not None:
+        writer.write_all(x.to_json() for x in spls)
+    with process_pool() as executor:
         for set_id, spl in zip(
             set_ids,
             executor.map(get_spl, set_ids),
         ):
             _logger.info(f"Processed history for set ID {set_id}")
             spls.append(spl)
+            _record_history(journal, set_id, spl, writer)
 
     # Return the history data of the spls
     return spls
+
+
+def process_spl_history_async(
+    set_ids, max_concurrency=100, journal=None, writer=None
+):
+    """
+    Fetches the history of the input set ids, like process_spl_history. The
+    history is downloaded with asyncio from a single process, with at most
+    max_concurrency requests in flight.
+
+    Args:
+        set_ids (list[str]): a list of set ids used by DailyMed.
+        max_concurrency (int, optional): the maximum number of requests in
+                                         flight. Defaults to 100.
+        journal (ProgressJournal, optional): records the histories fetched.
+                                             The histories it already holds
+                                             are not downloaded again.
+                                             Defaults to None.
+        writer (JsonlWriter, optional): writes each history as it is
+                                        fetched. Defaults to None.
+
+    Raises:
+        ValueError: When set_ids is not set or is not a list
+
+    Returns:
+        (list[SplHistoryRecord]): The list of spls processed from the set_id's
+                                  history. The set ids whose history could
+                                  not be fetched or parsed are left out.
+    """
+    if set_ids is not None and not isinstance(set_ids, list):
+        raise ValueError("Set ID data provided is incompatible.")
+
+    _logger.info(f"Fetching and processing {len(set_ids)} set IDs")
+    spls, set_ids = _split_journaled_histories(journal, set_ids)
+    if writer is not None:
+        writer.write_all(x.to_json() for x in spls)
+    return spls + asyncio.run(
+        _process_spl_history_async(set_ids, max_concurrency, journal, writer)
+    )
+
+
+async def _process_spl_history_async(set_ids, max_concurrency, journal, writer):
+    async with AsyncFetcher(max_concurrency=max_concurrency) as fetcher:
+
+        async def fetch_and_process(set_id):
+            try:
+                content = await fetcher.fetch(
+                    SplHistoryResponse.get_url(set_id)
+                )
+                # The JSON data is small, so it is parsed in the event loop
+                first_page = SplHistoryResponse(set_id, content=content or b"")
+                page_nums = range(2, first_page.get_total_pages() + 1)
+                page_contents = await fetcher.fetch_all(
+                    [SplHistoryResponse.get_url(set_id, x) for x in page_nums]
+                )
+                spl = get_spl(
+                    set_id,
+                    page_contents=dict(zip(page_nums, page_contents)),
+                    first_page=first_page,
+                )
+            except Exception as e:
+                # Skip the set ID, without stopping the others in flight
+                _logger.error(
+                    f"Unable to process history for set ID {set_id}: {e}"
+                )
+                metrics.count_error("history", e)
+                return None
+            _logger.info(f"Processed history for set ID {set_id}")
+            _record_history(journal, set_id, spl, writer)
+            return spl
+
+        spls = await asyncio.gather(*map(fetch_and_process, set_ids))
+        return [x for x in spls if x is not None]
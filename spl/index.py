@@ -1,10 +1,15 @@
-import concurrent.futures
+import asyncio
+import io
 import os
 
-import requests
-import xmltodict
+from lxml import etree
 
+from spl.records import SplIndexRecord
+from utils import http_client, metrics, profiling
+from utils.async_http import AsyncFetcher
+from utils.journal import INDEX_STAGE
 from utils.logging import getLogger
+from utils.scheduling import process_pool
 
 _logger = getLogger(__name__)
 
@@ -17,15 +22,30 @@ class SplIndexFile:
 
     BASE_URL = "https://dailymed.nlm.nih.gov/dailymed/services/v2/spls.xml"
 
-    def __init__(self, page_number):
+    def __init__(self, page_number, content=None):
         if not isinstance(page_number, int):
             raise ValueError("Invalid Page number")
         self.page_number = page_number
         # Attributes to store processed data
         self.metadata = {}
         self.spls = []
-        # Process
-        self._fetch_and_process()
+        # Process, skipping the download if the content was already fetched
+        if content is None:
+            self._fetch_and_process()
+        else:
+            self._process(content)
+
+    @staticmethod
+    def get_url(page_number):
+        """Returns the URL of the SPL index file for the page number.
+
+        Args:
+            page_number (int): the page number of the SPL index file
+
+        Returns:
+            str: the URL of the SPL index file
+        """
+        return f"{SplIndexFile.BASE_URL}?page={page_number}"
 
     def get_max_page_number(self):
         """Returns the max page number for the SPL index data from the metadata of the
@@ -41,37 +61,105 @@ class SplIndexFile:
         Fetches the spl file and processes it. The parsed data is stored in the
         spls attribute.
         """
-        url = f"{SplIndexFile.BASE_URL}?page={self.page_number}"
-        r = requests.get(url, allow_redirects=True)
+        r = http_client.get(SplIndexFile.get_url(self.page_number))
+        self._process(r.content)
+
+    def _process(self, content):
+        """
+        Processes the content of the spl file. The parsed data is stored in the
+        spls attribute.
+
+        Args:
+            content (bytes): the content of the spl file
+        """
+        if isinstance(content, str):
+            content = content.encode()
         try:
-            dict_data = xmltodict.parse(r.content)
-            self.metadata = dict_data["spls"]["metadata"]
-            self.spls = dict_data["spls"]["spl"]
+            with metrics.timer("parse_seconds", stage="index"):
+                # Parse the page incrementally, discarding elements once read
+                for _, element in etree.iterparse(
+                    io.BytesIO(content),
+                    events=("end",),
+                    tag=("metadata", "spl"),
+                    resolve_entities=False,
+                ):
+                    fields = {x.tag: x.text for x in element}
+                    if element.tag == "spl":
+                        self.spls.append(
+                            SplIndexRecord(
+                                setid=fields.get("setid"),
+                                spl_version=fields.get("spl_version"),
+                                published_date=fields.get("published_date"),
+                                title=fields.get("title"),
+                            )
+                        )
+                    else:
+                        self.metadata = fields
+                    element.clear()
+                    while element.getprevious() is not None:
+                        del element.getparent()[0]
+            metrics.inc("items_total", stage="index")
         except Exception as e:
             _logger.error(f"Unable to parse XML data from file")
+            metrics.count_error("index", e)
+            # Drop the spls parsed before the error, so that the page is not
+            # taken as complete, e.g. by the journal
+            self.spls = []
 
 
-def get_spls(page_num):
-    return SplIndexFile(page_number=page_num).spls
+@metrics.flush_after
+@profiling.profile_worker
+def get_spls(page_num, content=None):
+    return SplIndexFile(page_number=page_num, content=content).spls
 
 
-def process_paginated_index(start_page, num_pages=None):
+def _record_page(journal, page_num, spls, writer=None):
+    # A page that could not be processed has no spls, and is not recorded
+    if journal is not None and spls:
+        journal.record(INDEX_STAGE, page_num, [x._asdict() for x in spls])
+    _write_spls(writer, spls)
+
+
+def _write_spls(writer, spls):
+    if writer is not None:
+        writer.write_all(x._asdict() for x in spls)
+
+
+def _split_journaled_pages(journal, page_nums):
     """
-    Fetches index pages in the applicable range, from start_page.
+    Splits the page numbers into the pages already processed, according to
+    the journal, and the pages to fetch.
 
     Args:
-        start_page (int): the page number from which to start downloading the SPL index
-        num_pages (int, optional): the number of pages of the index data to download. If left unset, it will
-                                   download all pages available from the starting page number. Defaults to None.
-
-    Raises:
-        ValueError: When start_date is not set
-        ValueError: When start_date is not int or less than 1
-        ValueError: When num_pages is set but is not a positive integer
+        journal (ProgressJournal): the journal of the run, or None
+        page_nums (iterable[int]): the page numbers
 
     Returns:
-        (list[dict], int): The list of spls processed and the last spl index page number processed
+        (list[SplIndexRecord], list[int]): The spls of the pages already
+                                           processed, and the page numbers to
+                                           fetch
     """
+    if journal is None:
+        return [], list(page_nums)
+    completed = journal.get_completed(INDEX_STAGE)
+    spls = []
+    remaining = []
+    for page_num in page_nums:
+        if str(page_num) in completed:
+            spls.extend(
+                SplIndexRecord(**x) for x in journal.get(INDEX_STAGE, page_num)
+            )
+        else:
+            remaining.append(page_num)
+    if len(remaining) < len(page_nums):
+        _logger.info(
+            f"Skipping {len(page_nums) - len(remaining)} index pages already "
+            "processed"
+        )
+    return spls, remaining
+
+
+def _validate_page_range(start_page, num_pages):
     if not start_page:
         raise ValueError("SPL index start page is not set")
     if (not isinstance(start_page, int)) or start_page < 1:
@@ -82,31 +170,154 @@ def process_paginated_index(start_page, num_pages=None):
         ):
             raise ValueError("SPL index start page must be a positive integer")
 
-    # Get max page number available
-    first_spl_index_file = SplIndexFile(page_number=1)
-    max_page_number = first_spl_index_file.get_max_page_number()
 
+def _get_end_page(start_page, num_pages, max_page_number):
     if start_page > max_page_number:
-        # Nothing to process
-        return [], None
-
+        return None
     # Set end_page according to max_page_number available and num_pages to download
-    end_page = (
+    return (
         max_page_number
         if num_pages is None
         else min(start_page + num_pages - 1, max_page_number)
     )
 
-    # Fetch and process all pages in parallel
+
+def process_paginated_index(
+    start_page, num_pages=None, journal=None, writer=None
+):
+    """
+    Fetches index pages in the applicable range, from start_page.
+
+    Args:
+        start_page (int): the page number from which to start downloading the SPL index
+        num_pages (int, optional): the number of pages of the index data to download. If left unset, it will
+                                   download all pages available from the starting page number. Defaults to None.
+        journal (ProgressJournal, optional): records the pages processed. The pages it already holds are not
+                                             downloaded again. Defaults to None.
+        writer (JsonlWriter, optional): writes the spls of each page as it is processed. Defaults to None.
+
+    Raises:
+        ValueError: When start_date is not set
+        ValueError: When start_date is not int or less than 1
+        ValueError: When num_pages is set but is not a positive integer
+
+    Returns:
+        (list[SplIndexRecord], int): The list of spls processed and the last spl index page number processed
+    """
+    _validate_page_range(start_page, num_pages)
+
+    # Get max page number available
+    first_spl_index_file = SplIndexFile(page_number=1)
+    end_page = _get_end_page(
+        start_page, num_pages, first_spl_index_file.get_max_page_number()
+    )
+    if end_page is None:
+        # Nothing to process
+        return [], None
+
+    # Reuse the first page, if in range, rather than downloading it again
     all_spls = []
-    page_nums = range(start_page, end_page + 1)
-    with concurrent.futures.ProcessPoolExecutor() as executor:
+    if start_page == 1:
+        _logger.info(f"Processed index page 1")
+        all_spls.extend(first_spl_index_file.spls)
+        _record_page(journal, 1, first_spl_index_file.spls, writer)
+        start_page = 2
+
+    journaled_spls, page_nums = _split_journaled_pages(
+        journal, range(start_page, end_page + 1)
+    )
+    all_spls.extend(journaled_spls)
+    _write_spls(writer, journaled_spls)
+
+    # Fetch and process the other pages in parallel
+    with process_pool() as executor:
         for page_num, spls in zip(
             page_nums,
             executor.map(get_spls, page_nums),
         ):
             _logger.info(f"Processed index page {page_num}")
             all_spls.extend(spls)
+            _record_page(journal, page_num, spls, writer)
 
     # Return all the spls from the index and the last page number downloaded
     return all_spls, end_page
+
+
+def process_paginated_index_async(
+    start_page, num_pages=None, max_concurrency=100, journal=None, writer=None
+):
+    """
+    Fetches index pages in the applicable range, from start_page, like
+    process_paginated_index. The pages are downloaded with asyncio from a
+    single process, with at most max_concurrency requests in flight, and are
+    parsed in a pool of processes as they arrive.
+
+    Args:
+        start_page (int): the page number from which to start downloading the SPL index
+        num_pages (int, optional): the number of pages of the index data to download. If left unset, it will
+                                   download all pages available from the starting page number. Defaults to None.
+        max_concurrency (int, optional): the maximum number of requests in flight. Defaults to 100.
+        journal (ProgressJournal, optional): records the pages processed. The pages it already holds are not
+                                             downloaded again. Defaults to None.
+        writer (JsonlWriter, optional): writes the spls of each page as it is processed. Defaults to None.
+
+    Returns:
+        (list[SplIndexRecord], int): The list of spls processed and the last spl index page number processed
+    """
+    _validate_page_range(start_page, num_pages)
+    return asyncio.run(
+        _process_paginated_index_async(
+            start_page, num_pages, max_concurrency, journal, writer
+        )
+    )
+
+
+async def _process_paginated_index_async(
+    start_page, num_pages, max_concurrency, journal, writer
+):
+    loop = asyncio.get_running_loop()
+    async with AsyncFetcher(max_concurrency=max_concurrency) as fetcher:
+        # Get max page number available
+        first_spl_index_file = SplIndexFile(
+            page_number=1,
+            content=await fetcher.fetch(SplIndexFile.get_url(1)) or b"",
+        )
+        end_page = _get_end_page(
+            start_page, num_pages, first_spl_index_file.get_max_page_number()
+        )
+        if end_page is None:
+            # Nothing to process
+            return [], None
+
+        # Reuse the first page, if in range, rather than downloading it again
+        first_spls = []
+        if start_page == 1:
+            _logger.info(f"Processed index page 1")
+            first_spls = first_spl_index_file.spls
+            _record_page(journal, 1, first_spls, writer)
+            start_page = 2
+
+        journaled_spls, page_nums = _split_journaled_pages(
+            journal, range(start_page, end_page + 1)
+        )
+        _write_spls(writer, journaled_spls)
+
+        # Fetch the other pages concurrently, and parse them in parallel
+        with process_pool() as executor:
+
+            async def fetch_and_process(page_num):
+                content = await fetcher.fetch(SplIndexFile.get_url(page_num))
+                spls = await loop.run_in_executor(
+                    executor, get_spls, page_num, content or b""
+                )
+                _logger.info(f"Processed index page {page_num}")
+                _record_page(journal, page_num, spls, writer)
+                return spls
+
+            results = await asyncio.gather(*map(fetch_and_process, page_nums))
+
+    # Return all the spls from the index and the last page number downloaded
+    all_spls = (
+        first_spls + journaled_spls + [spl for spls in results for spl in spls]
+    )
+    return all_spls, end_page
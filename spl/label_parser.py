@@ -0,0 +1,472 @@
+from abc import ABC, abstractmethod
+import bisect
+import operator
+from pathlib import Path
+import re
+
+from lxml import etree
+import unicodedata
+
+from spl.records import LabelSection, LabelVersion
+from utils import metrics
+from utils.logging import getLogger
+
+_logger = getLogger(__name__)
+
+# All SPL documents are published in the HL7 v3 namespace
+SPL_NAMESPACE = "urn:hl7-org:v3"
+
+
+_XML_PARSER = etree.XMLParser(resolve_entities=False)
+
+# BeautifulSoup parses the labels as HTML, where a CDATA section is a bogus
+# comment and its text is dropped. It ends at the first ">" though, so a CDATA
+# section holding a ">" still gives a different text with each parser, as do
+# CDATA sections and comments in a <title>, which HTML takes as raw text.
+_CDATA = re.compile(rb"<!\[CDATA\[.*?\]\]>", re.DOTALL)
+
+# Characters BeautifulSoup treats as whitespace when collapsing strings
+_ASCII_SPACES = " \n\t\x0c\r"
+
+
+def get_xml_text(text):
+    # Process the label text; normalize remove nbsp
+    text = unicodedata.normalize("NFKC", text.lstrip().rstrip())
+    text = re.sub(r"\n\s*\n", "\n", text)
+    return text
+
+
+def get_xml_title(text):
+    # strip extra \n, \t, and spaces in titles, but keep number
+    text = get_xml_text(text)
+    text = re.sub(r"\.\s+", ".", text)
+    text = re.sub(r"\s+", " ", text)
+    return text
+
+
+def _collapse_whitespace(text):
+    # BeautifulSoup replaces strings made up only of whitespace with a single
+    # newline or space; do the same so that both parsers agree on the output
+    if text.strip(_ASCII_SPACES):
+        return text
+    return "\n" if "\n" in text else " "
+
+
+def _text(element):
+    """Returns the concatenated text of the element and its descendants.
+    Mirrors BeautifulSoup's .text."""
+    return "".join(map(_collapse_whitespace, element.itertext()))
+
+
+class LabelTree(ABC):
+    """
+    Adapts a parsed label tree for LabelIndex. Subclasses define how to walk
+    the elements of the tree, and how to get the name, attributes and text of
+    an element. The subclasses are passed to LabelIndex as they are, without
+    being instantiated.
+    """
+
+    @staticmethod
+    @abstractmethod
+    def walk(root):
+        """Yields ("start", element) and ("end", element) for each element
+        under root, including root itself, in document order."""
+
+    @staticmethod
+    @abstractmethod
+    def tag(name):
+        """Returns the element name used by the tree for the SPL element
+        name, e.g. "manufacturedProduct"."""
+
+    @staticmethod
+    @abstractmethod
+    def get_name(element):
+        """Returns the name of the element, as returned by tag."""
+
+    @staticmethod
+    @abstractmethod
+    def get_attribute(element, name):
+        """Returns the value of the SPL attribute name, e.g. "displayName".
+        Raises KeyError if the element does not have the attribute."""
+
+    @staticmethod
+    @abstractmethod
+    def get_text(element):
+        """Returns the concatenated text of the element and its
+        descendants."""
+
+
+class _LxmlLabelTree(LabelTree):
+    @staticmethod
+    def walk(root):
+        return etree.iterwalk(root, events=("start", "end"), tag=etree.Element)
+
+    @staticmethod
+    def tag(name):
+        return f"{{{SPL_NAMESPACE}}}{name}"
+
+    @staticmethod
+    def get_attribute(element, name):
+        return element.attrib[name]
+
+    get_name = operator.attrgetter("tag")
+    get_text = staticmethod(_text)
+
+
+class LabelIndex:
+    """
+    Index of the elements of a parsed label, built in a single walk over the
+    tree. Elements are numbered in document order, so the elements under an
+    element are those numbered from it to its last descendant. The positions
+    of the elements named in INDEXED_NAMES are kept in order, so that the
+    first or all such elements under any element are found by bisection.
+    """
+
+    # The SPL elements looked up when parsing a label
+    INDEXED_NAMES = [
+        "activeMoiety",
+        "approval",
+        "asEntityWithGeneric",
+        "code",
+        "component",
+        "effectiveTime",
+        "genericMedicine",
+        "id",
+        "manufacturedMedicine",
+        "manufacturedProduct",
+        "name",
+        "setId",
+        "structuredBody",
+        "text",
+        "title",
+        "versionNumber",
+    ]
+
+    def __init__(self, root, tree):
+        """
+        Args:
+            root: the root of the parsed label
+            tree (LabelTree): the adapter for the type of tree parsed
+        """
+        self.tree = tree
+        self.elements = []
+        self.parents = []
+        self.last = []
+        self.positions = {x: [] for x in LabelIndex.INDEXED_NAMES}
+        lookup = {tree.tag(x): self.positions[x] for x in self.positions}
+        # Local names for the calls made for every element
+        add_element = self.elements.append
+        add_parent = self.parents.append
+        add_last = self.last.append
+        last = self.last
+        find_positions = lookup.get
+        get_name = tree.get_name
+        # The positions of the elements being walked, from the root down
+        stack = [None]
+        push, pop = stack.append, stack.pop
+        i = -1
+        for event, element in tree.walk(root):
+            if event == "start":
+                i += 1
+                add_element(element)
+                add_parent(stack[-1])
+                add_last(i)
+                positions = find_positions(get_name(element))
+                if positions is not None:
+                    positions.append(i)
+                push(i)
+            else:
+                last[pop()] = i
+
+    def find_all(self, name, within):
+        """Returns the positions of the elements with the given SPL name
+        under the element at position within.
+
+        Args:
+            name (str): one of INDEXED_NAMES
+            within (int): the position of the element to search, 0 for the
+                          whole label
+
+        Raises:
+            LookupError: When within is None, i.e. the element to search was
+                         not found
+
+        Returns:
+            list[int]: the positions, in document order
+        """
+        if within is None:
+            raise LookupError(f"No element to search for <{name}>")
+        positions = self.positions[name]
+        return positions[
+            bisect.bisect_right(positions, within) : bisect.bisect_right(
+                positions, self.last[within]
+            )
+        ]
+
+    def find(self, name, within):
+        """Returns the position of the first element with the given SPL name
+        under the element at position within. Mirrors BeautifulSoup's
+        find(name).
+
+        Args:
+            name (str): one of INDEXED_NAMES
+            within (int): the position of the element to search, 0 for the
+                          whole label
+
+        Raises:
+            LookupError: When there is no such element, or within is None
+
+        Returns:
+            int: the position
+        """
+        if within is None:
+            raise LookupError(f"No element to search for <{name}>")
+        positions = self.positions[name]
+        i = bisect.bisect_right(positions, within)
+        if i == len(positions) or positions[i] > self.last[within]:
+            raise LookupError(f"No <{name}> found")
+        return positions[i]
+
+    def get_attribute(self, i, name):
+        return self.tree.get_attribute(self.elements[i], name)
+
+    def get_text(self, i):
+        return self.tree.get_text(self.elements[i])
+
+
+def extract_sections(index, section_matcher):
+    """
+    Extracts the label sections matched by section_matcher, along with their
+    sub-sections.
+
+    For each matched title, the section text is the first <text> under the
+    title's parent. If the parent holds other titles, they are listed as
+    sub-sections, and the section text becomes the <text> following the
+    title instead. Untitled sub-sections are collapsed into the previous one.
+
+    Args:
+        index (LabelIndex): the index of the parsed label
+        section_matcher (SectionTitleMatcher): matches the section titles of
+                                               interest
+
+    Raises:
+        LookupError: When a matched title or sub-title has no <text> in its
+                     section
+
+    Returns:
+        list[LabelSection]: the name, text and parent name of each section
+    """
+    parents, last = index.parents, index.last
+    titles = index.find_all("title", 0)
+    texts = index.find_all("text", 0)
+
+    def section_text(title):
+        # The first <text> under the title's parent
+        parent = parents[title]
+        i = bisect.bisect_right(texts, parent)
+        if i < len(texts) and texts[i] <= last[parent]:
+            return index.get_text(texts[i])
+        raise LookupError(
+            f"No text in the section of the title {index.get_text(title)!r}"
+        )
+
+    def next_sibling_text(title):
+        parent = parents[title]
+        i = bisect.bisect_right(texts, last[title])
+        while i < len(texts) and texts[i] <= last[parent]:
+            if parents[texts[i]] == parent:
+                return texts[i]
+            i += 1
+        return None
+
+    raw_titles = [index.get_text(x) for x in titles]
+    with metrics.timer("title_match_seconds"):
+        matches = [section_matcher.match(x) for x in raw_titles]
+
+    labels = []
+    for title, raw_title, match in zip(titles, raw_titles, matches):
+        if not match:
+            continue
+        title_name = get_xml_title(raw_title)
+        title_text = get_xml_text(section_text(title))
+
+        # Get sub-sections of the label; the first title under the parent is
+        # the title itself
+        subtitles = index.find_all("title", parents[title])
+        sub_section_labels = []
+        if len(subtitles) > 1:
+            sub_section_labels = [
+                LabelSection(
+                    name=get_xml_title(index.get_text(x)),
+                    text=get_xml_text(section_text(x)),
+                    parent=title_name,
+                )
+                for x in subtitles[1:]
+            ]
+            # Replace title text with sibling text if there are sub-sections
+            sibling = next_sibling_text(title)
+            title_text = index.get_text(sibling) if sibling is not None else ""
+
+        labels.append(LabelSection(title_name, title_text, None))
+        labels.extend(sub_section_labels)
+
+    # If there are sub-sections without titles, collapse them into the
+    # previous sub-section
+    corrected_labels = []
+    for item in labels:
+        if item.name:
+            corrected_labels.append(item)
+        elif corrected_labels and item.text:
+            corrected_labels[-1] = corrected_labels[-1]._replace(
+                text=corrected_labels[-1].text + "\n" + item.text
+            )
+    return corrected_labels
+
+
+def _get_application_numbers(set_id, index, component):
+    application_numbers = set()
+    try:
+        for item in index.find_all("approval", component):
+            code = index.find("code", item)
+            if index.get_attribute(code, "displayName") == "NDA":
+                # Capture the corresponding NDA number, without the "NDA"
+                # prefix and without leading zeros
+                extension = index.get_attribute(
+                    index.find("id", item), "extension"
+                )
+                appln_num = (
+                    extension[3:] if extension.startswith("NDA") else extension
+                )
+                application_numbers.add(str(int(appln_num)))
+    except Exception as e:
+        _logger.error(
+            f"Error in _get_application_numbers for set ID {set_id}: {e}"
+        )
+    return tuple(application_numbers)
+
+
+def _get_drug_name(index, product):
+    try:
+        product = index.find("manufacturedProduct", product)
+    except LookupError:
+        # Legacy format
+        product = index.find("manufacturedMedicine", product)
+    return index.get_text(index.find("name", product)).replace("\n", "")
+
+
+def _get_generic_name(index, product):
+    generic = index.find(
+        "genericMedicine", index.find("asEntityWithGeneric", product)
+    )
+    return index.get_text(index.find("name", generic)).replace("\n", "")
+
+
+def _get_active_ingredient(index, product):
+    moiety = index.find("activeMoiety", product)
+    return index.get_text(index.find("name", moiety)).replace("\n", "")
+
+
+def _safe_get(getter, set_id, default, *args):
+    try:
+        return getter(*args)
+    except Exception as e:
+        _logger.error(f"Error in {getter.__name__} for set ID {set_id}: {e}")
+        return default
+
+
+def extract_metadata(index):
+    """
+    Extracts the label metadata: the set id, version and effective date from
+    the label header, and the product names and NDA numbers from the product
+    data, locating the product and approval elements once.
+
+    Args:
+        index (LabelIndex): the index of the parsed label
+
+    Returns:
+        dict: the application_numbers, set_id, spl_version, published_date,
+              name, generic_name and active_ingredient of the label
+    """
+    set_id = index.get_attribute(index.find("setId", 0), "root")
+    version = index.get_attribute(index.find("versionNumber", 0), "value")
+    date = index.get_attribute(index.find("effectiveTime", 0), "value")
+    # The product data is in the first component of the structured body. If
+    # it is missing, the lookups under it fail and the fields are left empty.
+    component = product = None
+    try:
+        component = index.find(
+            "component",
+            index.find("structuredBody", index.find("component", 0)),
+        )
+        product = index.find("manufacturedProduct", component)
+    except LookupError:
+        pass
+    return {
+        "application_numbers": _get_application_numbers(
+            set_id, index, component
+        ),
+        "set_id": set_id,
+        "spl_version": version,
+        "published_date": f"{date[:4]}-{date[4:6]}-{date[-2:]}",
+        "name": _safe_get(_get_drug_name, set_id, "", index, product),
+        "generic_name": _safe_get(
+            _get_generic_name, set_id, "", index, product
+        ),
+        "active_ingredient": _safe_get(
+            _get_active_ingredient, set_id, "", index, product
+        ),
+    }
+
+
+def extract_label(index, section_matcher, spl_id):
+    """
+    Extracts the label version data: the metadata and the sections of the
+    label.
+
+    Args:
+        index (LabelIndex): the index of the parsed label
+        section_matcher (SectionTitleMatcher): matches the section titles of
+                                               interest
+        spl_id (str): the SPL ID of the label
+
+    Returns:
+        LabelVersion: the label version data
+    """
+    return LabelVersion(
+        **extract_metadata(index),
+        spl_id=spl_id,
+        sections=tuple(extract_sections(index, section_matcher)),
+    )
+
+
+def parse_label_xml(xml_file, section_matcher, spl_id=None):
+    """
+    Parses an SPL label XML file with lxml, producing the same label version
+    as the BeautifulSoup based parser in SplHistoricalLabels. As with that
+    parser, the text of CDATA sections and comments is left out.
+
+    Args:
+        xml_file (str or file): the full name (inclusive of the absolute path)
+                                of the label file to parse, or a binary file
+                                object to read it from
+        section_matcher (SectionTitleMatcher): matches the section titles of
+                                               interest
+        spl_id (str, optional): the SPL ID of the label. Defaults to the name
+                                of the label file without its extension.
+
+    Returns:
+        LabelVersion: the label version data
+    """
+    if spl_id is None:
+        spl_id = Path(xml_file).name[:-4]
+    if isinstance(xml_file, str):
+        with open(xml_file, "rb") as f:
+            content = f.read()
+    else:
+        content = xml_file.read()
+    if b"<![CDATA[" in content:
+        content = _CDATA.sub(b"", content)
+    root = etree.fromstring(content, _XML_PARSER)
+    return extract_label(
+        LabelIndex(root, _LxmlLabelTree), section_matcher, spl_id
+    )
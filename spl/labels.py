@@ -1,24 +1,99 @@
+import asyncio
 import concurrent.futures
+import functools
+import io
+import operator
 import os
 from pathlib import Path
-import re
 import shutil
+from typing import NamedTuple
 import zipfile
 
-from bs4 import BeautifulSoup as bs, Tag, NavigableString
-import cleantext
-import requests
-import unicodedata
-
-from db.mongo import connect_mongo, MongoClient
+from pymongo import ASCENDING
+
+from db.mongo import get_client
+from spl.label_parser import (
+    LabelIndex,
+    LabelTree,
+    extract_label,
+    parse_label_xml,
+)
+from spl.records import SplHistoryRecord
+from spl.section_store import load_sections, store_sections
+from spl.section_titles import SectionTitleMatcher
+from utils import http_client, metrics, profiling
+from utils.async_http import AsyncFetcher
+from utils.journal import LABELS_STAGE
 from utils.logging import getLogger
+from utils.scheduling import (
+    map_longest_first,
+    order_longest_first,
+    process_pool,
+)
 
 _logger = getLogger(__name__)
 
-_mongo_client = MongoClient(connect_mongo())
+# The client of the database, when set, e.g. by tests. Otherwise, each
+# process connects on first use.
+_mongo_client = None
 
 MONGO_COLLECTION_NAME = "labels"
 
+# Each label version is stored once per (set_id, spl_id)
+MONGO_KEY_FIELDS = ["set_id", "spl_id"]
+MONGO_INDEXES = [
+    ([(x, ASCENDING) for x in MONGO_KEY_FIELDS], {"unique": True}),
+    ([("application_numbers", ASCENDING)], {}),
+]
+
+# The number of set IDs looked up per query in incremental mode
+STORED_VERSIONS_QUERY_SIZE = 1000
+
+# The number of labels whose section texts are looked up per query
+FIND_LABELS_BATCH_SIZE = 100
+
+
+class LabelOptions(NamedTuple):
+    """The options of the label stage, passed to each worker along with the
+    history of the set id to process."""
+
+    download_path: str
+    parser: str = "bs4"
+    in_memory: bool = False
+    version_workers: int = 1
+    dedup_sections: bool = False
+
+
+class _Bs4LabelTree(LabelTree):
+    @staticmethod
+    def walk(root):
+        from bs4 import Tag
+
+        yield "start", root
+        stack = [(root, iter(root.children))]
+        while stack:
+            element, children = stack[-1]
+            for child in children:
+                if isinstance(child, Tag):
+                    yield "start", child
+                    stack.append((child, iter(child.children)))
+                    break
+            else:
+                stack.pop()
+                yield "end", element
+
+    @staticmethod
+    def tag(name):
+        # The lxml HTML parser lower cases the element and attribute names
+        return name.lower()
+
+    @staticmethod
+    def get_attribute(element, name):
+        return element[name.lower()]
+
+    get_name = operator.attrgetter("name")
+    get_text = operator.attrgetter("text")
+
 
 class SplHistoricalLabels:
     """
@@ -36,7 +111,7 @@ class SplHistoricalLabels:
 
     # LABEL_SECTIONS includes titles of interest and their variants
     # LABEL_SECTIONS does not include subtitles. Subtitles are identified by
-    # __get_label_text(), since they differ from label to label.
+    # extract_sections(), since they differ from label to label.
     #
     # Example of title/subtitle variants include:
     # 1. https://dailymed.nlm.nih.gov/dailymed/lookup.cfm?setid=762b51be-1893-4cd1-9511-e645fc420d3a&version=2
@@ -67,346 +142,786 @@ class SplHistoricalLabels:
         "USE",
     ]
 
-    def __init__(self, spl, download_path):
-        if not isinstance(spl, dict):
+    # Matches the section titles against LABEL_SECTIONS
+    SECTION_MATCHER = SectionTitleMatcher(LABEL_SECTIONS)
+
+    # Available label XML parsers. "bs4" builds a BeautifulSoup tree; "lxml"
+    # uses compiled XPath lookups over an lxml tree and is considerably faster.
+    PARSERS = ["bs4", "lxml"]
+
+    def __init__(
+        self,
+        spl,
+        download_path,
+        parser="bs4",
+        in_memory=False,
+        version_workers=1,
+        zip_contents=None,
+    ):
+        if not isinstance(spl, (SplHistoryRecord, dict)):
             raise ValueError(
-                "Expected spl data to a dict with the history data"
+                "Expected spl data to be a SplHistoryRecord, or a dict with "
+                "the history data"
             )
-        if download_path is None:
+        # The download path is not used when the zip files are processed in
+        # memory
+        if download_path is None and not in_memory:
             raise ValueError("Download path is not defined")
-        if not os.path.exists(download_path):
+        if parser not in SplHistoricalLabels.PARSERS:
+            raise ValueError(f"Unknown label parser: {parser}")
+        if not isinstance(version_workers, int) or version_workers < 1:
+            raise ValueError("Version workers must be a positive integer")
+        if not in_memory and not os.path.exists(download_path):
             os.mkdir(download_path)
         # Init attributes
         self.download_path = download_path
+        self.parser = parser
+        self.in_memory = in_memory
+        self.version_workers = version_workers
+        # Label zip files already downloaded, by version. When set, the labels
+        # are not downloaded again.
+        self.zip_contents = zip_contents
         try:
-            self.set_id = spl["data"]["spl"]["setid"]
-            self.spl_versions = list(
-                map(lambda x: x["spl_version"], spl["data"]["history"])
-            )
+            if isinstance(spl, dict):
+                spl = SplHistoryRecord.from_json(spl)
+            self.set_id = spl.set_id
+            self.spl_versions = list(spl.spl_versions)
         except Exception as e:
             raise ValueError(f"Bad SPL data passed to SplLabelFile: {e}")
         # Attributes to store processed data
         self.application_numbers_for_setid = set()
         self.spl_label_versions = []
+        # Whether the zip file of every version could be read
+        self.all_versions_processed = False
         # Process
         self._fetch_and_process()
 
+    @staticmethod
+    def get_url(set_id, version):
+        """Returns the URL of the label zip file for the set_id + version.
+
+        Args:
+            set_id (str): the set id used by DailyMed
+            version (int): the spl version of the label
+
+        Returns:
+            str: the URL of the label zip file
+        """
+        return (
+            f"{SplHistoricalLabels.BASE_URL}&setid={set_id}&version={version}"
+        )
+
     def _fetch_and_process(self):
         """
         Fetches the spl version label data and processes it. The parsed data is
         stored in the spl_label_versions attribute. If any version has an
         association with an NDA number, the number is added to
         application_numbers_for_setid.
+
+        Up to version_workers versions are downloaded and processed
+        concurrently; the results are still stored in version order. Once
+        every version is processed, all_versions_processed is set.
         """
-        for version in self.spl_versions:
-            url = f"{SplHistoricalLabels.BASE_URL}&setid={self.set_id}&version={version}"
-            folder_path = os.path.join(
-                self.download_path, f"{self.set_id}_{version}"
-            )
-            if not os.path.exists(folder_path):
-                os.mkdir(folder_path)
-            file_path = os.path.join(folder_path, "zipfile.zip")
+        if self.version_workers == 1:
+            # Process the versions in this thread. map is lazy, so no version
+            # is downloaded after an unusable one.
+            self.__add_versions(map(self.__fetch_version, self.spl_versions))
+            return
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.version_workers
+        ) as executor:
+            futures = [
+                executor.submit(self.__fetch_version, version)
+                for version in self.spl_versions
+            ]
+            if not self.__add_versions(x.result() for x in futures):
+                for pending in futures:
+                    pending.cancel()
+
+    def __add_versions(self, results):
+        """
+        Adds the labels of each version, in version order, stopping at the
+        first version whose zip file is unusable.
 
-            # Download and save label as zip file
-            r = requests.get(url, allow_redirects=True)
-            with open(file_path, "wb+") as f:
-                f.write(r.content)
+        Args:
+            results (iterable): the result of __fetch_version for each version
 
-            # Extract all the contents of zip file in different directory
-            try:
-                with zipfile.ZipFile(file_path, "r") as zip_obj:
-                    zip_obj.extractall(folder_path)
-            except Exception as e:
-                _logger.error(f"Unable to extract zip file {file_path}: {e}")
-                return
+        Returns:
+            bool: whether every version was processed
+        """
+        for labels in results:
+            if labels is None:
+                # Stop processing the set ID if a zip file is unusable
+                return False
+            for label in labels:
+                self.__add_label(label)
+        self.all_versions_processed = True
+        return True
 
-            # Parse the XML file and delete the other files extracted
-            for dir_name, _, files in os.walk(folder_path):
-                for file_name in files:
-                    if file_name.endswith(".xml"):
-                        self.__process_label(os.path.join(dir_name, file_name))
+    @profiling.profile_thread
+    def __fetch_version(self, version):
+        """
+        Downloads the label zip file of the given version and parses the label
+        XML files in it.
 
-            # Delete the folder (the original zip file and the extracted data)
-            shutil.rmtree(folder_path)
+        Args:
+            version (int): the spl version of the label
+
+        Returns:
+            list[LabelVersion]: the label version data parsed, or None if the
+                                zip file could not be read
+        """
+        if self.zip_contents is not None:
+            content = self.zip_contents.get(version)
+        else:
+            # Download label zip file
+            r = http_client.get(
+                SplHistoricalLabels.get_url(self.set_id, version)
+            )
+            content = r.content
+
+        if content is None:
+            # The download failed in process_historical_labels_async
+            _logger.error(
+                f"No zip file downloaded for set ID {self.set_id} version "
+                f"{version}"
+            )
+            metrics.count_error("labels", "DownloadError")
+            return None
+        if self.in_memory:
+            return self.__process_zip_in_memory(version, content)
+        return self.__process_zip_on_disk(version, content)
 
-    def __process_label(self, xml_file_name):
+    def __add_label(self, label):
         """
-        Processes the data in the given file name, extracting the required data
-        and saving them to the spl_label_versions attribute. Also checks for
-        the presence of an NDA association in the label data and appends the
-        application numbers to the application_numbers_for_setid attribute.
+        Saves the label version data to the spl_label_versions attribute, and
+        appends its application numbers to the application_numbers_for_setid
+        attribute.
 
         Args:
-            file_name (str): the full name (inclusive of the absolute path) of
-                             the label file name to process
+            label (LabelVersion): the label version data
         """
-        if not os.path.exists(xml_file_name):
-            raise ValueError(f"File not found at: {xml_file_name}")
-        try:
-            with open(xml_file_name) as f:
-                # Init BeautifulSoup object with the contents
-                bs_content = bs(f.read(), "lxml")
-                # Get Set ID
-                set_id = bs_content.document.setid["root"]
-                # Get Application Number
-                application_numbers = self.__get_application_numbers(
-                    set_id, bs_content
-                )
-                if application_numbers:
-                    # Add to NDA numbers for the set
-                    self.application_numbers_for_setid = (
-                        self.application_numbers_for_setid.union(
-                            set(application_numbers)
-                        )
-                    )
-                # Get other required properties and make label version data
-                self.spl_label_versions.append(
-                    {
-                        "application_numbers": application_numbers,
-                        "set_id": set_id,
-                        "spl_id": Path(xml_file_name).name[:-4],
-                        "spl_version": self.__get_spl_version(bs_content),
-                        "published_date": self.__get_published_date(bs_content),
-                        "name": self.__get_drug_name(set_id, bs_content),
-                        "generic_name": self.__get_generic_name(
-                            set_id, bs_content
-                        ),
-                        "active_ingredient": self.__get_active_ingredient(
-                            set_id, bs_content
-                        ),
-                        "sections": self.__get_label_text(set_id, bs_content),
-                    }
+        if label.application_numbers:
+            # Add to NDA numbers for the set
+            self.application_numbers_for_setid = (
+                self.application_numbers_for_setid.union(
+                    label.application_numbers
                 )
-        except Exception as e:
-            _logger.error(f"Unable to parse XML data from file: {e}")
+            )
+        self.spl_label_versions.append(label)
 
-    def __get_spl_version(self, label_data):
-        return label_data.document.versionnumber["value"]
+    def __process_zip_in_memory(self, version, content):
+        """
+        Parses the XML files in the zip file content, reading them straight
+        from the archive. Nothing is written to disk and the other files in
+        the archive (e.g. product images) are never extracted.
 
-    def __get_published_date(self, label_data):
-        date = label_data.document.effectivetime["value"]
-        return f"{date[:4]}-{date[4:6]}-{date[-2:]}"
+        Args:
+            version (int): the spl version of the label
+            content (bytes): the contents of the downloaded zip file
 
-    def __get_application_numbers(self, set_id, bs_content):
-        application_numbers = set()
+        Returns:
+            list[LabelVersion]: the label version data parsed, or None if the
+                                zip file could not be read
+        """
         try:
-            components = bs_content.document.component.structuredbody.component
-            for item in components.find_all("approval"):
-                if hasattr(item, "code") and item.code["displayname"] == "NDA":
-                    # Capture the corresponding NDA number, without the "NDA" prefix and
-                    # without leading zeros
-                    appln_num = (
-                        item.id["extension"][3:]
-                        if item.id["extension"].startswith("NDA")
-                        else item.id["extension"]
-                    )
-                    application_numbers.add(str(int(appln_num)))
+            xml_files = read_label_zip(content)
         except Exception as e:
             _logger.error(
-                f"Error in __get_application_numbers for set ID {set_id}: {e}"
+                f"Unable to read zip file for set ID {self.set_id} version "
+                f"{version}: {e}"
             )
-        return list(application_numbers)
+            metrics.count_error("labels", e)
+            return None
+        labels = [
+            self.__process_label(io.BytesIO(xml), spl_id)
+            for spl_id, xml in xml_files
+        ]
+        return [x for x in labels if x is not None]
+
+    def __process_zip_on_disk(self, version, content):
+        """
+        Saves the zip file content to the download path, extracts it and
+        parses the extracted XML files. The extracted data is deleted
+        afterwards.
 
-    def __get_drug_name(self, set_id, bs_content):
-        drug_name = ""
-        try:
-            product = (
-                bs_content.document.component.structuredbody.component.find(
-                    "manufacturedproduct"
-                )
-            )
-            if product.find("manufacturedproduct"):
-                product = product.manufacturedproduct
-            else:
-                # Legacy format
-                product = product.manufacturedmedicine
-            drug_name = product.find("name").text.replace("\n", "")
-        except Exception as e:
-            _logger.error(f"Error in __get_drug_name for set ID {set_id}: {e}")
-        return drug_name
+        Args:
+            version (int): the spl version of the label
+            content (bytes): the contents of the downloaded zip file
 
-    def __get_generic_name(self, set_id, bs_content):
-        generic_name = ""
+        Returns:
+            list[LabelVersion]: the label version data parsed, or None if the
+                                zip file could not be extracted
+        """
+        folder_path = os.path.join(
+            self.download_path, f"{self.set_id}_{version}"
+        )
+        if not os.path.exists(folder_path):
+            os.mkdir(folder_path)
+        file_path = os.path.join(folder_path, "zipfile.zip")
+
+        # Save label as zip file
+        with open(file_path, "wb+") as f:
+            f.write(content)
+
+        # Extract all the contents of zip file in different directory
         try:
-            generic_name = (
-                bs_content.document.component.structuredbody.component.find(
-                    "manufacturedproduct"
-                )
-                .asentitywithgeneric.genericmedicine.find("name")
-                .text.replace("\n", "")
-            )
+            with metrics.timer("unzip_seconds"):
+                with zipfile.ZipFile(file_path, "r") as zip_obj:
+                    zip_obj.extractall(folder_path)
         except Exception as e:
-            _logger.error(
-                f"Error in __get_generic_name for set ID {set_id}: {e}"
-            )
-        return generic_name
+            _logger.error(f"Unable to extract zip file {file_path}: {e}")
+            metrics.count_error("labels", e)
+            return None
 
-    def __get_active_ingredient(self, set_id, bs_content):
-        active_ingredient = ""
-        try:
-            active_ingredient = (
-                bs_content.document.component.structuredbody.component.find(
-                    "manufacturedproduct"
-                )
-                .find("activemoiety")
-                .find("name")
-                .text.replace("\n", "")
-            )
-        except Exception as e:
-            _logger.error(
-                f"Error in __get_active_ingredient for set ID {set_id}: {e}"
-            )
-        return active_ingredient
-
-    def __get_label_text(self, set_id, bs_content):
-        def get_xml_text(text):
-            # Process the label text; normalize remove nbsp
-            text = unicodedata.normalize("NFKC", text.lstrip().rstrip())
-            text = re.sub(r"\n\s*\n", "\n", text)
-            return text
-
-        def get_xml_title(text):
-            # strip extra \n, \t, and spaces in titles, but keep number
-            text = get_xml_text(text)
-            text = re.sub(r"\.\s+", ".", text)
-            text = re.sub(r"\s+", " ", text)
-            return text
-
-        # Get and process all "title" tags
-        titles = bs_content.find_all("title")
+        # Parse the XML file and delete the other files extracted
         labels = []
-
-        for title in titles:
-            # For matching:
-            # - Convert title text to upper case
-            # - Replace & with AND, tab with space
-            # - Clean up Unicode characters, digits, punctuation
-            title_match_text = cleantext.clean(
-                title.text.upper().replace("&", "AND").replace("\t", " "),
-                lower=False,
-                no_line_breaks=True,
-                no_punct=True,
-                no_numbers=True,
-                no_digits=True,
-                replace_with_number="",
-                replace_with_digit="",
-            )
-
-            # Exact match against label section titles
-            if title_match_text in SplHistoricalLabels.LABEL_SECTIONS:
-                title_name, title_text = get_xml_title(
-                    title.text
-                ), get_xml_text(
-                    title.parent.find("text").text,
-                )
-                # Get sub-sections of the label
-                subtitles = title.parent.find_all("title")
-                sub_section_labels = []
-
-                # The first match is the title itself, so check len > 1
-                if len(subtitles) > 1:
-                    # Make sub-section labels list
-                    sub_section_labels = list(
-                        map(
-                            lambda x: {
-                                "name": get_xml_title(x.text),
-                                "text": get_xml_text(
-                                    x.parent.find("text").text,
-                                ),
-                                "parent": title_name,
-                            },
-                            subtitles[1:],
+        for dir_name, _, files in os.walk(folder_path):
+            for file_name in files:
+                if file_name.endswith(".xml"):
+                    labels.append(
+                        self.__process_label(
+                            os.path.join(dir_name, file_name), file_name[:-4]
                         )
                     )
-                    # Replace title text with sibling text if there are sub-sections
-                    title_text = (
-                        title.find_next_sibling("text").text
-                        if title.find_next_sibling("text")
-                        else ""
-                    )
 
-                # Add the section info and sub-sections to the labels list
-                labels.extend(
-                    [
-                        {
-                            "name": title_name,
-                            "text": title_text,
-                            "parent": None,
-                        }
-                    ]
-                    + sub_section_labels
-                )
+        # Delete the folder (the original zip file and the extracted data)
+        shutil.rmtree(folder_path)
+        return [x for x in labels if x is not None]
+
+    def __process_label(self, xml_file, spl_id):
+        """
+        Processes the data in the given label XML file, extracting the required
+        data.
+
+        Args:
+            xml_file (str or file): the full name (inclusive of the absolute
+                                    path) of the label file to process, or a
+                                    binary file object to read it from
+            spl_id (str): the SPL ID of the label, i.e. the name of the label
+                          file without its extension
+
+        Returns:
+            LabelVersion: the label version data, or None if it could not be
+                          parsed
+        """
+        return process_label(xml_file, self.parser, spl_id)
+
+    def _parse_label(self, xml_file, spl_id=None):
+        """
+        Parses the label XML file with the configured parser.
 
-        # If there are sub-sections without titles, collapse them into the
-        # previous sub-section
-        corrected_labels = []
-        for item in labels:
-            if item["name"]:
-                corrected_labels.append(item)
-            elif corrected_labels and item["text"]:
-                # Append label text to the last item in the corrected list
-                corrected_labels[-1]["text"] += "\n" + item["text"]
+        Args:
+            xml_file (str or file): the full name (inclusive of the absolute
+                                    path) of the label file to parse, or a
+                                    binary file object to read it from
+            spl_id (str, optional): the SPL ID of the label. Defaults to the
+                                    name of the label file without its
+                                    extension.
+
+        Returns:
+            LabelVersion: the label version data
+        """
+        return parse_label(xml_file, self.parser, spl_id)
+
+
+def read_label_zip(content):
+    """
+    Reads the XML files in the label zip file content, straight from the
+    archive. Nothing is written to disk and the other files in the archive
+    (e.g. product images) are never extracted.
 
-        return corrected_labels
+    Args:
+        content (bytes): the contents of the label zip file
 
+    Raises:
+        zipfile.BadZipFile: When the content is not a zip file
 
-def process_labels_for_set_id(set_id_history):
+    Returns:
+        list[tuple]: the SPL ID (the name of the XML file without its
+                     extension) and the contents of each XML file
+    """
+    # Decompress the XML files up front, so that the unzip time is measured
+    # apart from the parse time
+    with metrics.timer("unzip_seconds"):
+        with zipfile.ZipFile(io.BytesIO(content), "r") as zip_obj:
+            return [
+                (Path(name).name[:-4], zip_obj.read(name))
+                for name in zip_obj.namelist()
+                if name.endswith(".xml")
+            ]
+
+
+def parse_label(xml_file, parser="bs4", spl_id=None):
+    """
+    Parses the label XML file with the given parser.
+
+    Args:
+        xml_file (str or file): the full name (inclusive of the absolute
+                                path) of the label file to parse, or a
+                                binary file object to read it from
+        parser (str, optional): The label XML parser to use, one of
+                                SplHistoricalLabels.PARSERS. Defaults to "bs4".
+        spl_id (str, optional): the SPL ID of the label. Defaults to the name
+                                of the label file without its extension.
+
+    Returns:
+        LabelVersion: the label version data
+    """
+    if spl_id is None:
+        spl_id = Path(xml_file).name[:-4]
+    if parser == "lxml":
+        return parse_label_xml(
+            xml_file, SplHistoricalLabels.SECTION_MATCHER, spl_id
+        )
+    if isinstance(xml_file, str):
+        with open(xml_file) as f:
+            content = f.read()
+    else:
+        content = xml_file.read()
+    # Init BeautifulSoup object with the contents. bs4 is only imported by
+    # this parser, as the lxml parser does not need it.
+    from bs4 import BeautifulSoup as bs
+
+    bs_content = bs(content, "lxml")
+    return extract_label(
+        LabelIndex(bs_content, _Bs4LabelTree),
+        SplHistoricalLabels.SECTION_MATCHER,
+        spl_id,
+    )
+
+
+def process_label(xml_file, parser="bs4", spl_id=None):
+    """
+    Parses the label XML file like parse_label, logging and counting the
+    errors instead of raising them.
+
+    Returns:
+        LabelVersion: the label version data, or None if it could not be
+                      parsed
+    """
+    try:
+        with metrics.timer("parse_seconds", stage="labels", parser=parser):
+            label = parse_label(xml_file, parser, spl_id)
+    except Exception as e:
+        _logger.error(f"Unable to parse XML data from file: {e}")
+        metrics.count_error("labels", e)
+        return None
+    metrics.inc("items_total", stage="labels")
+    return label
+
+
+def _set_application_numbers(spl_label_versions, application_numbers):
+    """
+    Sets the application numbers of a set id on each of its label versions.
+    Only the labels of set ids with application numbers are stored.
+
+    Args:
+        spl_label_versions (list[LabelVersion]): the label versions of the
+                                                 set id
+        application_numbers (set[str]): the application numbers of all the
+                                        versions of the set id
+
+    Returns:
+        list[LabelVersion]: the label versions with the application numbers
+                            of the set id, or an empty list if it has none
+    """
+    if not application_numbers:
+        return []
+    # Reset individual application numbers for SPL version with all
+    # application numbers for the set id
+    application_numbers = tuple(application_numbers)
+    return [
+        x._replace(application_numbers=application_numbers)
+        for x in spl_label_versions
+    ]
+
+
+@metrics.flush_after
+@profiling.profile_worker
+def process_labels_for_set_id(set_id_history, options, zip_contents=None):
+    """
+    Processes the labels of every version of the set id in the history, and
+    stores them in MongoDB if any version has an NDA number.
+
+    Args:
+        set_id_history (SplHistoryRecord): the history of the set id
+        options (LabelOptions): the options of the label stage
+        zip_contents (dict, optional): the label zip files of the versions,
+                                       if already downloaded
+
+    Returns:
+        bool: whether every version of the set id was processed. It is False
+              when the zip file of a version could not be downloaded or read,
+              in which case the set id should be processed again.
+    """
     labels = SplHistoricalLabels(
-        spl=set_id_history, download_path=set_id_history["download_path"]
+        spl=set_id_history,
+        download_path=options.download_path,
+        parser=options.parser,
+        in_memory=options.in_memory,
+        version_workers=options.version_workers,
+        zip_contents=zip_contents,
     )
-    if labels.application_numbers_for_setid:
-        # Upsert to MongoDB
-        for label in labels.spl_label_versions:
-            # Reset individual application numbers for SPL version with all
-            # application numbers for the set id
-            label["application_numbers"] = list(
-                labels.application_numbers_for_setid
-            )
-            # Merge with existing data
-            existing = _mongo_client.find(
+    # In incremental mode, the versions already stored are not processed
+    # again, but their application numbers still count towards the set id
+    stored_application_numbers = set(set_id_history.stored_application_numbers)
+    application_numbers_for_setid = (
+        labels.application_numbers_for_setid | stored_application_numbers
+    )
+    spl_label_versions = _set_application_numbers(
+        labels.spl_label_versions, application_numbers_for_setid
+    )
+    if spl_label_versions:
+        # Upsert to MongoDB, merging with the existing data
+        _store_labels(spl_label_versions, options.dedup_sections)
+        if stored_application_numbers and not (
+            labels.application_numbers_for_setid <= stored_application_numbers
+        ):
+            # A new version added application numbers; apply them to the
+            # versions stored before
+            _get_mongo_client().update_many(
                 MONGO_COLLECTION_NAME,
-                {"spl_id": label["spl_id"], "set_id": label["set_id"]},
+                {"set_id": labels.set_id},
+                {
+                    "$set": {
+                        "application_numbers": list(
+                            application_numbers_for_setid
+                        )
+                    }
+                },
             )
-            if existing.count():
-                label = {**existing[0], **label}
-            _mongo_client.upsert(
-                MONGO_COLLECTION_NAME,
-                {"spl_id": label["spl_id"], "set_id": label["set_id"]},
-                label,
+    return labels.all_versions_processed
+
+
+def _get_mongo_client():
+    # The client is created on first use in each process, as pymongo clients
+    # must not be shared with forked worker processes
+    return _mongo_client if _mongo_client is not None else get_client()
+
+
+def _store_labels(spl_label_versions, dedup_sections=False):
+    mongo_client = _get_mongo_client()
+    spl_label_versions = [x.to_document() for x in spl_label_versions]
+    if dedup_sections:
+        # Store each section text once, and reference it from the labels
+        spl_label_versions = store_sections(mongo_client, spl_label_versions)
+    mongo_client.bulk_upsert(
+        MONGO_COLLECTION_NAME, MONGO_KEY_FIELDS, spl_label_versions
+    )
+
+
+def find_labels(query, projection=None):
+    """
+    Finds the labels stored in MongoDB, with the text of their sections,
+    whether they were stored with deduplicated sections or not.
+
+    Args:
+        query (dict or list[dict]): the query, as taken by MongoClient.find
+        projection (dict, optional): the fields to return
+
+    Returns:
+        Iterator[dict]: the labels found
+    """
+    mongo_client = _get_mongo_client()
+    batch = []
+    for label in mongo_client.find(MONGO_COLLECTION_NAME, query, projection):
+        batch.append(label)
+        if len(batch) == FIND_LABELS_BATCH_SIZE:
+            yield from load_sections(mongo_client, batch)
+            batch = []
+    yield from load_sections(mongo_client, batch)
+
+
+def _create_indexes():
+    try:
+        _get_mongo_client().create_indexes(MONGO_COLLECTION_NAME, MONGO_INDEXES)
+    except Exception as e:
+        _logger.error(
+            f"Unable to create the {MONGO_COLLECTION_NAME} indexes: {e}"
+        )
+
+
+def _get_stored_versions(set_ids):
+    """
+    Looks up the label versions already stored in MongoDB for the set ids,
+    with one query per STORED_VERSIONS_QUERY_SIZE set ids.
+
+    Args:
+        set_ids (list[str]): the set ids to look up
+
+    Returns:
+        dict: the stored spl versions (as str) and the application numbers
+              of each set id that has any stored label
+    """
+    stored = {}
+    for i in range(0, len(set_ids), STORED_VERSIONS_QUERY_SIZE):
+        for doc in _get_mongo_client().find(
+            MONGO_COLLECTION_NAME,
+            {"set_id": {"$in": set_ids[i : i + STORED_VERSIONS_QUERY_SIZE]}},
+            projection={
+                "_id": False,
+                "set_id": True,
+                "spl_version": True,
+                "application_numbers": True,
+            },
+        ):
+            entry = stored.setdefault(
+                doc["set_id"],
+                {"versions": set(), "application_numbers": set()},
             )
-        return True
-    return False
+            entry["versions"].add(str(doc["spl_version"]))
+            entry["application_numbers"].update(
+                doc.get("application_numbers", [])
+            )
+    return stored
+
+
+def _exclude_stored_versions(all_setid_history):
+    """
+    Removes the label versions already stored in MongoDB from the set id
+    history, for the incremental mode. Set ids with no new versions are
+    dropped altogether.
+
+    Args:
+        all_setid_history (list[SplHistoryRecord]): the history of each set
+                                                    id
+
+    Returns:
+        list[SplHistoryRecord]: the history records with only the versions to
+                                process, along with the application numbers
+                                of the stored versions
+    """
+    stored = _get_stored_versions([x.set_id for x in all_setid_history])
+    remaining = []
+    skipped_versions = 0
+    for set_id_history in all_setid_history:
+        set_id = set_id_history.set_id
+        if set_id not in stored:
+            remaining.append(set_id_history)
+            continue
+        stored_versions = stored[set_id]["versions"]
+        history = set_id_history.select_versions(
+            lambda x: str(x) not in stored_versions
+        )
+        skipped_versions += len(set_id_history.spl_versions) - len(
+            history.spl_versions
+        )
+        if not history.spl_versions:
+            continue
+        remaining.append(
+            history._replace(
+                stored_application_numbers=tuple(
+                    stored[set_id]["application_numbers"]
+                )
+            )
+        )
+    _logger.info(
+        f"Skipping {skipped_versions} label versions already stored, "
+        f"{len(all_setid_history) - len(remaining)} set IDs up to date"
+    )
+    return remaining
+
 
+def _exclude_journaled_set_ids(journal, all_setid_history):
+    """
+    Removes the set ids whose labels were already processed, according to
+    the journal, from the set id history.
+
+    Args:
+        journal (ProgressJournal): the journal of the run, or None
+        all_setid_history (list[SplHistoryRecord]): the history of each set
+                                                    id
 
-def process_historical_labels(all_setid_history, download_path):
+    Returns:
+        list[SplHistoryRecord]: the history records of the set ids to process
+    """
+    if journal is None:
+        return all_setid_history
+    completed = journal.get_completed(LABELS_STAGE)
+    remaining = [x for x in all_setid_history if x.set_id not in completed]
+    if len(remaining) < len(all_setid_history):
+        _logger.info(
+            f"Skipping {len(all_setid_history) - len(remaining)} set IDs with "
+            "labels already processed"
+        )
+    return remaining
+
+
+def _get_version_count(set_id_history):
+    # The expected cost of processing the labels of a set id
+    return len(set_id_history.spl_versions)
+
+
+def _record_labels(journal, set_id, all_versions_processed=True):
+    # A set id with a version that could not be processed is not recorded,
+    # so that it is processed again when resuming
+    if journal is not None and all_versions_processed:
+        journal.record(LABELS_STAGE, set_id)
+
+
+def process_historical_labels(
+    all_setid_history,
+    download_path,
+    parser="bs4",
+    in_memory=False,
+    version_workers=1,
+    incremental=False,
+    dedup_sections=False,
+    journal=None,
+):
     """
     Fetches the detailed label text for all spl versions of the set_id.
     If any version of a given set_id has an association with one or more
     NDA numbers, the data will be processed further and saved to MongoDB.
 
     Args:
-        all_setid_history (list[dict]): A list of history records for a set_id
-                                        as created by the SplHistoryResponse
-                                        object, after processing.
+        all_setid_history (list[SplHistoryRecord]): the history of each set
+                                                    id, as returned by
+                                                    process_spl_history
         download_path (str): Temporary folder to store the label data
+        parser (str, optional): The label XML parser to use, one of
+                                SplHistoricalLabels.PARSERS. Defaults to "bs4".
+        in_memory (bool, optional): Whether to read the label zip files in
+                                    memory, instead of extracting them to
+                                    download_path. Defaults to False.
+        version_workers (int, optional): The number of versions of a set_id to
+                                         download concurrently. Defaults to 1.
+        incremental (bool, optional): Whether to skip the versions already
+                                      stored in MongoDB. Defaults to False.
+        dedup_sections (bool, optional): Whether to store each section text
+                                         once, in the label_sections
+                                         collection, and reference it from
+                                         the labels. Defaults to False.
+        journal (ProgressJournal, optional): records the set ids processed.
+                                             The set ids it already holds
+                                             are skipped. Defaults to None.
     """
     # If the download_path does not exist yet, create it.
-    if not os.path.exists(download_path):
+    if not in_memory and not os.path.exists(download_path):
         os.mkdir(download_path)
 
-    # Associate download_path with the set_id_history before the parallel
-    # processing, as it cannot be passed as a second argument easily.
-    for obj in all_setid_history:
-        obj["download_path"] = download_path
+    _create_indexes()
+    all_setid_history = _exclude_journaled_set_ids(journal, all_setid_history)
+    if incremental:
+        all_setid_history = _exclude_stored_versions(all_setid_history)
+
+    options = LabelOptions(
+        download_path=download_path,
+        parser=parser,
+        in_memory=in_memory,
+        version_workers=version_workers,
+        dedup_sections=dedup_sections,
+    )
 
-    # Process each set_id's historical label data in parallel
-    with concurrent.futures.ProcessPoolExecutor() as executor:
-        for set_id_history, _ in zip(
+    # Process each set_id's historical label data in parallel, the set_ids
+    # with the most versions first
+    with process_pool() as executor:
+        for set_id_history, all_versions_processed in map_longest_first(
+            executor,
+            functools.partial(process_labels_for_set_id, options=options),
             all_setid_history,
-            executor.map(
-                process_labels_for_set_id,
-                all_setid_history,
-            ),
+            _get_version_count,
         ):
-            set_id = set_id_history["data"]["spl"]["setid"]
-            _logger.info(f"Processed labels for set ID {set_id}")
+            _logger.info(f"Processed labels for set ID {set_id_history.set_id}")
+            _record_labels(
+                journal, set_id_history.set_id, all_versions_processed
+            )
+
+
+def process_historical_labels_async(
+    all_setid_history,
+    download_path,
+    parser="bs4",
+    in_memory=False,
+    max_concurrency=100,
+    incremental=False,
+    dedup_sections=False,
+    journal=None,
+):
+    """
+    Fetches the detailed label text for all spl versions of the set_id, like
+    process_historical_labels. The label zip files are downloaded with asyncio
+    from a single process, with at most max_concurrency requests in flight,
+    and each set_id is processed in a pool of processes once all of its
+    versions are downloaded.
+
+    Args:
+        all_setid_history (list[SplHistoryRecord]): the history of each set
+                                                    id, as returned by
+                                                    process_spl_history
+        download_path (str): Temporary folder to store the label data
+        parser (str, optional): The label XML parser to use, one of
+                                SplHistoricalLabels.PARSERS. Defaults to "bs4".
+        in_memory (bool, optional): Whether to read the label zip files in
+                                    memory, instead of extracting them to
+                                    download_path. Defaults to False.
+        max_concurrency (int, optional): The maximum number of requests in
+                                         flight. Defaults to 100.
+        incremental (bool, optional): Whether to skip the versions already
+                                      stored in MongoDB. Defaults to False.
+        dedup_sections (bool, optional): Whether to store each section text
+                                         once, in the label_sections
+                                         collection, and reference it from
+                                         the labels. Defaults to False.
+        journal (ProgressJournal, optional): records the set ids processed.
+                                             The set ids it already holds
+                                             are skipped. Defaults to None.
+    """
+    # If the download_path does not exist yet, create it.
+    if not in_memory and not os.path.exists(download_path):
+        os.mkdir(download_path)
+
+    _create_indexes()
+    all_setid_history = _exclude_journaled_set_ids(journal, all_setid_history)
+    if incremental:
+        all_setid_history = _exclude_stored_versions(all_setid_history)
+
+    options = LabelOptions(
+        download_path=download_path,
+        parser=parser,
+        in_memory=in_memory,
+        dedup_sections=dedup_sections,
+    )
+
+    # Start with the set_ids with the most versions, which take the longest
+    asyncio.run(
+        _process_historical_labels_async(
+            order_longest_first(all_setid_history, _get_version_count),
+            options,
+            max_concurrency,
+            journal,
+        )
+    )
+
+
+async def _process_historical_labels_async(
+    all_setid_history, options, max_concurrency, journal
+):
+    loop = asyncio.get_running_loop()
+    # Bound the number of set IDs whose zip files are held in memory
+    set_id_slots = asyncio.Semaphore(max_concurrency)
+    async with AsyncFetcher(max_concurrency=max_concurrency) as fetcher:
+        with process_pool() as executor:
+
+            async def fetch_and_process(set_id_history):
+                set_id = set_id_history.set_id
+                versions = set_id_history.spl_versions
+                async with set_id_slots:
+                    contents = await fetcher.fetch_all(
+                        [
+                            SplHistoricalLabels.get_url(set_id, version)
+                            for version in versions
+                        ]
+                    )
+                    all_versions_processed = await loop.run_in_executor(
+                        executor,
+                        process_labels_for_set_id,
+                        set_id_history,
+                        options,
+                        dict(zip(versions, contents)),
+                    )
+                _logger.info(f"Processed labels for set ID {set_id}")
+                _record_labels(journal, set_id, all_versions_processed)
+
+            await asyncio.gather(*map(fetch_and_process, all_setid_history))
@@ -0,0 +1,316 @@
+"""
+Streaming pipeline running the index, history and label stages at once.
+
+Set IDs found on each index page go straight into history fetching, and each
+history fetched goes straight into label processing, instead of each stage
+waiting for the previous one to finish over the whole run. The stages are
+connected by bounded queues: when a stage falls behind, the stages before it
+block on putting more work into its queue, so the data held in memory stays
+the same no matter how many pages are processed.
+
+Each stage has its own pool of processes, fed by as many threads in the main
+process, so up to `workers` items are in flight per stage.
+"""
+
+import functools
+import os
+import queue
+import threading
+
+from spl.history import _record_history, get_spl
+from spl.index import (
+    SplIndexFile,
+    _get_end_page,
+    _record_page,
+    _split_journaled_pages,
+    _validate_page_range,
+    get_spls,
+)
+from spl.labels import (
+    LabelOptions,
+    _create_indexes,
+    _exclude_stored_versions,
+    _record_labels,
+    process_labels_for_set_id,
+)
+from spl.records import SplHistoryRecord
+from utils import metrics
+from utils.journal import HISTORY_STAGE, LABELS_STAGE
+from utils.logging import getLogger
+from utils.scheduling import process_pool
+
+_logger = getLogger(__name__)
+
+# Marks the end of the items put into a stage queue
+_DONE = object()
+
+# In incremental mode, the number of set id histories whose stored versions
+# are looked up at once, before they are queued for the label stage
+INCREMENTAL_BATCH_SIZE = 100
+
+
+class _Stage:
+    """
+    Runs fn over the items put into the stage queue, in a pool of processes,
+    passing each result to handle_result in the main process.
+    """
+
+    def __init__(self, name, fn, workers, queue_size, handle_result, on_done):
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.handle_result = handle_result
+        self.on_done = on_done
+        self._remaining = workers
+        self._lock = threading.Lock()
+        self._executor = process_pool(workers)
+        # Fork the worker processes now, before the threads of any stage are
+        # started, as forking a multi-threaded process is unsafe. This does
+        # not rule it out: the manager threads of the pools created earlier
+        # are running, and a worker replacing one that died, or spawned on
+        # demand by the Python versions that start workers lazily, is forked
+        # while the stage threads run.
+        self._executor.submit(int).result()
+        self._threads = [
+            threading.Thread(target=self.__run, name=f"{name}-{i}")
+            for i in range(workers)
+        ]
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+
+    def join(self):
+        for thread in self._threads:
+            thread.join()
+        self._executor.shutdown()
+
+    def __run(self):
+        while True:
+            item = self.queue.get()
+            if item is _DONE:
+                # Let the other threads of the stage stop too
+                self.queue.put(_DONE)
+                break
+            try:
+                result = self._executor.submit(self.fn, item).result()
+                self.handle_result(item, result)
+            except Exception as e:
+                _logger.error(f"Error in {self.name} stage for {item}: {e}")
+                metrics.count_error(self.name, e)
+        with self._lock:
+            self._remaining -= 1
+            last = self._remaining == 0
+        if last:
+            self.on_done()
+
+
+def run_pipeline(
+    download_path,
+    start_page=None,
+    num_pages=None,
+    set_ids=None,
+    parser="bs4",
+    in_memory=False,
+    version_workers=1,
+    incremental=False,
+    dedup_sections=False,
+    workers=None,
+    queue_size=100,
+    journal=None,
+):
+    """
+    Processes the labels of the set ids in the applicable range of index
+    pages, or of the given set ids, streaming the data from one stage to the
+    next.
+
+    Args:
+        download_path (str): Temporary folder to store the label data
+        start_page (int, optional): the page number from which to start
+                                    downloading the SPL index
+        num_pages (int, optional): the number of pages of the index data to
+                                   download. If left unset, it will download
+                                   all pages available from the starting page
+                                   number. Defaults to None.
+        set_ids (list[str], optional): the set ids to process, instead of the
+                                       set ids in the index
+        parser (str, optional): The label XML parser to use, one of
+                                SplHistoricalLabels.PARSERS. Defaults to "bs4".
+        in_memory (bool, optional): Whether to read the label zip files in
+                                    memory. Defaults to False.
+        version_workers (int, optional): The number of versions of a set_id to
+                                         download concurrently. Defaults to 1.
+        incremental (bool, optional): Whether to skip the versions already
+                                      stored in MongoDB. Defaults to False.
+        dedup_sections (bool, optional): Whether to store each section text
+                                         once, in the label_sections
+                                         collection, and reference it from
+                                         the labels. Defaults to False.
+        workers (int, optional): the number of items in flight per stage.
+                                 Defaults to the number of CPUs.
+        queue_size (int, optional): the number of items each stage queue
+                                    holds. Defaults to 100.
+        journal (ProgressJournal, optional): records the index pages, set id
+                                             histories and set ids processed.
+                                             The work it already holds is
+                                             not done again. Defaults to None.
+
+    Raises:
+        ValueError: When neither set_ids nor a valid page range is given
+
+    Returns:
+        int: the last spl index page number processed, or None if the set ids
+             were given or there was nothing to process
+    """
+    if set_ids is None:
+        _validate_page_range(start_page, num_pages)
+    if workers is None:
+        workers = os.cpu_count()
+    if not isinstance(workers, int) or workers < 1:
+        raise ValueError("Workers must be a positive integer")
+    if not isinstance(queue_size, int) or queue_size < 1:
+        raise ValueError("Queue size must be a positive integer")
+
+    # If the download_path does not exist yet, create it.
+    if not in_memory and not os.path.exists(download_path):
+        os.mkdir(download_path)
+    _create_indexes()
+
+    end_page = None
+    if set_ids is None:
+        # Get max page number available
+        first_spl_index_file = SplIndexFile(page_number=1)
+        end_page = _get_end_page(
+            start_page,
+            num_pages,
+            first_spl_index_file.get_max_page_number(),
+        )
+        if end_page is None:
+            # Nothing to process
+            return None
+
+    def handle_labels(set_id_history, all_versions_processed):
+        _logger.info(f"Processed labels for set ID {set_id_history.set_id}")
+        _record_labels(journal, set_id_history.set_id, all_versions_processed)
+
+    options = LabelOptions(
+        download_path=download_path,
+        parser=parser,
+        in_memory=in_memory,
+        version_workers=version_workers,
+        dedup_sections=dedup_sections,
+    )
+    labels_stage = _Stage(
+        "labels",
+        functools.partial(process_labels_for_set_id, options=options),
+        workers,
+        queue_size,
+        handle_labels,
+        on_done=lambda: None,
+    )
+
+    def handle_history(set_id, set_id_history):
+        _logger.info(f"Processed history for set ID {set_id}")
+        _record_history(journal, set_id, set_id_history)
+        queue_labels(set_id_history)
+
+    # In incremental mode, the histories wait here until a batch of them
+    # can be checked against the stored versions with a single query
+    pending_histories = []
+    pending_lock = threading.Lock()
+
+    def queue_labels(set_id_history):
+        if not incremental:
+            labels_stage.queue.put(set_id_history)
+            return
+        with pending_lock:
+            pending_histories.append(set_id_history)
+            if len(pending_histories) < INCREMENTAL_BATCH_SIZE:
+                return
+            batch = pending_histories[:]
+            pending_histories.clear()
+        for x in _exclude_stored_versions(batch):
+            labels_stage.queue.put(x)
+
+    def finish_labels():
+        with pending_lock:
+            batch = pending_histories[:]
+            pending_histories.clear()
+        if batch:
+            for x in _exclude_stored_versions(batch):
+                labels_stage.queue.put(x)
+        labels_stage.queue.put(_DONE)
+
+    history_stage = _Stage(
+        "history",
+        get_spl,
+        workers,
+        queue_size,
+        handle_history,
+        on_done=finish_labels,
+    )
+
+    # Set IDs already passed on, as the index can list a set ID more than
+    # once. When resuming, the set IDs with labels processed are skipped.
+    seen_set_ids = set()
+    seen_lock = threading.Lock()
+    journaled_histories = set()
+    if journal is not None:
+        seen_set_ids = journal.get_completed(LABELS_STAGE)
+        journaled_histories = journal.get_completed(HISTORY_STAGE)
+
+    def queue_history(set_id):
+        with seen_lock:
+            if set_id in seen_set_ids:
+                return
+            seen_set_ids.add(set_id)
+        if set_id in journaled_histories:
+            queue_labels(
+                SplHistoryRecord.from_json(journal.get(HISTORY_STAGE, set_id))
+            )
+        else:
+            history_stage.queue.put(set_id)
+
+    def handle_index_page(page_num, spls):
+        _logger.info(f"Processed index page {page_num}")
+        _record_page(journal, page_num, spls)
+        for spl in spls:
+            queue_history(spl.setid)
+
+    stages = [history_stage, labels_stage]
+    if set_ids is None:
+        index_stage = _Stage(
+            "index",
+            get_spls,
+            workers,
+            queue_size,
+            handle_index_page,
+            on_done=lambda: history_stage.queue.put(_DONE),
+        )
+        stages.insert(0, index_stage)
+    for stage in stages:
+        stage.start()
+
+    if set_ids is None:
+        if start_page == 1:
+            # Reuse the first page rather than downloading it again
+            handle_index_page(1, first_spl_index_file.spls)
+            start_page = 2
+        journaled_spls, page_nums = _split_journaled_pages(
+            journal, range(start_page, end_page + 1)
+        )
+        for spl in journaled_spls:
+            queue_history(spl.setid)
+        for page_num in page_nums:
+            index_stage.queue.put(page_num)
+        index_stage.queue.put(_DONE)
+    else:
+        # Skip the index stage
+        for set_id in set_ids:
+            queue_history(set_id)
+        history_stage.queue.put(_DONE)
+
+    for stage in stages:
+        stage.join()
+    return end_page
@@ -0,0 +1,165 @@
+"""
+Record types of the data passed between the stages: the spls of the index,
+the history of each set id and the label versions.
+
+The records are NamedTuples, which hold their fields in slots rather than in
+a dict per instance, so they take less memory than the JSON dicts they are
+made from, and are pickled smaller when passed to and from the worker
+processes. They are converted from and to dicts only at the edges of the
+pipeline: the JSON responses of DailyMed, the intermediate data files and
+journal, and the documents stored in MongoDB.
+
+Each NamedTuple costs a call to its __new__ when unpickled, so a record
+holding many records is slower to pickle than the dicts. The history, passed
+between processes for every set id, holds its versions as tuples of plain
+values instead. See benchmarks/bench_records.py.
+"""
+
+from typing import NamedTuple
+
+
+class SplIndexRecord(NamedTuple):
+    """An spl listed in the SPL index."""
+
+    setid: str
+    spl_version: str
+    published_date: str
+    title: str
+
+
+class SplHistoryRecord(NamedTuple):
+    """
+    The history of a set id: the versions of its label. The versions are held
+    as a tuple of version numbers and a tuple of publication dates, rather
+    than as a record per version, as tuples of ints and strs are pickled
+    several times faster than tuples of records.
+    """
+
+    set_id: str
+    title: str
+    spl_versions: tuple
+    published_dates: tuple
+    # The application numbers of the versions already stored, when only the
+    # versions not stored yet are processed
+    stored_application_numbers: tuple = ()
+
+    @classmethod
+    def from_json(cls, data):
+        """
+        Creates the record from the history JSON data of DailyMed, or from the
+        JSON data returned by to_json.
+
+        Args:
+            data (dict): the history JSON data
+
+        Raises:
+            KeyError: When the data is missing the set id or the versions
+
+        Returns:
+            SplHistoryRecord: the history of the set id
+        """
+        if "data" in data:
+            # As returned by DailyMed, with every page merged into the first
+            history = data["data"]["history"]
+            return cls(
+                set_id=data["data"]["spl"]["setid"],
+                title=data["data"]["spl"].get("title"),
+                spl_versions=tuple(x["spl_version"] for x in history),
+                published_dates=tuple(x.get("published_date") for x in history),
+            )
+        return cls(
+            set_id=data["set_id"],
+            title=data.get("title"),
+            spl_versions=tuple(data["spl_versions"]),
+            published_dates=tuple(data["published_dates"]),
+            stored_application_numbers=tuple(
+                data.get("stored_application_numbers", ())
+            ),
+        )
+
+    def to_json(self):
+        """Returns the JSON serializable data of the record."""
+        data = {
+            "set_id": self.set_id,
+            "title": self.title,
+            "spl_versions": list(self.spl_versions),
+            "published_dates": list(self.published_dates),
+        }
+        if self.stored_application_numbers:
+            data["stored_application_numbers"] = list(
+                self.stored_application_numbers
+            )
+        return data
+
+    def select_versions(self, keep):
+        """Returns the history with only the versions for which keep returns
+        True.
+
+        Args:
+            keep (Callable): takes a version number, and returns whether to
+                             keep the version
+
+        Returns:
+            SplHistoryRecord: the history of the versions kept
+        """
+        kept = [
+            i for i, version in enumerate(self.spl_versions) if keep(version)
+        ]
+        return self._replace(
+            spl_versions=tuple(self.spl_versions[i] for i in kept),
+            published_dates=tuple(self.published_dates[i] for i in kept),
+        )
+
+
+class LabelSection(NamedTuple):
+    """A section of a label, or a sub-section of the parent section."""
+
+    name: str
+    text: str
+    parent: str
+
+
+class LabelVersion(NamedTuple):
+    """The label data of a version of a set id, as parsed from its XML file.
+    The fields are in the order of the stored documents."""
+
+    application_numbers: tuple
+    set_id: str
+    spl_version: str
+    published_date: str
+    name: str
+    generic_name: str
+    active_ingredient: str
+    spl_id: str
+    sections: tuple
+
+    @classmethod
+    def from_document(cls, document):
+        """
+        Creates the record from the document of the label version, as stored
+        in MongoDB and returned by find_labels.
+
+        Args:
+            document (dict): the label version document
+
+        Returns:
+            LabelVersion: the label version data
+        """
+        return cls(
+            **{
+                **{x: document.get(x) for x in cls._fields},
+                "application_numbers": tuple(document["application_numbers"]),
+                "sections": tuple(
+                    LabelSection(x["name"], x["text"], x["parent"])
+                    for x in document["sections"]
+                ),
+            }
+        )
+
+    def to_document(self):
+        """Returns the document of the label version, as stored in MongoDB."""
+        return {
+            **self._asdict(),
+            "application_numbers": list(self.application_numbers),
+            "sections": [x._asdict() for x in self.sections],
+        }
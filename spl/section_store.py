@@ -0,0 +1,146 @@
+"""
+Content-addressed storage of the label section texts.
+
+Consecutive versions of a set ID share nearly all of their section texts. In
+the deduplicated storage mode, the text of each section is stored once in the
+label_sections collection, keyed by the SHA-256 digest of the text, and the
+sections of the label documents reference their text by its digest:
+
+    {"name": "INDICATIONS", "parent": None, "text_hash": "9f86d0..."}
+
+instead of holding the text itself. The section texts are already normalized
+by the label parser, so the same text always has the same digest.
+"""
+
+import hashlib
+
+SECTIONS_COLLECTION_NAME = "label_sections"
+
+# The section texts are looked up by digest
+SECTIONS_KEY_FIELDS = ["_id"]
+
+
+def get_text_hash(text):
+    """Returns the digest identifying the section text.
+
+    Args:
+        text (str): the section text
+
+    Returns:
+        str: the hex SHA-256 digest of the text
+    """
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def split_sections(labels):
+    """
+    Replaces the section texts of the labels with their digests.
+
+    Args:
+        labels (list[dict]): the label version data
+
+    Returns:
+        (list[dict], dict): copies of the labels referencing their section
+                            texts by digest, and the section texts by digest
+    """
+    texts = {}
+    split_labels = []
+    for label in labels:
+        sections = []
+        for section in label["sections"]:
+            text_hash = get_text_hash(section["text"])
+            texts[text_hash] = section["text"]
+            sections.append(
+                {
+                    "name": section["name"],
+                    "parent": section["parent"],
+                    "text_hash": text_hash,
+                }
+            )
+        split_labels.append({**label, "sections": sections})
+    return split_labels, texts
+
+
+def join_sections(labels, texts):
+    """
+    Replaces the section text digests of the labels with the texts. Labels
+    stored with their section texts are returned unchanged.
+
+    Args:
+        labels (list[dict]): the labels, as stored
+        texts (dict): the section texts by digest
+
+    Returns:
+        list[dict]: the labels with their section texts
+    """
+    joined_labels = []
+    for label in labels:
+        sections = label.get("sections")
+        if sections and any("text_hash" in x for x in sections):
+            label = {
+                **label,
+                "sections": [
+                    (
+                        {
+                            "name": x["name"],
+                            "text": texts[x["text_hash"]],
+                            "parent": x["parent"],
+                        }
+                        if "text_hash" in x
+                        else x
+                    )
+                    for x in sections
+                ],
+            }
+        joined_labels.append(label)
+    return joined_labels
+
+
+def store_sections(mongo_client, labels):
+    """
+    Stores the section texts of the labels not stored yet in the
+    label_sections collection.
+
+    Args:
+        mongo_client (MongoClient): the client of the database
+        labels (list[dict]): the label version data
+
+    Returns:
+        list[dict]: copies of the labels referencing their section texts by
+                    digest, to be stored instead of the labels
+    """
+    split_labels, texts = split_sections(labels)
+    mongo_client.bulk_insert_new(
+        SECTIONS_COLLECTION_NAME,
+        SECTIONS_KEY_FIELDS,
+        [{"_id": text_hash, "text": text} for text_hash, text in texts.items()],
+    )
+    return split_labels
+
+
+def load_sections(mongo_client, labels):
+    """
+    Looks up the section texts referenced by the labels, with one query.
+
+    Args:
+        mongo_client (MongoClient): the client of the database
+        labels (list[dict]): the labels, as stored
+
+    Returns:
+        list[dict]: the labels with their section texts
+    """
+    text_hashes = {
+        x["text_hash"]
+        for label in labels
+        for x in label.get("sections") or []
+        if "text_hash" in x
+    }
+    texts = {}
+    if text_hashes:
+        texts = {
+            x["_id"]: x["text"]
+            for x in mongo_client.find(
+                SECTIONS_COLLECTION_NAME, {"_id": {"$in": list(text_hashes)}}
+            )
+        }
+    return join_sections(labels, texts)
@@ -0,0 +1,101 @@
+"""
+Normalization and matching of label section titles.
+
+Titles are normalized the same way as by the cleantext.clean call in _clean,
+but the ASCII titles that make up nearly all of the corpus take a fast path
+built on precompiled regexes and translation tables. Normalized titles are
+memoized, as the same few hundred headings repeat across every label.
+"""
+
+import functools
+import re
+import unicodedata
+
+import cleantext
+
+# The same patterns as cleantext's no_numbers and no_digits options
+_NUMBERS_REGEX = re.compile(
+    r"(?:^|(?<=[^\w,.]))[+–-]?(([1-9]\d{0,2}(,\d{3})+(\.\d*)?)|"
+    r"([1-9]\d{0,2}([ .]\d{3})+(,\d*)?)|(\d*?[.,]\d+)|\d+)(?:$|(?=\b))"
+)
+_DIGITS_REGEX = re.compile(r"\d")
+
+_TITLE_TRANSLATION = str.maketrans({"&": "AND", "\t": " "})
+_ASCII_PUNCT_TRANSLATION = {
+    i: None for i in range(128) if unicodedata.category(chr(i)).startswith("P")
+}
+
+# Titles made up only of these characters are left unchanged by the unicode
+# fixes and transliteration that cleantext.clean applies first
+_FAST_PATH_CHARS = frozenset(
+    [chr(i) for i in range(0x20, 0x7F) if chr(i) != "\\"] + ["\t", "\n", "\r"]
+)
+
+
+def _clean(text):
+    # Two colons could form an emoji alias, which cleantext would convert
+    if not _FAST_PATH_CHARS.issuperset(text) or text.count(":") > 1:
+        return cleantext.clean(
+            text,
+            lower=False,
+            no_line_breaks=True,
+            no_punct=True,
+            no_numbers=True,
+            no_digits=True,
+            replace_with_number="",
+            replace_with_digit="",
+        )
+    # cleantext replaces backticks with quotes, which are punctuation
+    text = text.replace("`", "'")
+    text = _NUMBERS_REGEX.sub("", text)
+    text = _DIGITS_REGEX.sub("", text)
+    text = text.translate(_ASCII_PUNCT_TRANSLATION)
+    return " ".join(text.split())
+
+
+@functools.lru_cache(maxsize=4096)
+def normalize_title(text):
+    """
+    Normalizes a section title for matching: converts it to upper case,
+    replaces & with AND, and removes unicode oddities, digits, punctuation and
+    extra whitespace.
+
+    Args:
+        text (str): the section title
+
+    Returns:
+        str: the normalized title
+    """
+    return _clean(text.upper().translate(_TITLE_TRANSLATION))
+
+
+class SectionTitleMatcher:
+    """
+    Used to match section titles against the sections of interest, and their
+    aliases, in constant time.
+    """
+
+    def __init__(self, sections, aliases=None):
+        """
+        Args:
+            sections (list[str]): the section titles of interest
+            aliases (dict, optional): other titles of the sections, mapped to
+                                      the section title
+        """
+        self.sections = list(sections)
+        self._lookup = {normalize_title(x): x for x in self.sections}
+        for alias, section in (aliases or {}).items():
+            if section not in self.sections:
+                raise ValueError(f"Alias of an unknown section: {section}")
+            self._lookup[normalize_title(alias)] = section
+
+    def match(self, title):
+        """Returns the section title matched by the title, or None.
+
+        Args:
+            title (str): the section title found in a label
+
+        Returns:
+            str: the matching section title
+        """
+        return self._lookup.get(normalize_title(title))
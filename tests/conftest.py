@@ -0,0 +1,189 @@
+import http.server
+import io
+import json
+import os
+import threading
+import time
+import zipfile
+from urllib.parse import urlsplit
+
+import pytest
+
+TEST_DATA_DIR = os.path.join("tests", "testdata")
+
+
+def _read_test_data(*path):
+    with open(os.path.join(TEST_DATA_DIR, *path), "rb") as f:
+        return f.read()
+
+
+@pytest.fixture
+def read_test_data():
+    """Returns a function reading the contents of a file in tests/testdata,
+    given its path parts, as bytes."""
+    return _read_test_data
+
+
+def _make_versioned_label_zip(version, nda=True):
+    with open(os.path.join(TEST_DATA_DIR, "test_label_nested.xml")) as f:
+        xml = f.read().replace(
+            '<versionNumber value="4"/>', f'<versionNumber value="{version}"/>'
+        )
+    if not nda:
+        xml = xml.replace('extension="NDA012345"', 'extension="ANDA012345"')
+    content = io.BytesIO()
+    with zipfile.ZipFile(content, "w", zipfile.ZIP_DEFLATED) as zip_obj:
+        zip_obj.writestr(f"spl-{version}.xml", xml)
+        zip_obj.writestr("image-01.jpg", bytes(100))
+    return content.getvalue()
+
+
+@pytest.fixture
+def versioned_label_zip():
+    """
+    Returns a function building the zip file of the nested test label, with
+    its version number set to the given version. With nda=False, the
+    application number of the label is that of an ANDA.
+    """
+    return _make_versioned_label_zip
+
+
+class RecordingMongoClient:
+    """
+    Returns the matching stored documents from find, and records the queries
+    and writes made from this process.
+    """
+
+    def __init__(self, stored=()):
+        self.stored = list(stored)
+        self.queries = []
+        self.upserts = []
+        self.updates = []
+
+    def create_indexes(self, collection_name, indexes):
+        pass
+
+    def find(self, collection_name, query, projection=None):
+        self.queries.append(query)
+        set_ids = query["set_id"]["$in"]
+        return [x for x in self.stored if x["set_id"] in set_ids]
+
+    def bulk_upsert(self, collection_name, key_fields, documents):
+        self.upserts.extend(documents)
+
+    def update_many(self, collection_name, query, update):
+        self.updates.append((query, update))
+
+
+class FileMongoClient(RecordingMongoClient):
+    """
+    A RecordingMongoClient that also records the upserts to a file, so that
+    they can be read back from the worker processes.
+    """
+
+    def __init__(self, file_path, stored=()):
+        super().__init__(stored)
+        self.file_path = file_path
+
+    def bulk_upsert(self, collection_name, key_fields, documents):
+        super().bulk_upsert(collection_name, key_fields, documents)
+        with open(self.file_path, "a") as f:
+            for document in documents:
+                f.write(json.dumps(document) + "\n")
+
+    def read_upserts(self):
+        with open(self.file_path) as f:
+            return [json.loads(x) for x in f]
+
+
+@pytest.fixture
+def mongo_client(monkeypatch):
+    """Stores the labels with a RecordingMongoClient, in place of MongoDB."""
+    import spl.labels
+
+    mongo_client = RecordingMongoClient()
+    monkeypatch.setattr(spl.labels, "_mongo_client", mongo_client)
+    return mongo_client
+
+
+@pytest.fixture
+def file_mongo_client(monkeypatch, tmp_path):
+    """Stores the labels with a FileMongoClient, in place of MongoDB."""
+    import spl.labels
+
+    mongo_client = FileMongoClient(tmp_path / "upserts.jsonl")
+    monkeypatch.setattr(spl.labels, "_mongo_client", mongo_client)
+    return mongo_client
+
+
+class StubServer(http.server.ThreadingHTTPServer):
+    """
+    A local HTTP server used in place of DailyMed. Responses are set by path
+    (including the query string) in the routes attribute, either as a
+    (status, body) or (status, body, headers) tuple, or as a callable
+    returning one.
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), _StubRequestHandler)
+        self.routes = {}
+        self.delay = 0
+        self.requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def handle_error(self, request, client_address):
+        # Clients may drop the connection early, e.g. on a timeout
+        pass
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class _StubRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server = self.server
+        with server._lock:
+            server.requests.append(self.path)
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        try:
+            time.sleep(server.delay)
+            route = server.routes.get(self.path)
+            if route is None:
+                route = server.routes.get(urlsplit(self.path).path)
+            if callable(route):
+                route = route(self)
+            if route is None:
+                route = (404, b"")
+            status, body, headers = (*route, {})[:3]
+            if isinstance(body, str):
+                body = body.encode()
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with server._lock:
+                server.in_flight -= 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def stub_server():
+    server = StubServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
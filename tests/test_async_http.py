@@ -0,0 +1,195 @@
+import asyncio
+import json
+import pytest
+
+pytest.importorskip("aiohttp")
+
+from spl.history import SplHistoryResponse, process_spl_history_async
+from spl.index import SplIndexFile, process_paginated_index_async
+from spl.labels import SplHistoricalLabels, process_historical_labels_async
+from spl.records import SplHistoryRecord
+from utils.async_http import AsyncFetcher
+from utils.journal import HISTORY_STAGE, LABELS_STAGE, ProgressJournal
+
+TEST_HISTORY_SET_ID = "9525f887-a055-4e33-8e92-898d42828cd1"
+TEST_LABEL_SET_ID = "1b5e2860-6855-4a65-8bbc-e064172a1adf"
+
+
+def test_init_method():
+    with pytest.raises(ValueError):
+        _ = AsyncFetcher(max_concurrency=0)
+    fetcher = AsyncFetcher(max_concurrency=5)
+    assert fetcher.max_concurrency == 5
+
+
+def test_fetch_all_limits_concurrency(stub_server):
+    stub_server.delay = 0.1
+    for i in range(9):
+        stub_server.routes[f"/page/{i}"] = (200, f"content {i}")
+
+    async def fetch_all():
+        async with AsyncFetcher(max_concurrency=3) as fetcher:
+            contents = await fetcher.fetch_all(
+                [f"{stub_server.url}/page/{i}" for i in range(9)]
+            )
+            return contents, fetcher.max_in_flight
+
+    contents, max_in_flight = asyncio.run(fetch_all())
+    assert contents == [f"content {i}".encode() for i in range(9)]
+    assert max_in_flight == 3
+    assert stub_server.max_in_flight <= 3
+
+
+def test_fetch_failure(stub_server):
+    url = stub_server.url
+    stub_server.shutdown()
+    stub_server.server_close()
+
+    async def fetch():
+        async with AsyncFetcher() as fetcher:
+            return await fetcher.fetch(f"{url}/unreachable")
+
+    assert asyncio.run(fetch()) is None
+
+
+def test_process_paginated_index_async(
+    monkeypatch, stub_server, read_test_data
+):
+    monkeypatch.setattr(SplIndexFile, "BASE_URL", f"{stub_server.url}/spls.xml")
+    stub_server.routes["/spls.xml?page=1"] = (
+        200,
+        read_test_data("test_index_page.xml"),
+    )
+    all_spls, end_page = process_paginated_index_async(1, 1)
+    baseline = json.loads(read_test_data("baselines", "test_index_page.json"))
+    assert [x._asdict() for x in all_spls] == baseline["spls"]
+    assert end_page == 1
+
+
+def test_process_spl_history_async(monkeypatch, stub_server, read_test_data):
+    monkeypatch.setattr(
+        SplHistoryResponse, "BASE_URL", f"{stub_server.url}/spls"
+    )
+    stub_server.routes[f"/spls/{TEST_HISTORY_SET_ID}/history"] = (
+        200,
+        read_test_data("test_history.json"),
+    )
+    spl_history = process_spl_history_async([TEST_HISTORY_SET_ID])
+    assert spl_history == [
+        SplHistoryRecord.from_json(
+            json.loads(read_test_data("test_history.json"))
+        )
+    ]
+
+
+def test_process_spl_history_async_paginated(monkeypatch, stub_server):
+    monkeypatch.setattr(
+        SplHistoryResponse, "BASE_URL", f"{stub_server.url}/spls"
+    )
+    for page_num in [1, 2]:
+        query = "" if page_num == 1 else f"?page={page_num}"
+        stub_server.routes[f"/spls/{TEST_HISTORY_SET_ID}/history{query}"] = (
+            200,
+            json.dumps(
+                {
+                    "data": {
+                        "spl": {"setid": TEST_HISTORY_SET_ID},
+                        "history": [{"spl_version": 3 - page_num}],
+                    },
+                    "metadata": {"total_pages": 2},
+                }
+            ),
+        )
+    parsed_pages = []
+    process = SplHistoryResponse._process
+
+    def record_process(self, content):
+        parsed_pages.append(self.page)
+        process(self, content)
+
+    monkeypatch.setattr(SplHistoryResponse, "_process", record_process)
+    (spl_history,) = process_spl_history_async([TEST_HISTORY_SET_ID])
+    assert spl_history.spl_versions == (2, 1)
+    # Each page is parsed once
+    assert sorted(parsed_pages) == [1, 2]
+
+
+def test_process_spl_history_async_failure(
+    monkeypatch, stub_server, read_test_data, tmp_path
+):
+    monkeypatch.setattr(
+        SplHistoryResponse, "BASE_URL", f"{stub_server.url}/spls"
+    )
+    stub_server.routes[f"/spls/{TEST_HISTORY_SET_ID}/history"] = (
+        200,
+        read_test_data("test_history.json"),
+    )
+    stub_server.routes["/spls/failing-setid/history"] = (500, "error")
+    journal = ProgressJournal(str(tmp_path / "journal.sqlite"))
+    spl_history = process_spl_history_async(
+        ["failing-setid", TEST_HISTORY_SET_ID], journal=journal
+    )
+
+    # The failing set ID is skipped, without losing the others
+    assert [x.set_id for x in spl_history] == [TEST_HISTORY_SET_ID]
+    assert journal.get_completed(HISTORY_STAGE) == {TEST_HISTORY_SET_ID}
+
+
+def test_process_historical_labels_async(
+    monkeypatch, stub_server, file_mongo_client, read_test_data, tmp_path
+):
+    monkeypatch.setattr(
+        SplHistoricalLabels,
+        "BASE_URL",
+        f"{stub_server.url}/getFile.cfm?type=zip",
+    )
+    stub_server.routes[
+        f"/getFile.cfm?type=zip&setid={TEST_LABEL_SET_ID}&version=1"
+    ] = (200, read_test_data(f"{TEST_LABEL_SET_ID}_1.zip"))
+    all_setid_history = [
+        SplHistoryRecord(TEST_LABEL_SET_ID, None, (1,), (None,))
+    ]
+    process_historical_labels_async(
+        all_setid_history, str(tmp_path / "label_data"), in_memory=True
+    )
+
+    assert file_mongo_client.read_upserts() == json.loads(
+        read_test_data("baselines", "test_label.json")
+    )
+
+
+def test_process_historical_labels_async_unreachable(
+    monkeypatch, stub_server, file_mongo_client, read_test_data, tmp_path
+):
+    monkeypatch.setattr(
+        SplHistoricalLabels,
+        "BASE_URL",
+        f"{stub_server.url}/getFile.cfm?type=zip",
+    )
+    stub_server.routes[
+        f"/getFile.cfm?type=zip&setid={TEST_LABEL_SET_ID}&version=1"
+    ] = (200, read_test_data(f"{TEST_LABEL_SET_ID}_1.zip"))
+
+    def drop_connection(handler):
+        raise ConnectionResetError()
+
+    stub_server.routes["/getFile.cfm?type=zip&setid=unreachable&version=1"] = (
+        drop_connection
+    )
+    all_setid_history = [
+        SplHistoryRecord("unreachable", None, (1,), (None,)),
+        SplHistoryRecord(TEST_LABEL_SET_ID, None, (1,), (None,)),
+    ]
+    journal = ProgressJournal(str(tmp_path / "journal.sqlite"))
+    # The zip files are saved to disk, where a failed download must not stop
+    # the stage
+    process_historical_labels_async(
+        all_setid_history, str(tmp_path / "label_data"), journal=journal
+    )
+
+    # Only the set ID with every version processed is recorded as completed
+    assert journal.get_completed(LABELS_STAGE) == {TEST_LABEL_SET_ID}
+
+    assert file_mongo_client.read_upserts() == json.loads(
+        read_test_data("baselines", "test_label.json")
+    )
@@ -0,0 +1,86 @@
+import os
+import zipfile
+
+import pytest
+
+import spl.labels
+from spl.bulk import get_label_zip_names, ingest_archives
+
+TEST_DATA_DIR = os.path.join("tests", "testdata")
+NESTED_SET_ID = "0c9e2bd6-53b2-4d6e-8f1a-9b8c7d6e5f40"
+ROGAINE_SET_ID = "1b5e2860-6855-4a65-8bbc-e064172a1adf"
+
+
+def _make_archive(path, label_zips):
+    with zipfile.ZipFile(path, "w") as archive:
+        for name, content in label_zips.items():
+            archive.writestr(f"prescription/{name}", content)
+    return str(path)
+
+
+@pytest.mark.parametrize("parser", spl.labels.SplHistoricalLabels.PARSERS)
+def test_ingest_archives(tmp_path, mongo_client, versioned_label_zip, parser):
+    with open(
+        os.path.join(TEST_DATA_DIR, f"{ROGAINE_SET_ID}_1.zip"), "rb"
+    ) as f:
+        rogaine_zip = f.read()
+    archives = [
+        _make_archive(
+            tmp_path / "part1.zip",
+            {
+                f"20200131_{NESTED_SET_ID}.zip": versioned_label_zip(3),
+                f"20160309_{ROGAINE_SET_ID}.zip": rogaine_zip,
+                "bad.zip": b"not a zip file",
+            },
+        ),
+        # An update with a later version of a set ID, whose own application
+        # numbers are not those of an NDA
+        _make_archive(
+            tmp_path / "update.zip",
+            {
+                f"20210131_{NESTED_SET_ID}.zip": versioned_label_zip(
+                    4, nda=False
+                )
+            },
+        ),
+    ]
+    assert get_label_zip_names(archives[1]) == [
+        f"prescription/20210131_{NESTED_SET_ID}.zip"
+    ]
+
+    assert ingest_archives(archives, parser=parser, workers=2) == 2
+
+    labels = {(x["set_id"], x["spl_version"]): x for x in mongo_client.upserts}
+    assert set(labels) == {
+        (NESTED_SET_ID, "3"),
+        (NESTED_SET_ID, "4"),
+        (ROGAINE_SET_ID, "1"),
+    }
+    # The application numbers of the set ID are applied to all its versions
+    assert set(labels[(NESTED_SET_ID, "4")]["application_numbers"]) == {
+        "12345",
+        "20001",
+    }
+    assert labels[(ROGAINE_SET_ID, "1")]["application_numbers"] == ["21812"]
+    assert labels[(ROGAINE_SET_ID, "1")]["spl_id"] == (
+        "ab36b844-19de-4340-b32b-5e3abdaa5895"
+    )
+    assert len(labels[(ROGAINE_SET_ID, "1")]["sections"]) > 0
+
+
+def test_ingest_archives_without_application_numbers(
+    tmp_path, mongo_client, versioned_label_zip
+):
+    archive = _make_archive(
+        tmp_path / "part1.zip",
+        {f"{NESTED_SET_ID}.zip": versioned_label_zip(1, nda=False)},
+    )
+    assert ingest_archives([archive], workers=1) == 0
+    assert mongo_client.upserts == []
+
+
+def test_ingest_archives_not_a_zip_file(tmp_path, mongo_client):
+    path = tmp_path / "part1.zip"
+    path.write_bytes(b"not a zip file")
+    with pytest.raises(ValueError):
+        ingest_archives([str(path)])
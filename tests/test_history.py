@@ -3,6 +3,8 @@ import os
 import pytest
 
 from spl.history import SplHistoryResponse, get_spl, process_spl_history
+from spl.records import SplHistoryRecord
+from utils import http_client
 
 TEST_DATA_DIR = os.path.join("tests", "testdata")
 TEST_SET_ID = "9525f887-a055-4e33-8e92-898d42828cd1"
@@ -32,20 +34,21 @@ def mock_fetch_and_process(monkeypatch):
 
 @pytest.fixture
 def mock_request(monkeypatch):
-    def mock_method(url, allow_redirects):
+    def mock_method(url):
         """This method expects to have been invoked with specific args, without
         which it will return None
         """
         if (
             url
             == "https://dailymed.nlm.nih.gov/dailymed/services/v2/spls/9525f887-a055-4e33-8e92-898d42828cd1/history"
-            and allow_redirects == True
         ):
             content = None
             with open(os.path.join(TEST_DATA_DIR, "test_history.json")) as f:
                 content = f.read()
             return MockResponse(content)
 
+    monkeypatch.setattr(http_client, "get", mock_method)
+
 
 def test_class_attributes():
     assert (
@@ -90,4 +93,60 @@ def test_process_spl_history(mock_request):
     spl_history = process_spl_history([TEST_SET_ID])
     # Test against baseline
     data = _read_setid_history_baseline()
-    assert spl_history == [data]
+    assert spl_history == [SplHistoryRecord.from_json(data)]
+
+
+def _history_page(page_num, total_pages, versions):
+    return json.dumps(
+        {
+            "data": {
+                "spl": {"setid": "test-setid"},
+                "history": [{"spl_version": x} for x in versions],
+            },
+            "metadata": {"total_pages": total_pages, "current_page": page_num},
+        }
+    )
+
+
+@pytest.fixture
+def stub_paginated_history(monkeypatch, stub_server):
+    """Serves 3 pages of history for test-setid from the stub server."""
+    monkeypatch.setattr(
+        SplHistoryResponse, "BASE_URL", f"{stub_server.url}/spls"
+    )
+    stub_server.delay = 0.1
+    pages = {1: [7, 6, 5], 2: [4, 3, 2], 3: [1]}
+    for page_num, versions in pages.items():
+        query = "" if page_num == 1 else f"?page={page_num}"
+        stub_server.routes[f"/spls/test-setid/history{query}"] = (
+            200,
+            _history_page(page_num, len(pages), versions),
+        )
+    return stub_server
+
+
+def test_get_url():
+    assert SplHistoryResponse.get_url("test-setid") == (
+        "https://dailymed.nlm.nih.gov/dailymed/services/v2/spls/test-setid/history"
+    )
+    assert SplHistoryResponse.get_url("test-setid", 3) == (
+        "https://dailymed.nlm.nih.gov/dailymed/services/v2/spls/test-setid/history?page=3"
+    )
+
+
+def test_get_spl_paginated(stub_paginated_history):
+    spl_history = get_spl("test-setid")
+
+    assert spl_history.spl_versions == tuple(range(7, 0, -1))
+    assert len(stub_paginated_history.requests) == 3
+    # The pages after the first are fetched concurrently
+    assert stub_paginated_history.max_in_flight == 2
+
+
+def test_get_spl_missing_page(stub_paginated_history):
+    stub_paginated_history.routes["/spls/test-setid/history?page=2"] = (
+        404,
+        "",
+    )
+    spl_history = get_spl("test-setid")
+    assert spl_history.spl_versions == (7, 6, 5, 1)
@@ -0,0 +1,139 @@
+import asyncio
+
+import pytest
+
+from utils import http_cache, http_client
+from utils.async_http import AsyncFetcher
+
+LABEL_URL = (
+    "https://dailymed.nlm.nih.gov/dailymed/getFile.cfm"
+    "?type=zip&setid=abc&version=2"
+)
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return http_cache.ResponseCache(str(tmp_path), max_bytes=100, ttl=60)
+
+
+@pytest.fixture
+def cached_client(monkeypatch, tmp_path):
+    """Enables the response cache for the HTTP client, in a temp folder."""
+    monkeypatch.setattr(http_cache, "_config", dict(http_cache._config))
+    monkeypatch.setattr(http_client, "_config", dict(http_client._config))
+    monkeypatch.setattr(http_client, "_session", None)
+    http_cache.configure(folder=str(tmp_path / "cache"), ttl=60)
+    yield
+    http_cache.configure(folder=None)
+
+
+def _etag_route(etag, body):
+    def route(handler):
+        if handler.headers.get("If-None-Match") == etag:
+            return (304, b"")
+        return (200, body, {"ETag": etag})
+
+    return route
+
+
+def test_store_and_lookup(cache):
+    assert cache.lookup("http://x/a") is None
+    cache.store("http://x/a", b"content", etag='"1"', last_modified="Mon")
+    entry = cache.lookup("http://x/a")
+    assert entry["content"] == b"content"
+    assert not entry["permanent"]
+    assert cache.is_fresh(entry)
+    assert cache.conditional_headers(entry) == {
+        "If-None-Match": '"1"',
+        "If-Modified-Since": "Mon",
+    }
+    assert cache.conditional_headers(None) == {}
+
+
+def test_ttl_and_permanent_entries(cache, monkeypatch):
+    cache.store("http://x/a", b"index")
+    cache.store(LABEL_URL, b"label")
+    assert cache.lookup(LABEL_URL)["permanent"]
+    now = http_cache.time.time()
+    monkeypatch.setattr(http_cache.time, "time", lambda: now + 120)
+    assert not cache.is_fresh(cache.lookup("http://x/a"))
+    assert cache.is_fresh(cache.lookup(LABEL_URL))
+    cache.revalidated("http://x/a")
+    assert cache.is_fresh(cache.lookup("http://x/a"))
+
+
+def test_lru_eviction(cache, tmp_path):
+    cache.store("http://x/a", b"a" * 40)
+    cache.store("http://x/b", b"b" * 40)
+    # Use a, so that b is the least recently used entry
+    cache.lookup("http://x/a")
+    cache.store("http://x/c", b"c" * 40)
+    assert cache.lookup("http://x/b") is None
+    assert cache.lookup("http://x/a") is not None
+    assert cache.lookup("http://x/c") is not None
+    assert cache.get_size() == 80
+    assert len(list((tmp_path / "bodies").glob("*/*"))) == 2
+    # Responses larger than the cache are not stored
+    cache.store("http://x/d", b"d" * 101)
+    assert cache.lookup("http://x/d") is None
+
+
+def test_identical_bodies_are_stored_once(cache, tmp_path):
+    cache.store("http://x/a", b"same")
+    cache.store("http://x/b", b"same")
+    assert len(list((tmp_path / "bodies").glob("*/*"))) == 1
+    # Replacing one URL's content keeps the body still in use
+    cache.store("http://x/a", b"other")
+    assert cache.lookup("http://x/b")["content"] == b"same"
+    assert len(list((tmp_path / "bodies").glob("*/*"))) == 2
+
+
+def test_get_uses_cache(cached_client, stub_server, monkeypatch):
+    stub_server.routes["/page"] = _etag_route('"v1"', "content")
+    url = f"{stub_server.url}/page"
+    before = http_client.get_stats()
+    assert http_client.get(url).content == b"content"
+    # Fresh: served without a request
+    assert http_client.get(url).content == b"content"
+    assert stub_server.requests == ["/page"]
+
+    # Stale: revalidated with a conditional request
+    now = http_cache.time.time()
+    monkeypatch.setattr(http_cache.time, "time", lambda: now + 120)
+    r = http_client.get(url)
+    assert r.status_code == 200
+    assert r.content == b"content"
+    assert len(stub_server.requests) == 2
+    after = http_client.get_stats()
+    assert after["cache_hits"] - before["cache_hits"] == 1
+    assert after["cache_revalidations"] - before["cache_revalidations"] == 1
+
+    # Changed: the new content replaces the cached one
+    stub_server.routes["/page"] = _etag_route('"v2"', "changed")
+    monkeypatch.setattr(http_cache.time, "time", lambda: now + 240)
+    assert http_client.get(url).content == b"changed"
+    assert http_client.get(url).content == b"changed"
+    assert len(stub_server.requests) == 3
+
+
+def test_get_does_not_cache_errors(cached_client, stub_server):
+    stub_server.routes["/missing"] = (404, "not found")
+    url = f"{stub_server.url}/missing"
+    assert http_client.get(url).status_code == 404
+    assert http_client.get(url).status_code == 404
+    assert len(stub_server.requests) == 2
+
+
+def test_async_fetch_uses_cache(cached_client, stub_server):
+    stub_server.routes["/page"] = _etag_route('"v1"', "content")
+    url = f"{stub_server.url}/page"
+
+    async def fetch_twice():
+        async with AsyncFetcher(max_concurrency=2) as fetcher:
+            return [await fetcher.fetch(url), await fetcher.fetch(url)]
+
+    assert asyncio.run(fetch_twice()) == [b"content", b"content"]
+    assert stub_server.requests == ["/page"]
+    # The cache is shared with the synchronous client
+    assert http_client.get(url).content == b"content"
+    assert stub_server.requests == ["/page"]
@@ -0,0 +1,78 @@
+import pytest
+import requests
+
+from utils import http_client
+
+
+@pytest.fixture
+def client_config(monkeypatch):
+    """Isolates the client options and session used by each test."""
+    monkeypatch.setattr(http_client, "_config", dict(http_client._config))
+    monkeypatch.setattr(http_client, "_session", None)
+    http_client.configure(backoff_factor=0.01)
+
+
+def _stats_delta(before):
+    after = http_client.get_stats()
+    return {name: after[name] - before[name] for name in before}
+
+
+def test_configure(client_config):
+    with pytest.raises(ValueError):
+        http_client.configure(bad_option=1)
+    http_client.configure(read_timeout=5, max_retries=None)
+    assert http_client._config["read_timeout"] == 5
+    assert http_client._config["max_retries"] == 5
+
+
+def test_get_session(client_config):
+    session = http_client.get_session()
+    assert http_client.get_session() is session
+    http_client.configure(max_retries=1)
+    assert http_client.get_session() is not session
+
+
+def test_get_reuses_connections(client_config, stub_server):
+    stub_server.routes["/page"] = (200, "content")
+    before = http_client.get_stats()
+    for _ in range(3):
+        r = http_client.get(f"{stub_server.url}/page")
+        assert r.content == b"content"
+    assert _stats_delta(before) == {
+        "requests": 3,
+        "connections": 1,
+        "retries": 0,
+        "cache_hits": 0,
+        "cache_revalidations": 0,
+        "handshakes_saved": 2,
+    }
+
+
+def test_get_retries(client_config, stub_server):
+    statuses = [503, 429, 200]
+    stub_server.routes["/flaky"] = lambda handler: (statuses.pop(0), "done")
+    before = http_client.get_stats()
+    r = http_client.get(f"{stub_server.url}/flaky")
+    assert r.status_code == 200
+    assert r.content == b"done"
+    delta = _stats_delta(before)
+    assert delta["requests"] == 3
+    assert delta["retries"] == 2
+
+
+def test_get_retries_exhausted(client_config, stub_server):
+    http_client.configure(max_retries=2)
+    stub_server.routes["/down"] = (503, "unavailable")
+    before = http_client.get_stats()
+    r = http_client.get(f"{stub_server.url}/down")
+    # The last response is returned once the retries are exhausted
+    assert r.status_code == 503
+    assert _stats_delta(before)["requests"] == 3
+
+
+def test_get_timeout(client_config, stub_server):
+    http_client.configure(read_timeout=0.1, max_retries=0)
+    stub_server.delay = 0.5
+    stub_server.routes["/slow"] = (200, "slow")
+    with pytest.raises(requests.exceptions.ConnectionError):
+        http_client.get(f"{stub_server.url}/slow")
@@ -2,8 +2,13 @@ import json
 import os
 import pytest
 
-from spl.index import SplIndexFile, get_spls, process_paginated_index
-
+from spl.index import (
+    SplIndexFile,
+    SplIndexRecord,
+    get_spls,
+    process_paginated_index,
+)
+from utils import http_client, jsonl
 
 TEST_DATA_DIR = os.path.join("tests", "testdata")
 
@@ -31,20 +36,25 @@ def mock_fetch_and_process(monkeypatch):
 
 @pytest.fixture
 def mock_request(monkeypatch):
-    def mock_method(url, allow_redirects):
+    requested_urls = []
+
+    def mock_method(url):
         """This method expects to have been invoked with specific args, without
         which it will return None
         """
+        requested_urls.append(url)
         if (
             url
             == "https://dailymed.nlm.nih.gov/dailymed/services/v2/spls.xml?page=1"
-            and allow_redirects == True
         ):
             content = None
             with open(os.path.join(TEST_DATA_DIR, "test_index_page.xml")) as f:
                 content = f.read()
             return MockResponse(content)
 
+    monkeypatch.setattr(http_client, "get", mock_method)
+    return requested_urls
+
 
 def test_class_attribute():
     assert (
@@ -76,17 +86,59 @@ def test_fetch_and_process(mock_request):
     # Test against baseline
     data = _read_index_first_page_baseline()
     assert spl_obj.metadata == data["metadata"]
-    assert list(map(lambda x: dict(x), spl_obj.spls)) == data["spls"]
+    assert [x._asdict() for x in spl_obj.spls] == data["spls"]
 
 
 def test_get_spls(mock_request):
     spls = get_spls(1)
     data = _read_index_first_page_baseline()
-    assert spls == data["spls"]
+    assert [x._asdict() for x in spls] == data["spls"]
 
 
 def test_process_paginated_index(mock_request):
     all_spls, end_page = process_paginated_index(1, 1)
     data = _read_index_first_page_baseline()
-    assert all_spls == data["spls"]
-    assert end_page == 1
\ No newline at end of file
+    assert [x._asdict() for x in all_spls] == data["spls"]
+    assert end_page == 1
+    # The first page is downloaded only once
+    assert len(mock_request) == 1
+
+
+def test_process_paginated_index_writer(mock_request, tmp_path):
+    path = str(tmp_path / "spl_index_pages_1_to_1.jsonl.gz")
+    with jsonl.JsonlWriter(path) as writer:
+        all_spls, _ = process_paginated_index(1, 1, writer=writer)
+    assert list(jsonl.read_records(path)) == [x._asdict() for x in all_spls]
+
+
+def test_process_single_spl_page():
+    spl_obj = SplIndexFile(
+        1,
+        content=(
+            b"<spls><metadata><total_pages>1</total_pages></metadata>"
+            b"<spl><setid>test-setid</setid><spl_version>2</spl_version>"
+            b"<title/></spl></spls>"
+        ),
+    )
+    assert spl_obj.metadata == {"total_pages": "1"}
+    assert spl_obj.spls == [
+        SplIndexRecord(
+            setid="test-setid",
+            spl_version="2",
+            published_date=None,
+            title=None,
+        )
+    ]
+
+
+def test_process_truncated_spl_page():
+    spl_obj = SplIndexFile(
+        1,
+        content=(
+            b"<spls><metadata><total_pages>1</total_pages></metadata>"
+            b"<spl><setid>test-setid</setid><spl_version>2</spl_version></spl>"
+            b"<spl><setid>test-"
+        ),
+    )
+    # None of the spls of a page that failed to parse are kept
+    assert spl_obj.spls == []
@@ -0,0 +1,39 @@
+from utils.journal import (
+    HISTORY_STAGE,
+    INDEX_STAGE,
+    LABELS_STAGE,
+    ProgressJournal,
+)
+
+
+def test_record_and_get(tmp_path):
+    journal = ProgressJournal(str(tmp_path / "journal.sqlite"))
+    assert journal.get_completed(INDEX_STAGE) == set()
+    assert journal.get(INDEX_STAGE, 1) is None
+
+    journal.record(INDEX_STAGE, 1, [{"setid": "a"}])
+    journal.record(HISTORY_STAGE, "a", {"data": {"history": []}})
+    journal.record(LABELS_STAGE, "a")
+
+    assert journal.get_completed(INDEX_STAGE) == {"1"}
+    assert journal.get(INDEX_STAGE, 1) == [{"setid": "a"}]
+    assert journal.get(HISTORY_STAGE, "a") == {"data": {"history": []}}
+    assert journal.get_completed(LABELS_STAGE) == {"a"}
+    assert journal.get_completed(HISTORY_STAGE) == {"a"}
+
+
+def test_resume(tmp_path):
+    path = str(tmp_path / "journal.sqlite")
+    journal = ProgressJournal(path)
+    journal.record(LABELS_STAGE, "a")
+    journal.close()
+
+    # The work recorded is kept when resuming
+    journal = ProgressJournal(path, resume=True)
+    assert journal.get_completed(LABELS_STAGE) == {"a"}
+    journal.record(LABELS_STAGE, "b")
+    journal.close()
+
+    # A new run starts over
+    journal = ProgressJournal(path)
+    assert journal.get_completed(LABELS_STAGE) == set()
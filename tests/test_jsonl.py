@@ -0,0 +1,78 @@
+import gzip
+import os
+import json
+
+import pytest
+
+from utils import jsonl
+
+RECORDS = [
+    {"setid": "set-id-1", "spl_version": "1", "title": "Ünïcode"},
+    {"setid": "set-id-2", "spl_version": "3", "title": None},
+]
+
+
+@pytest.mark.parametrize("compression", [None, "gzip", "zstd"])
+def test_write_and_read(tmp_path, compression):
+    if compression == "zstd":
+        pytest.importorskip("zstandard")
+    path = jsonl.get_path(str(tmp_path / "data"), compression)
+    assert jsonl.get_compression(path) == compression
+
+    with jsonl.JsonlWriter(path) as writer:
+        writer.write(RECORDS[0])
+        writer.write_all(RECORDS[1:])
+        # The file is only complete once the writer is closed
+        assert not os.path.exists(path)
+    assert writer.count == 2
+    assert list(jsonl.read_records(path)) == RECORDS
+
+
+def test_compression(tmp_path):
+    path = str(tmp_path / "data.jsonl.gz")
+    with jsonl.JsonlWriter(path) as writer:
+        writer.write_all(RECORDS * 100)
+    with gzip.open(path, "rt") as f:
+        assert f.readline() == json.dumps(RECORDS[0]) + "\n"
+    assert (tmp_path / "data.jsonl.gz").stat().st_size < len(
+        "".join(json.dumps(x) + "\n" for x in RECORDS * 100)
+    )
+
+
+def test_close_with_final_path(tmp_path):
+    writer = jsonl.JsonlWriter(str(tmp_path / "data.jsonl.gz"))
+    writer.write(RECORDS[0])
+    with pytest.raises(ValueError):
+        writer.close(str(tmp_path / "data_1_to_2.jsonl"))
+    path = writer.close(str(tmp_path / "data_1_to_2.jsonl.gz"))
+    assert path == str(tmp_path / "data_1_to_2.jsonl.gz")
+    # Closing again is a no-op
+    assert writer.close() == path
+    assert list(jsonl.read_records(path)) == RECORDS[:1]
+    assert sorted(x.name for x in tmp_path.iterdir()) == [
+        "data_1_to_2.jsonl.gz"
+    ]
+
+
+def test_discarded_on_error(tmp_path):
+    with pytest.raises(RuntimeError):
+        with jsonl.JsonlWriter(str(tmp_path / "data.jsonl")) as writer:
+            writer.write(RECORDS[0])
+            raise RuntimeError()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_read_json_list(tmp_path):
+    path = tmp_path / "spl_history_pages.json"
+    path.write_text(json.dumps(RECORDS))
+    assert list(jsonl.read_records(str(path))) == RECORDS
+
+
+def test_read_missing_file(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        list(jsonl.read_records(str(tmp_path / "data.jsonl")))
+
+
+def test_unknown_compression():
+    with pytest.raises(ValueError):
+        jsonl.get_path("data", "bz2")
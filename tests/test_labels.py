@@ -1,12 +1,19 @@
+import io
 import json
 import os
+import re
 import pytest
+import time
 
 from spl.labels import (
+    LabelOptions,
     SplHistoricalLabels,
+    _exclude_stored_versions,
     process_labels_for_set_id,
     process_historical_labels,
 )
+from spl.records import SplHistoryRecord
+from utils import http_client, profiling
 
 TEST_DATA_DIR = os.path.join("tests", "testdata")
 TEMPDATA_DIR = os.path.join("tests", "tempdata")
@@ -40,14 +47,13 @@ def mock_fetch_and_process(monkeypatch):
 
 @pytest.fixture
 def mock_request(monkeypatch):
-    def mock_method(url, allow_redirects):
+    def mock_method(url):
         """This method expects to have been invoked with specific args, without
         which it will return None
         """
         if (
             url
             == "https://dailymed.nlm.nih.gov/dailymed/getFile.cfm?type=zip&setid=1b5e2860-6855-4a65-8bbc-e064172a1adf&version=1"
-            and allow_redirects == True
         ):
             content = None
             with open(
@@ -59,6 +65,8 @@ def mock_request(monkeypatch):
                 content = f.read()
             return MockResponse(content)
 
+    monkeypatch.setattr(http_client, "get", mock_method)
+
 
 def test_class_attributes():
     assert (
@@ -100,14 +108,279 @@ def test_init_method(setup_temp_datadir, mock_fetch_and_process):
     assert spl_history.called == True
 
 
-def test_fetch_and_process(setup_temp_datadir, mock_request):
+def test_init_method_parser(setup_temp_datadir, mock_fetch_and_process):
+    spl_data = {
+        "data": {
+            "spl": {"setid": "test-setid"},
+            "history": [{"spl_version": 1}],
+        }
+    }
+    with pytest.raises(ValueError):
+        _ = SplHistoricalLabels(spl_data, TEMPDATA_DIR, parser="bad_value")
+    labels = SplHistoricalLabels(spl_data, TEMPDATA_DIR, parser="lxml")
+    assert labels.parser == "lxml"
+    # The download path is not needed to process the labels in memory
+    labels = SplHistoricalLabels(spl_data, None, in_memory=True)
+    assert labels.in_memory == True
+    with pytest.raises(ValueError):
+        _ = SplHistoricalLabels(spl_data, TEMPDATA_DIR, version_workers=0)
+
+
+@pytest.mark.parametrize("parser", SplHistoricalLabels.PARSERS)
+def test_fetch_and_process(setup_temp_datadir, mock_request, parser):
+    spl_data = {
+        "data": {
+            "spl": {"setid": TEST_SET_ID},
+            "history": [{"spl_version": TEST_SET_SPL_VERSION}],
+        }
+    }
+    labels = SplHistoricalLabels(spl_data, TEMPDATA_DIR, parser=parser)
+
+    assert labels.application_numbers_for_setid == set(["21812"])
+    assert [
+        x.to_document() for x in labels.spl_label_versions
+    ] == _read_label_baseline()
+
+
+@pytest.mark.parametrize("parser", SplHistoricalLabels.PARSERS)
+def test_fetch_and_process_in_memory(monkeypatch, mock_request, parser):
+    def mock_mkdir(path):
+        raise AssertionError(f"Unexpected folder created at {path}")
+
+    monkeypatch.setattr(os, "mkdir", mock_mkdir)
     spl_data = {
         "data": {
             "spl": {"setid": TEST_SET_ID},
             "history": [{"spl_version": TEST_SET_SPL_VERSION}],
         }
     }
-    labels = SplHistoricalLabels(spl_data, TEMPDATA_DIR)
+    labels = SplHistoricalLabels(spl_data, None, parser=parser, in_memory=True)
 
     assert labels.application_numbers_for_setid == set(["21812"])
-    assert labels.spl_label_versions == _read_label_baseline()
+    assert [
+        x.to_document() for x in labels.spl_label_versions
+    ] == _read_label_baseline()
+
+
+@pytest.mark.parametrize(
+    "inserted",
+    [
+        "",
+        "<![CDATA[cdata text]]>",
+        "<![CDATA[multi-line\ncdata text]]>",
+        "<!-- a comment -->",
+        "<!-- a comment with <tag> in it -->",
+    ],
+)
+def test_parsers_match_on_nested_sections(
+    setup_temp_datadir, mock_fetch_and_process, tmp_path, inserted
+):
+    spl_data = {
+        "data": {
+            "spl": {"setid": "test-setid"},
+            "history": [{"spl_version": 1}],
+        }
+    }
+    with open(os.path.join(TEST_DATA_DIR, "test_label_nested.xml")) as f:
+        content = f.read()
+    # Inserted in the text of a sub-section
+    content = content.replace(
+        "Treatment of  hypertension.", f"Treatment of {inserted} hypertension."
+    )
+    xml_file_name = str(tmp_path / "test_label_nested.xml")
+    with open(xml_file_name, "w") as f:
+        f.write(content)
+    bs4_label, lxml_label = [
+        SplHistoricalLabels(spl_data, TEMPDATA_DIR, parser=p)._parse_label(
+            xml_file_name
+        )
+        for p in ["bs4", "lxml"]
+    ]
+    assert bs4_label == lxml_label
+    assert sorted(lxml_label.application_numbers) == ["12345", "20001"]
+    assert lxml_label.name == "Testamide XR"
+    assert [x.parent for x in lxml_label.sections] == [
+        None,
+        "1 INDICATIONS & USAGE",
+        "1 INDICATIONS & USAGE",
+        None,
+        None,
+    ]
+    assert not any(
+        "text" in x.text or "comment" in x.text for x in lxml_label.sections
+    )
+
+
+@pytest.mark.parametrize("parser", SplHistoricalLabels.PARSERS)
+def test_parse_label_without_product_data(
+    setup_temp_datadir, mock_fetch_and_process, parser
+):
+    spl_data = {
+        "data": {
+            "spl": {"setid": "test-setid"},
+            "history": [{"spl_version": 1}],
+        }
+    }
+    with open(os.path.join(TEST_DATA_DIR, "test_label_nested.xml")) as f:
+        content = f.read()
+    start = content.index("<manufacturedProduct>")
+    end = content.rindex("</manufacturedProduct>")
+    content = content[:start] + content[end + len("</manufacturedProduct>") :]
+    label = SplHistoricalLabels(
+        spl_data, TEMPDATA_DIR, parser=parser
+    )._parse_label(io.BytesIO(content.encode()), "test-spl-id")
+    # The metadata outside of the product data is still parsed
+    assert label.spl_id == "test-spl-id"
+    assert label.spl_version == "4"
+    assert label.application_numbers == ()
+    assert label.name == ""
+    assert label.generic_name == ""
+    assert label.active_ingredient == ""
+    assert len(label.sections) == 5
+
+
+@pytest.mark.parametrize("parser", SplHistoricalLabels.PARSERS)
+def test_parse_label_without_section_text(
+    setup_temp_datadir, mock_fetch_and_process, parser
+):
+    spl_data = {
+        "data": {
+            "spl": {"setid": "test-setid"},
+            "history": [{"spl_version": 1}],
+        }
+    }
+    with open(os.path.join(TEST_DATA_DIR, "test_label_nested.xml")) as f:
+        content = re.sub(r"<text\b.*?</text>", "", f.read(), flags=re.DOTALL)
+    labels = SplHistoricalLabels(spl_data, TEMPDATA_DIR, parser=parser)
+    with pytest.raises(LookupError, match="No text in the section"):
+        labels._parse_label(io.BytesIO(content.encode()), "test-spl-id")
+
+
+@pytest.fixture
+def mock_versioned_request(monkeypatch, versioned_label_zip):
+    def mock_method(url):
+        """Returns a zip file of the nested test label, with the version
+        number set to the requested version. Earlier versions take longer to
+        download, so that they complete out of order.
+        """
+        version = int(url.split("version=")[-1])
+        time.sleep(0.05 / version)
+        return MockResponse(versioned_label_zip(version))
+
+    monkeypatch.setattr(http_client, "get", mock_method)
+
+
+@pytest.mark.parametrize("in_memory", [False, True])
+def test_fetch_and_process_concurrent_versions(
+    setup_temp_datadir, mock_versioned_request, in_memory
+):
+    versions = [5, 1, 4, 2, 3]
+    spl_data = {
+        "data": {
+            "spl": {"setid": "test-setid"},
+            "history": [{"spl_version": v} for v in versions],
+        }
+    }
+    labels = SplHistoricalLabels(
+        spl_data, TEMPDATA_DIR, in_memory=in_memory, version_workers=3
+    )
+
+    assert [x.spl_version for x in labels.spl_label_versions] == list(
+        map(str, versions)
+    )
+    assert [x.spl_id for x in labels.spl_label_versions] == [
+        f"spl-{v}" for v in versions
+    ]
+    assert labels.application_numbers_for_setid == set(["12345", "20001"])
+
+
+def test_exclude_stored_versions(mongo_client):
+    mongo_client.stored = [
+        {"set_id": "a", "spl_version": "1", "application_numbers": ["1"]},
+        {"set_id": "a", "spl_version": "2", "application_numbers": ["1"]},
+        {"set_id": "b", "spl_version": "1", "application_numbers": ["2"]},
+    ]
+    all_setid_history = [
+        SplHistoryRecord(set_id, None, versions, (None,) * len(versions))
+        for set_id, versions in [("a", (3, 2, 1)), ("b", (1,)), ("c", (1,))]
+    ]
+    remaining = _exclude_stored_versions(all_setid_history)
+
+    # The stored versions of the batch are looked up in a single query
+    assert len(mongo_client.queries) == 1
+    assert [x.set_id for x in remaining] == ["a", "c"]
+    assert remaining[0].spl_versions == (3,)
+    assert remaining[0].published_dates == (None,)
+    assert remaining[0].stored_application_numbers == ("1",)
+    assert remaining[1] is all_setid_history[2]
+    # The input history is left unchanged
+    assert len(all_setid_history[0].spl_versions) == 3
+
+
+@pytest.mark.parametrize(
+    "stored_application_numbers, expected_update",
+    [(["12345", "20001"], False), (["12345"], True), (["99"], True)],
+)
+def test_process_labels_for_set_id_incremental(
+    mongo_client,
+    mock_versioned_request,
+    stored_application_numbers,
+    expected_update,
+):
+    set_id_history = SplHistoryRecord(
+        "test-setid",
+        None,
+        (3,),
+        (None,),
+        stored_application_numbers=tuple(stored_application_numbers),
+    )
+    assert process_labels_for_set_id(
+        set_id_history, LabelOptions(download_path=None, in_memory=True)
+    )
+
+    expected = set(stored_application_numbers) | {"12345", "20001"}
+    assert [x["spl_version"] for x in mongo_client.upserts] == ["3"]
+    assert set(mongo_client.upserts[0]["application_numbers"]) == expected
+    if expected_update:
+        # The new application numbers are applied to the stored versions
+        ((query, update),) = mongo_client.updates
+        assert query == {"set_id": "test-setid"}
+        assert set(update["$set"]["application_numbers"]) == expected
+    else:
+        assert mongo_client.updates == []
+
+
+@pytest.mark.parametrize("in_memory", [False, True])
+def test_process_labels_for_set_id_bad_zip(mongo_client, tmp_path, in_memory):
+    set_id_history = SplHistoryRecord("test-setid", None, (2, 1), (None,) * 2)
+    # The body of a 404 response in place of the zip file of version 2, and
+    # a download that failed for version 1
+    assert not process_labels_for_set_id(
+        set_id_history,
+        LabelOptions(download_path=str(tmp_path), in_memory=in_memory),
+        zip_contents={2: b"Not Found", 1: None},
+    )
+    assert mongo_client.upserts == []
+
+
+@pytest.mark.parametrize("version_workers", [1, 2])
+def test_process_labels_for_set_id_profiled(
+    mongo_client, mock_versioned_request, tmp_path, version_workers
+):
+    profiling.configure(str(tmp_path / "profile"))
+    try:
+        assert process_labels_for_set_id(
+            SplHistoryRecord("test-setid", None, (2, 1), (None, None)),
+            LabelOptions(
+                download_path=None,
+                in_memory=True,
+                version_workers=version_workers,
+            ),
+        )
+        stats = profiling.collect()
+    finally:
+        profiling.configure(None)
+    # The versions are parsed in the worker thread, or in threads of their
+    # own, and profiled either way
+    functions = {func[2] for func in stats.stats}
+    assert {"parse_label", "extract_label"} <= functions
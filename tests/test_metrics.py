@@ -0,0 +1,110 @@
+import json
+import os
+
+import pytest
+
+from utils import metrics
+from utils.scheduling import process_pool
+
+
+@pytest.fixture(autouse=True)
+def reset_metrics():
+    metrics._counters.clear()
+    metrics._histograms.clear()
+    yield
+    metrics.configure(None)
+    metrics._counters.clear()
+    metrics._histograms.clear()
+
+
+@metrics.flush_after
+def _work(item):
+    metrics.inc("items_total", stage="labels")
+    metrics.observe("parse_seconds", 0.002, stage="labels")
+    return os.getpid()
+
+
+def _get_counters_in_child():
+    counters, _ = metrics.collect()
+    return counters
+
+
+def test_counters_and_histograms():
+    metrics.inc("items_total", stage="index")
+    metrics.inc("items_total", 2, stage="index")
+    metrics.count_error("labels", ValueError("bad"))
+    for seconds in [0.0005, 0.003, 0.003, 100]:
+        metrics.observe("parse_seconds", seconds, stage="index")
+
+    counters, histograms = metrics.collect()
+    assert counters[("items_total", (("stage", "index"),))] == 3
+    assert (
+        counters[
+            ("errors_total", (("stage", "labels"), ("type", "ValueError")))
+        ]
+        == 1
+    )
+
+    summary = metrics.get_summary(counters, histograms)
+    parse = summary["parse_seconds"][0]
+    assert parse["count"] == 4
+    assert parse["p50"] == 0.005
+    # Above the largest bucket
+    assert parse["p99"] is None
+
+    with pytest.raises(ValueError):
+        metrics.inc("unknown_total")
+
+
+def test_prometheus_text():
+    metrics.inc("http_bytes_total", 100, stage="index")
+    metrics.observe("http_request_seconds", 0.2, stage="index")
+
+    text = metrics.get_prometheus_text(*metrics.collect())
+    assert "# TYPE dailymed_http_bytes_total counter" in text
+    assert 'dailymed_http_bytes_total{stage="index"} 100' in text
+    assert "# TYPE dailymed_http_request_seconds histogram" in text
+    assert (
+        'dailymed_http_request_seconds_bucket{stage="index",le="0.1"} 0' in text
+    )
+    assert (
+        'dailymed_http_request_seconds_bucket{stage="index",le="0.25"} 1'
+        in text
+    )
+    assert (
+        'dailymed_http_request_seconds_bucket{stage="index",le="+Inf"} 1'
+        in text
+    )
+    assert 'dailymed_http_request_seconds_count{stage="index"} 1' in text
+    # Metrics without values are left out
+    assert "dailymed_mongo_write_seconds" not in text
+
+
+def test_worker_metrics_are_merged(tmp_path):
+    metrics.configure(str(tmp_path / "workers"))
+    metrics.inc("items_total", stage="labels")
+
+    with process_pool(2) as executor:
+        pids = list(executor.map(_work, range(6)))
+    assert os.getpid() not in pids
+
+    json_path = str(tmp_path / "metrics.json")
+    prometheus_path = str(tmp_path / "metrics.prom")
+    metrics.write_reports(json_path, prometheus_path)
+
+    with open(json_path) as f:
+        summary = json.load(f)
+    # The parent's count was not inherited by the forked workers
+    assert summary["items_total"] == [
+        {"labels": {"stage": "labels"}, "value": 7}
+    ]
+    assert summary["parse_seconds"][0]["count"] == 6
+    with open(prometheus_path) as f:
+        assert 'dailymed_items_total{stage="labels"} 7' in f.read()
+
+
+def test_forked_process_starts_empty():
+    metrics.inc("items_total", stage="index")
+    with process_pool(1) as executor:
+        counters = executor.submit(_get_counters_in_child).result()
+    assert counters == {}
@@ -0,0 +1,132 @@
+import os
+
+import mongomock
+import pymongo
+import pytest
+
+from db import mongo
+from db.mongo import MongoClient
+from spl.labels import MONGO_INDEXES, MONGO_KEY_FIELDS
+from utils.scheduling import process_pool
+
+COLLECTION_NAME = "labels"
+
+
+@pytest.fixture
+def mongo_client():
+    return MongoClient(mongomock.MongoClient()["test"])
+
+
+def _label(spl_id, **fields):
+    return {"set_id": "test-setid", "spl_id": spl_id, **fields}
+
+
+def test_bulk_upsert(mongo_client):
+    assert (
+        mongo_client.bulk_upsert(COLLECTION_NAME, MONGO_KEY_FIELDS, []) is None
+    )
+    result = mongo_client.bulk_upsert(
+        COLLECTION_NAME,
+        MONGO_KEY_FIELDS,
+        [_label("spl-1", name="a"), _label("spl-2", name="b")],
+    )
+    assert result.upserted_count == 2
+
+    # Fields already stored are kept, and the new ones are set
+    mongo_client.db_client[COLLECTION_NAME].update_one(
+        {"spl_id": "spl-1"}, {"$set": {"extra": True}}
+    )
+    result = mongo_client.bulk_upsert(
+        COLLECTION_NAME,
+        MONGO_KEY_FIELDS,
+        [_label("spl-1", name="c"), _label("spl-3", name="d")],
+    )
+    assert result.upserted_count == 1
+    assert result.modified_count == 1
+    stored = {
+        x["spl_id"]: x
+        for x in mongo_client.find(COLLECTION_NAME, {}, projection={"_id": 0})
+    }
+    assert stored == {
+        "spl-1": _label("spl-1", name="c", extra=True),
+        "spl-2": _label("spl-2", name="b"),
+        "spl-3": _label("spl-3", name="d"),
+    }
+
+
+def test_create_indexes(mongo_client):
+    mongo_client.create_indexes(COLLECTION_NAME, MONGO_INDEXES)
+    # Creating the indexes again is a no-op
+    mongo_client.create_indexes(COLLECTION_NAME, MONGO_INDEXES)
+    index_keys = [
+        x["key"]
+        for x in mongo_client.db_client[COLLECTION_NAME]
+        .index_information()
+        .values()
+    ]
+    assert [("set_id", 1), ("spl_id", 1)] in index_keys
+    assert [("application_numbers", 1)] in index_keys
+
+    collection = mongo_client.db_client[COLLECTION_NAME]
+    collection.insert_one(_label("spl-1"))
+    with pytest.raises(pymongo.errors.DuplicateKeyError):
+        collection.insert_one(_label("spl-1"))
+
+
+def test_upsert(mongo_client):
+    mongo_client.upsert(COLLECTION_NAME, {"spl_id": "spl-1"}, _label("spl-1"))
+    mongo_client.upsert(
+        COLLECTION_NAME, {"spl_id": "spl-1"}, _label("spl-1", name="a")
+    )
+    assert list(
+        mongo_client.find(COLLECTION_NAME, [], projection={"_id": 0})
+    ) == [_label("spl-1", name="a")]
+
+
+def test_bulk_insert_new(mongo_client):
+    assert mongo_client.bulk_insert_new(COLLECTION_NAME, ["_id"], []) is None
+    result = mongo_client.bulk_insert_new(
+        COLLECTION_NAME, ["_id"], [{"_id": "a", "text": "1"}]
+    )
+    assert result.upserted_count == 1
+
+    # Documents already stored are left unchanged
+    result = mongo_client.bulk_insert_new(
+        COLLECTION_NAME,
+        ["_id"],
+        [{"_id": "a", "text": "2"}, {"_id": "b", "text": "3"}],
+    )
+    assert result.upserted_count == 1
+    assert result.modified_count == 0
+    assert list(mongo_client.find(COLLECTION_NAME, [])) == [
+        {"_id": "a", "text": "1"},
+        {"_id": "b", "text": "3"},
+    ]
+
+
+def _get_client_pid():
+    mongo.get_client()
+    return os.getpid(), mongo._client_pid
+
+
+def test_get_client_per_process(monkeypatch):
+    connections = []
+
+    def mock_connect():
+        connections.append(os.getpid())
+        return mongomock.MongoClient()["test"]
+
+    monkeypatch.setattr(mongo, "connect_mongo", mock_connect)
+    monkeypatch.setattr(mongo, "_client", None)
+    # Nothing connects until the client is first used
+    assert connections == []
+    client = mongo.get_client()
+    assert mongo.get_client() is client
+    assert connections == [os.getpid()]
+
+    # A forked worker does not reuse the client of the parent
+    with process_pool(1) as executor:
+        pid, client_pid = executor.submit(_get_client_pid).result()
+    assert pid != os.getpid()
+    assert client_pid == pid
+    assert mongo.get_client() is client
@@ -0,0 +1,221 @@
+import json
+import pytest
+
+from spl.history import SplHistoryResponse
+from spl.index import SplIndexFile, SplIndexRecord
+from spl.labels import SplHistoricalLabels
+from spl.pipeline import run_pipeline
+from utils.journal import (
+    HISTORY_STAGE,
+    INDEX_STAGE,
+    LABELS_STAGE,
+    ProgressJournal,
+)
+
+TEST_LABEL_SET_ID = "1b5e2860-6855-4a65-8bbc-e064172a1adf"
+
+
+def _index_page(page_num, total_pages, set_ids):
+    spls = "".join(
+        f"<spl><setid>{x}</setid><spl_version>1</spl_version></spl>"
+        for x in set_ids
+    )
+    return (
+        f"<spls><metadata><total_pages>{total_pages}</total_pages>"
+        f"<current_page>{page_num}</current_page></metadata>{spls}</spls>"
+    )
+
+
+def _history(set_id):
+    return json.dumps(
+        {
+            "data": {
+                "spl": {"setid": set_id},
+                "history": [{"spl_version": 1}],
+            },
+            "metadata": {"total_pages": 1},
+        }
+    )
+
+
+@pytest.fixture
+def stub_dailymed(monkeypatch, stub_server, file_mongo_client, read_test_data):
+    """Serves 3 index pages from the stub server, listing 4 distinct set IDs
+    of which only the test label set ID has a label zip file. Returns the
+    client storing the labels."""
+    monkeypatch.setattr(SplIndexFile, "BASE_URL", f"{stub_server.url}/spls.xml")
+    monkeypatch.setattr(
+        SplHistoryResponse, "BASE_URL", f"{stub_server.url}/spls"
+    )
+    monkeypatch.setattr(
+        SplHistoricalLabels,
+        "BASE_URL",
+        f"{stub_server.url}/getFile.cfm?type=zip",
+    )
+    pages = [
+        [TEST_LABEL_SET_ID, "set-id-1"],
+        ["set-id-2", TEST_LABEL_SET_ID],
+        ["set-id-3"],
+    ]
+    for page_num, set_ids in enumerate(pages, start=1):
+        stub_server.routes[f"/spls.xml?page={page_num}"] = (
+            200,
+            _index_page(page_num, len(pages), set_ids),
+        )
+        for set_id in set_ids:
+            stub_server.routes[f"/spls/{set_id}/history"] = (
+                200,
+                _history(set_id),
+            )
+    stub_server.routes[
+        f"/getFile.cfm?type=zip&setid={TEST_LABEL_SET_ID}&version=1"
+    ] = (200, read_test_data(f"{TEST_LABEL_SET_ID}_1.zip"))
+    return file_mongo_client
+
+
+@pytest.mark.parametrize("workers, queue_size", [(1, 1), (3, 2)])
+def test_run_pipeline(
+    stub_dailymed, stub_server, read_test_data, tmp_path, workers, queue_size
+):
+    end_page = run_pipeline(
+        str(tmp_path / "label_data"),
+        start_page=1,
+        num_pages=5,
+        in_memory=True,
+        workers=workers,
+        queue_size=queue_size,
+    )
+
+    assert end_page == 3
+    assert stub_dailymed.read_upserts() == json.loads(
+        read_test_data("baselines", "test_label.json")
+    )
+    # Each set ID's history is fetched once, though listed on two pages
+    history_requests = [x for x in stub_server.requests if "/history" in x]
+    assert sorted(history_requests) == sorted(set(history_requests))
+    assert len(history_requests) == 4
+    # The first index page is downloaded only once
+    assert stub_server.requests.count("/spls.xml?page=1") == 1
+
+
+def test_run_pipeline_set_ids(
+    stub_dailymed, stub_server, read_test_data, tmp_path
+):
+    end_page = run_pipeline(
+        str(tmp_path / "label_data"),
+        set_ids=[TEST_LABEL_SET_ID, "set-id-1"],
+        workers=2,
+    )
+
+    assert end_page is None
+    assert not any("/spls.xml" in x for x in stub_server.requests)
+    assert stub_dailymed.read_upserts() == json.loads(
+        read_test_data("baselines", "test_label.json")
+    )
+
+
+def test_run_pipeline_incremental(
+    stub_dailymed, stub_server, read_test_data, tmp_path
+):
+    stub_dailymed.stored = [
+        {"set_id": "set-id-1", "spl_version": 1},
+        {"set_id": "set-id-2", "spl_version": 1},
+    ]
+    run_pipeline(
+        str(tmp_path / "label_data"),
+        start_page=1,
+        num_pages=5,
+        in_memory=True,
+        incremental=True,
+        workers=2,
+    )
+
+    # The stored versions of all the set IDs are looked up in one query
+    assert len(stub_dailymed.queries) == 1
+    assert sorted(stub_dailymed.queries[0]["set_id"]["$in"]) == sorted(
+        [TEST_LABEL_SET_ID, "set-id-1", "set-id-2", "set-id-3"]
+    )
+    # The set IDs with every version stored are not processed
+    assert not any(
+        "setid=set-id-1" in x or "setid=set-id-2" in x
+        for x in stub_server.requests
+    )
+    assert stub_dailymed.read_upserts() == json.loads(
+        read_test_data("baselines", "test_label.json")
+    )
+
+
+def test_run_pipeline_resume(
+    stub_dailymed, stub_server, read_test_data, tmp_path
+):
+    # The journal of a run interrupted after processing index page 2, the
+    # test label set ID history and the set-id-1 labels
+    journal_path = str(tmp_path / "journal.sqlite")
+    journal = ProgressJournal(journal_path)
+    journal.record(
+        INDEX_STAGE,
+        2,
+        [
+            SplIndexRecord(x, "1", None, None)._asdict()
+            for x in ["set-id-2", TEST_LABEL_SET_ID]
+        ],
+    )
+    journal.record(
+        HISTORY_STAGE,
+        TEST_LABEL_SET_ID,
+        json.loads(_history(TEST_LABEL_SET_ID)),
+    )
+    journal.record(LABELS_STAGE, "set-id-1")
+    journal.close()
+
+    journal = ProgressJournal(journal_path, resume=True)
+    run_pipeline(
+        str(tmp_path / "label_data"),
+        start_page=1,
+        num_pages=5,
+        in_memory=True,
+        workers=2,
+        journal=journal,
+    )
+
+    assert sorted(x for x in stub_server.requests if "/spls" in x) == [
+        "/spls.xml?page=1",
+        "/spls.xml?page=3",
+        "/spls/set-id-2/history",
+        "/spls/set-id-3/history",
+    ]
+    assert stub_dailymed.read_upserts() == json.loads(
+        read_test_data("baselines", "test_label.json")
+    )
+    # The set IDs whose label zip files could not be downloaded are not
+    # recorded as completed
+    assert journal.get_completed(LABELS_STAGE) == {
+        TEST_LABEL_SET_ID,
+        "set-id-1",
+    }
+
+    # Resuming again downloads the first index page, and the labels of the
+    # set IDs not completed
+    stub_server.requests.clear()
+    run_pipeline(
+        str(tmp_path / "label_data"),
+        start_page=1,
+        num_pages=5,
+        in_memory=True,
+        workers=2,
+        journal=journal,
+    )
+    assert sorted(stub_server.requests) == [
+        "/getFile.cfm?type=zip&setid=set-id-2&version=1",
+        "/getFile.cfm?type=zip&setid=set-id-3&version=1",
+        "/spls.xml?page=1",
+    ]
+
+
+def test_run_pipeline_invalid_args(tmp_path):
+    with pytest.raises(ValueError):
+        run_pipeline(str(tmp_path), start_page=None)
+    with pytest.raises(ValueError):
+        run_pipeline(str(tmp_path), set_ids=[], workers=0)
+    with pytest.raises(ValueError):
+        run_pipeline(str(tmp_path), set_ids=[], queue_size=0)
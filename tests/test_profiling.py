@@ -0,0 +1,85 @@
+import concurrent.futures
+import os
+import pstats
+
+import pytest
+
+from utils import profiling
+from utils.scheduling import process_pool
+
+
+@pytest.fixture(autouse=True)
+def reset_profiling():
+    yield
+    profiling.configure(None)
+
+
+def _busy_work(n):
+    return sum(x * x for x in range(n))
+
+
+@profiling.profile_worker
+def _work(n):
+    return os.getpid(), _busy_work(n)
+
+
+def test_worker_profiles_are_merged(tmp_path):
+    profiling.configure(str(tmp_path / "workers"))
+    profiling.start()
+
+    with process_pool(2) as executor:
+        results = list(executor.map(_work, [10000] * 6))
+    assert os.getpid() not in [pid for pid, _ in results]
+
+    pstats_path = str(tmp_path / "profile.pstats")
+    report_path = str(tmp_path / "profile.txt")
+    profiling.write_report(pstats_path, report_path)
+
+    stats = pstats.Stats(pstats_path)
+    calls = {
+        func[2]: primitive_calls
+        for func, (primitive_calls, *_) in stats.stats.items()
+    }
+    # The workers' calls, and the parent's own
+    assert calls["_busy_work"] == 6
+    assert "test_worker_profiles_are_merged" not in calls
+    assert calls["map"] >= 1
+    with open(report_path) as f:
+        report = f.read()
+    assert "cumulative" in report
+    assert "_busy_work" in report
+
+
+@profiling.profile_thread
+def _thread_work(n):
+    return _busy_work(n)
+
+
+def test_thread_profiles_are_merged(tmp_path):
+    profiling.configure(str(tmp_path / "workers"))
+    profiling.start()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        assert (
+            list(executor.map(_thread_work, [10000] * 4))
+            == [_busy_work(10000)] * 4
+        )
+    # Called from the thread being profiled, the call is profiled as usual
+    _thread_work(10)
+
+    stats = profiling.collect()
+    calls = {
+        func[2]: primitive_calls
+        for func, (primitive_calls, *_) in stats.stats.items()
+    }
+    assert calls["_thread_work"] == 5
+    # The 4 calls in the threads, 1 from the test and 1 from _thread_work
+    assert calls["_busy_work"] == 6
+
+
+def test_not_profiled_without_folder(tmp_path):
+    assert _work(10)[1] == 285
+    profiling.write_report(
+        str(tmp_path / "profile.pstats"), str(tmp_path / "profile.txt")
+    )
+    assert not os.path.exists(tmp_path / "profile.pstats")
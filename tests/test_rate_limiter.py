@@ -0,0 +1,164 @@
+import multiprocessing
+import time
+
+import pytest
+
+from utils import http_client, rate_limiter
+from utils.scheduling import process_pool
+
+
+@pytest.fixture(autouse=True)
+def limiter_config(monkeypatch):
+    """Isolates the limiter and client options used by each test."""
+    config = dict(rate_limiter._config)
+    monkeypatch.setattr(http_client, "_config", dict(http_client._config))
+    monkeypatch.setattr(http_client, "_session", None)
+    http_client.configure(backoff_factor=0.01)
+    yield
+    rate_limiter._config.clear()
+    rate_limiter._config.update(config)
+    rate_limiter._reset()
+
+
+def _get_status(url):
+    return http_client.get(url).status_code
+
+
+def test_configure():
+    with pytest.raises(ValueError):
+        rate_limiter.configure(bad_option=1)
+    with pytest.raises(ValueError):
+        rate_limiter.configure(max_concurrency=0)
+    with pytest.raises(ValueError):
+        rate_limiter.configure(max_concurrency=4, rate=0)
+    rate_limiter.configure(initial_concurrency=10, max_concurrency=4, rate=None)
+    assert rate_limiter.get_stats()["concurrency_limit"] == 4
+
+
+def test_concurrency_limit_across_processes(stub_server):
+    rate_limiter.configure(initial_concurrency=2, max_concurrency=2)
+    stub_server.routes["/page"] = (200, "content")
+    stub_server.delay = 0.05
+    with process_pool(4) as executor:
+        statuses = list(
+            executor.map(_get_status, [f"{stub_server.url}/page"] * 12)
+        )
+    assert statuses == [200] * 12
+    assert stub_server.max_in_flight == 2
+    assert rate_limiter.get_stats()["in_flight"] == 0
+
+
+def test_reclaims_slots_of_exited_processes(monkeypatch):
+    monkeypatch.setattr(rate_limiter, "RECLAIM_INTERVAL", 0.05)
+    rate_limiter.configure(initial_concurrency=1, max_concurrency=1)
+    # A process that exits while its request is in flight
+    process = multiprocessing.Process(target=rate_limiter.acquire)
+    process.start()
+    process.join()
+    assert rate_limiter.get_stats()["in_flight"] == 1
+
+    # Waits until the slot of the exited process is reclaimed
+    start = rate_limiter.acquire()
+    assert rate_limiter.get_stats()["in_flight"] == 1
+    rate_limiter.release(start, "labels", 200)
+    assert rate_limiter.get_stats()["in_flight"] == 0
+
+
+def test_backs_off_when_throttled(stub_server):
+    rate_limiter.configure(initial_concurrency=8, max_concurrency=8)
+    http_client.configure(max_retries=0)
+    stub_server.routes["/throttled"] = (429, "slow down")
+    assert _get_status(f"{stub_server.url}/throttled") == 429
+    assert rate_limiter.get_stats() == {
+        "concurrency_limit": 4,
+        "in_flight": 0,
+        "decreases": 1,
+    }
+
+
+def test_backs_off_when_retried_after_throttling(stub_server):
+    rate_limiter.configure(initial_concurrency=8, max_concurrency=8)
+    statuses = [503, 200]
+    stub_server.routes["/flaky"] = lambda handler: (statuses.pop(0), "done")
+    assert _get_status(f"{stub_server.url}/flaky") == 200
+    assert rate_limiter.get_stats()["concurrency_limit"] == 4
+
+
+def test_burst_of_throttled_requests_backs_off_once():
+    rate_limiter.configure(initial_concurrency=8, max_concurrency=8)
+    starts = [rate_limiter.acquire() for _ in range(4)]
+    for start in starts:
+        rate_limiter.release(start, "labels", 429)
+    assert rate_limiter.get_stats()["concurrency_limit"] == 4
+
+    # A request sent after the decrease decreases the limit again
+    rate_limiter.release(rate_limiter.acquire(), "labels", None)
+    assert rate_limiter.get_stats()["concurrency_limit"] == 2
+
+
+def test_increases_while_healthy(stub_server):
+    rate_limiter.configure(
+        initial_concurrency=1, max_concurrency=3, latency_tolerance=1e9
+    )
+    stub_server.routes["/page"] = (200, "content")
+    for i in range(10):
+        assert _get_status(f"{stub_server.url}/page") == 200
+    # 1 + 1/1 + 1/2 + 1/2 + ... reaches the max
+    assert rate_limiter.get_stats()["concurrency_limit"] == 3
+
+
+def test_backs_off_on_rising_latency():
+    rate_limiter.configure(initial_concurrency=4, max_concurrency=4)
+    for _ in range(5):
+        rate_limiter.acquire()
+        rate_limiter.release(time.monotonic() - 0.01, "history", 200)
+    assert rate_limiter.get_stats()["decreases"] == 0
+
+    rate_limiter.acquire()
+    rate_limiter.release(time.monotonic() - 0.2, "history", 200)
+    assert rate_limiter.get_stats()["concurrency_limit"] == 2
+
+    # Other stages keep their own latencies
+    rate_limiter.acquire()
+    rate_limiter.release(time.monotonic() - 0.2, "labels", 200)
+    assert rate_limiter.get_stats()["decreases"] == 1
+
+
+def test_latency_to_headers():
+    rate_limiter.configure(initial_concurrency=4, max_concurrency=4)
+    for _ in range(5):
+        start = rate_limiter.acquire()
+        rate_limiter.release(start, "labels", 200, latency=0.01)
+    # A request whose large body took long to download, with the headers
+    # received as soon as usual
+    start = rate_limiter.acquire()
+    time.sleep(0.2)
+    rate_limiter.release(start, "labels", 200, latency=0.01)
+    assert rate_limiter.get_stats()["decreases"] == 0
+
+
+def test_get_passes_latency_to_headers(monkeypatch, stub_server):
+    releases = []
+    release = rate_limiter.release
+
+    def record_release(start, stage, status, throttled, latency):
+        releases.append(latency)
+        release(start, stage, status, throttled, latency)
+
+    monkeypatch.setattr(rate_limiter, "release", record_release)
+    stub_server.routes["/old"] = (302, "", {"Location": "/page"})
+    stub_server.routes["/page"] = (200, "content")
+    stub_server.delay = 0.1
+    start = time.monotonic()
+    assert _get_status(f"{stub_server.url}/old") == 200
+    # Both responses count, and no more than the whole request took
+    assert 0.2 <= releases[0] <= time.monotonic() - start
+
+
+def test_rate_limit():
+    rate_limiter.configure(rate=50)
+    start = time.monotonic()
+    for _ in range(11):
+        rate_limiter.release(rate_limiter.acquire(), "index", 200)
+    # The first request is sent at once, then one every 20ms
+    assert time.monotonic() - start >= 0.19
@@ -0,0 +1,46 @@
+import json
+import pickle
+
+from spl.records import LabelVersion, SplHistoryRecord, SplIndexRecord
+
+
+def test_history_record_from_json(read_test_data):
+    spl_history = SplHistoryRecord.from_json(
+        json.loads(read_test_data("test_history.json"))
+    )
+    assert spl_history.set_id == "9525f887-a055-4e33-8e92-898d42828cd1"
+    assert spl_history.title.startswith("VITRAKVI")
+    assert spl_history.spl_versions == (3, 1)
+    assert spl_history.published_dates == ("May 02, 2019", "Dec 06, 2018")
+    assert spl_history.stored_application_numbers == ()
+
+    # Round trips through its own JSON data, as written to the data files
+    data = json.loads(json.dumps(spl_history.to_json()))
+    assert data["spl_versions"] == [3, 1]
+    assert SplHistoryRecord.from_json(data) == spl_history
+
+    spl_history = spl_history._replace(stored_application_numbers=("1",))
+    assert SplHistoryRecord.from_json(spl_history.to_json()) == spl_history
+
+    # Selecting versions keeps each version number with its date
+    selected = spl_history.select_versions(lambda x: x != 3)
+    assert selected.spl_versions == (1,)
+    assert selected.published_dates == ("Dec 06, 2018",)
+    assert selected.stored_application_numbers == ("1",)
+
+
+def test_label_version_documents(read_test_data):
+    documents = json.loads(read_test_data("baselines", "test_label.json"))
+    labels = [LabelVersion.from_document(x) for x in documents]
+    assert [x.to_document() for x in labels] == documents
+    assert labels[0].sections[0].name == documents[0]["sections"][0]["name"]
+
+
+def test_records_have_no_dict():
+    records = [
+        SplIndexRecord("set-id", "1", "2021-01-01", "title"),
+        SplHistoryRecord("set-id", "title", (1,), ("May 02, 2019",)),
+    ]
+    for record in records:
+        assert not hasattr(record, "__dict__")
+        assert pickle.loads(pickle.dumps(record)) == record
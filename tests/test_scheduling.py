@@ -0,0 +1,92 @@
+import concurrent.futures
+import multiprocessing
+import threading
+
+import pytest
+
+from utils.scheduling import (
+    map_longest_first,
+    order_longest_first,
+    process_pool,
+)
+
+# Shared with the workers that are forked, but created anew by the workers
+# that import this module
+_counter = multiprocessing.Value("i", 0)
+
+
+def _increment_counter():
+    with _counter.get_lock():
+        _counter.value += 1
+
+
+def test_order_longest_first():
+    items = [("a", 1), ("b", 3), ("c", 1), ("d", 2)]
+    assert order_longest_first(items, lambda x: x[1]) == [
+        ("b", 3),
+        ("d", 2),
+        ("a", 1),
+        ("c", 1),
+    ]
+
+
+def test_map_longest_first():
+    started = []
+
+    def fn(cost):
+        started.append(cost)
+        return cost * 10
+
+    # With a single worker, the tasks run in the order they are submitted
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        results = list(
+            map_longest_first(executor, fn, [1, 2, 5, 3], lambda x: x)
+        )
+    assert started == [5, 3, 2, 1]
+    assert results == [(5, 50), (3, 30), (2, 20), (1, 10)]
+
+
+def test_map_longest_first_as_completed():
+    release = threading.Event()
+
+    def fn(cost):
+        if cost == 5:
+            release.wait(5)
+        return cost
+
+    # The results of the short tasks are not held back by the long one
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        items = []
+        for item, _ in map_longest_first(
+            executor, fn, [1, 2, 5, 3], lambda x: x
+        ):
+            items.append(item)
+            if len(items) == 3:
+                release.set()
+    assert sorted(items[:3]) == [1, 2, 3]
+    assert items[3] == 5
+
+
+def test_map_longest_first_error():
+    def fn(cost):
+        if cost == 2:
+            raise ValueError("bad item")
+        return cost
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        with pytest.raises(ValueError):
+            list(map_longest_first(executor, fn, [1, 2, 3], lambda x: x))
+
+
+def test_process_pool_forks():
+    start_method = multiprocessing.get_start_method()
+    multiprocessing.set_start_method("spawn", force=True)
+    try:
+        with process_pool(2) as executor:
+            futures = [executor.submit(_increment_counter) for _ in range(3)]
+            for future in futures:
+                future.result()
+    finally:
+        multiprocessing.set_start_method(start_method, force=True)
+    # The workers are forked even though spawn is the default
+    assert _counter.value == 3
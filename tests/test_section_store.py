@@ -0,0 +1,93 @@
+import copy
+
+import mongomock
+import pytest
+
+from db.mongo import MongoClient
+import spl.labels
+from spl.labels import _store_labels, find_labels
+from spl.records import LabelSection, LabelVersion
+from spl.section_store import (
+    SECTIONS_COLLECTION_NAME,
+    get_text_hash,
+    join_sections,
+    split_sections,
+)
+
+
+def _label_version(spl_id, version, texts):
+    return LabelVersion(
+        application_numbers=("12345",),
+        set_id="test-setid",
+        spl_version=version,
+        published_date="2021-01-01",
+        name="Testamide",
+        generic_name="",
+        active_ingredient="",
+        spl_id=spl_id,
+        sections=(
+            LabelSection("INDICATIONS", texts[0], None),
+            LabelSection("1.1 Adults", texts[1], "INDICATIONS"),
+        ),
+    )
+
+
+LABEL_VERSIONS = [
+    _label_version("spl-1", "1", ["Treats pain.", "Once a day."]),
+    _label_version("spl-2", "2", ["Treats pain.", "Twice a day."]),
+]
+# As stored in MongoDB
+LABELS = [x.to_document() for x in LABEL_VERSIONS]
+
+
+@pytest.fixture
+def mongo_client(monkeypatch):
+    mongo_client = MongoClient(mongomock.MongoClient()["test"])
+    monkeypatch.setattr(spl.labels, "_mongo_client", mongo_client)
+    return mongo_client
+
+
+def test_split_and_join_sections():
+    labels = copy.deepcopy(LABELS)
+    split_labels, texts = split_sections(labels)
+
+    assert len(texts) == 3
+    assert split_labels[0]["sections"][0] == {
+        "name": "INDICATIONS",
+        "parent": None,
+        "text_hash": get_text_hash("Treats pain."),
+    }
+    assert (
+        split_labels[0]["sections"][0]["text_hash"]
+        == split_labels[1]["sections"][0]["text_hash"]
+    )
+    # The labels passed in are left unchanged
+    assert labels == LABELS
+
+    assert join_sections(split_labels, texts) == LABELS
+    # Labels stored with their section texts are returned as they are
+    assert join_sections(LABELS, {}) == LABELS
+
+
+def test_store_and_find_labels(mongo_client):
+    _store_labels(LABEL_VERSIONS, dedup_sections=True)
+    # Storing a label again does not store its section texts again
+    _store_labels(LABEL_VERSIONS[1:], dedup_sections=True)
+
+    db = mongo_client.db_client
+    assert db[SECTIONS_COLLECTION_NAME].count_documents({}) == 3
+    stored = db[spl.labels.MONGO_COLLECTION_NAME].find_one({"spl_id": "spl-1"})
+    assert all("text" not in x for x in stored["sections"])
+
+    found = list(find_labels({"set_id": "test-setid"}, {"_id": False}))
+    assert sorted(found, key=lambda x: x["spl_id"]) == LABELS
+
+
+def test_find_labels_stored_with_texts(mongo_client, monkeypatch):
+    monkeypatch.setattr(spl.labels, "FIND_LABELS_BATCH_SIZE", 1)
+    _store_labels(LABEL_VERSIONS)
+
+    db = mongo_client.db_client
+    assert db[SECTIONS_COLLECTION_NAME].count_documents({}) == 0
+    found = list(find_labels({}, {"_id": False}))
+    assert sorted(found, key=lambda x: x["spl_id"]) == LABELS
@@ -0,0 +1,100 @@
+import os
+import random
+import string
+import zipfile
+
+import cleantext
+from lxml import etree
+import pytest
+
+from spl.labels import SplHistoricalLabels
+from spl.section_titles import SectionTitleMatcher, normalize_title
+
+TEST_DATA_DIR = os.path.join("tests", "testdata")
+
+
+def _clean_text_title(text):
+    # The normalization previously applied to every title
+    return cleantext.clean(
+        text.upper().replace("&", "AND").replace("\t", " "),
+        lower=False,
+        no_line_breaks=True,
+        no_punct=True,
+        no_numbers=True,
+        no_digits=True,
+        replace_with_number="",
+        replace_with_digit="",
+    )
+
+
+def _get_test_label_titles():
+    titles = []
+    with zipfile.ZipFile(
+        os.path.join(
+            TEST_DATA_DIR, "1b5e2860-6855-4a65-8bbc-e064172a1adf_1.zip"
+        )
+    ) as zip_obj:
+        xml_names = [x for x in zip_obj.namelist() if x.endswith(".xml")]
+        for xml_name in xml_names:
+            root = etree.fromstring(zip_obj.read(xml_name))
+            titles.extend(
+                "".join(x.itertext())
+                for x in root.iter("{urn:hl7-org:v3}title")
+            )
+    with open(os.path.join(TEST_DATA_DIR, "test_label_nested.xml"), "rb") as f:
+        root = etree.fromstring(f.read())
+        titles.extend(
+            "".join(x.itertext()) for x in root.iter("{urn:hl7-org:v3}title")
+        )
+    return titles
+
+
+# cleantext warns on backslashes in titles, through its unicode-escape step
+@pytest.mark.filterwarnings("ignore::DeprecationWarning")
+@pytest.mark.parametrize(
+    "title",
+    _get_test_label_titles()
+    + [
+        "1 INDICATIONS & USAGE",
+        "2.1\tDosage and Administration",
+        "Uses: see `label` (1,000.5 mg)",
+        "WARNINGS: :X: :OK:",
+        "Indicaciones y uso – niños",
+        "Active ingredient (in each tablet)",
+        "Purpose\\n",
+        "",
+    ],
+)
+def test_normalize_title(title):
+    assert normalize_title(title) == _clean_text_title(title)
+
+
+@pytest.mark.filterwarnings("ignore::DeprecationWarning")
+def test_normalize_title_random():
+    rng = random.Random(0)
+    alphabet = (
+        string.ascii_letters + string.digits * 3 + string.punctuation + " \t\n"
+    )
+    for _ in range(2000):
+        title = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 30)))
+        assert normalize_title(title) == _clean_text_title(title)
+
+
+def test_normalize_title_is_memoized():
+    normalize_title.cache_clear()
+    for _ in range(3):
+        normalize_title("1 INDICATIONS & USAGE")
+    assert normalize_title.cache_info().hits == 2
+
+
+def test_section_title_matcher():
+    matcher = SectionTitleMatcher(
+        SplHistoricalLabels.LABEL_SECTIONS,
+        aliases={"Indications and use": "INDICATIONS AND USAGE"},
+    )
+    assert matcher.match("1 INDICATIONS & USAGE") == "INDICATIONS AND USAGE"
+    assert matcher.match("Indications and use:") == "INDICATIONS AND USAGE"
+    assert matcher.match("Uses") is None
+    assert matcher.match("Use") == "USE"
+    with pytest.raises(ValueError):
+        SectionTitleMatcher(["USE"], aliases={"Uses": "DIRECTIONS"})
@@ -0,0 +1,33 @@
+import subprocess
+import sys
+
+# Only needed by the label stage, and slow to import
+LABEL_STAGE_MODULES = ["aiohttp", "bs4", "cleantext", "pymongo", "spl.labels"]
+
+
+def test_index_stage_imports():
+    # Starting the CLI and the index and history stages must not import the
+    # label stage, nor connect to MongoDB
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys, main, spl.index, spl.history; "
+            "print(' '.join(sys.modules))",
+        ],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    modules = result.stdout.split()
+    assert [x for x in LABEL_STAGE_MODULES if x in modules] == []
+    assert "mongodb" not in result.stderr
+
+
+def test_help():
+    result = subprocess.run(
+        [sys.executable, "main.py", "-h"], capture_output=True, text=True
+    )
+    assert result.returncode == 0
+    assert "--start_page" in result.stdout
+    assert "mongodb" not in result.stderr
@@ -0,0 +1,126 @@
+import asyncio
+
+from utils import http_cache, http_client, metrics
+from utils.logging import getLogger
+
+_logger = getLogger(__name__)
+
+# Optional dependency, only needed when fetching with asyncio. It is slow to
+# import, so it is imported by the first AsyncFetcher created.
+aiohttp = None
+
+
+def _import_aiohttp():
+    global aiohttp
+    if aiohttp is None:
+        try:
+            import aiohttp as module
+        except ImportError:
+            raise ImportError("aiohttp is required to fetch with asyncio")
+        aiohttp = module
+
+
+class AsyncFetcher:
+    """
+    Downloads URLs using asyncio, keeping at most max_concurrency requests in
+    flight across all the fetches made through the same instance. This allows
+    a single process to keep hundreds of downloads going, while the parsing of
+    the downloaded data is handed to a separate pool of processes.
+
+    Usage:
+        async with AsyncFetcher(max_concurrency=200) as fetcher:
+            contents = await fetcher.fetch_all(urls)
+    """
+
+    def __init__(self, max_concurrency=100, timeout=300):
+        if not isinstance(max_concurrency, int) or max_concurrency < 1:
+            raise ValueError("Max concurrency must be a positive integer")
+        _import_aiohttp()
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        # Attributes to track the requests
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._semaphore = None
+        self._session = None
+
+    async def __aenter__(self):
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.max_concurrency),
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+        )
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._session.close()
+
+    async def fetch(self, url):
+        """Downloads the content at the URL. When the response cache is
+        enabled, fresh cached responses are returned without a request, and
+        stale ones are revalidated with the server.
+
+        Args:
+            url (str): the URL to download
+
+        Returns:
+            bytes: the content downloaded, or None if the request failed
+        """
+        stage = http_client.get_stage(url)
+        cache = http_cache.get_cache()
+        entry = None
+        if cache is not None:
+            entry = cache.lookup(url)
+            if entry is not None and cache.is_fresh(entry):
+                metrics.inc("http_cache_hits_total", stage=stage)
+                return entry["content"]
+
+        async with self._semaphore:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            try:
+                with metrics.timer("http_request_seconds", stage=stage):
+                    async with self._session.get(
+                        url,
+                        allow_redirects=True,
+                        headers=http_cache.ResponseCache.conditional_headers(
+                            entry
+                        ),
+                    ) as r:
+                        content = await r.read()
+                        status, headers = r.status, r.headers
+            except Exception as e:
+                _logger.error(f"Unable to fetch {url}: {e}")
+                metrics.count_error(stage, e)
+                return None
+            finally:
+                self.in_flight -= 1
+        metrics.inc("http_bytes_total", len(content), stage=stage)
+        if status >= 400:
+            metrics.count_error(stage, f"HTTP {status}")
+
+        if cache is not None:
+            if status == 304 and entry is not None:
+                # Not modified since it was cached
+                cache.revalidated(url)
+                return entry["content"]
+            if status == 200:
+                cache.store(
+                    url,
+                    content,
+                    etag=headers.get("ETag"),
+                    last_modified=headers.get("Last-Modified"),
+                )
+        return content
+
+    async def fetch_all(self, urls):
+        """Downloads the content at each of the URLs concurrently.
+
+        Args:
+            urls (list[str]): the URLs to download
+
+        Returns:
+            list[bytes]: the content downloaded from each URL, in order. The
+                         content is None for the requests that failed.
+        """
+        return await asyncio.gather(*map(self.fetch, urls))
@@ -0,0 +1,274 @@
+"""
+Persistent on-disk cache for the responses downloaded from DailyMed.
+
+Response bodies are stored once per distinct content, in files named by the
+SHA-256 digest of the content. A SQLite index maps each URL to its body, along
+with the ETag/Last-Modified validators sent by the server and the access
+times used for LRU eviction once the cache grows beyond its size cap.
+
+Resources that never change (the label zip file of a set id + version) are
+cached permanently. Other resources, such as the SPL index pages and the set
+id history, are only served from the cache for a configurable TTL; after
+that, they are revalidated with a conditional request.
+"""
+
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from utils.logging import getLogger
+
+_logger = getLogger(__name__)
+
+# URLs of resources that never change once published
+IMMUTABLE_URL_PATTERNS = [
+    re.compile(r"/getFile\.cfm\?(?=.*\bsetid=)(?=.*\bversion=)"),
+]
+
+_config = {
+    "folder": None,
+    "max_bytes": 2 * 1024**3,
+    "ttl": 24 * 60 * 60,
+}
+
+_cache = None
+_cache_pid = None
+_cache_lock = threading.Lock()
+
+
+class CachedResponse:
+    """A response served from the cache, with the same attributes used from
+    requests.Response."""
+
+    def __init__(self, url, content, headers=None):
+        self.url = url
+        self.content = content
+        self.status_code = 200
+        self.headers = headers or {}
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class ResponseCache:
+    """
+    Used to store and look up downloaded responses by URL, in the given
+    folder. Safe to use from several threads and processes at once.
+    """
+
+    def __init__(self, folder, max_bytes, ttl):
+        if not folder:
+            raise ValueError("Cache folder is not defined")
+        if not isinstance(max_bytes, int) or max_bytes < 1:
+            raise ValueError("Cache size must be a positive integer")
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        os.makedirs(os.path.join(folder, "bodies"), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            os.path.join(folder, "index.sqlite"),
+            timeout=60,
+            check_same_thread=False,
+            isolation_level=None,
+        )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "url TEXT PRIMARY KEY, digest TEXT NOT NULL, size INTEGER NOT NULL, "
+            "etag TEXT, last_modified TEXT, permanent INTEGER NOT NULL, "
+            "fetched_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS entries_accessed_at "
+            "ON entries (accessed_at)"
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS entries_digest ON entries (digest)"
+        )
+
+    @staticmethod
+    def is_immutable(url):
+        return any(x.search(url) for x in IMMUTABLE_URL_PATTERNS)
+
+    def _body_path(self, digest):
+        return os.path.join(self.folder, "bodies", digest[:2], digest)
+
+    def lookup(self, url):
+        """Returns the cache entry of the URL, or None.
+
+        Args:
+            url (str): the URL downloaded
+
+        Returns:
+            dict: the cache entry, with the response content
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT digest, etag, last_modified, permanent, fetched_at "
+                "FROM entries WHERE url = ?",
+                (url,),
+            ).fetchone()
+            if row is None:
+                return None
+            self._db.execute(
+                "UPDATE entries SET accessed_at = ? WHERE url = ?",
+                (time.time(), url),
+            )
+        digest, etag, last_modified, permanent, fetched_at = row
+        try:
+            with open(self._body_path(digest), "rb") as f:
+                content = f.read()
+        except FileNotFoundError:
+            # Evicted by another process in the meantime
+            return None
+        return {
+            "content": content,
+            "etag": etag,
+            "last_modified": last_modified,
+            "permanent": bool(permanent),
+            "fetched_at": fetched_at,
+        }
+
+    def is_fresh(self, entry):
+        """Whether the entry can be used without revalidating it."""
+        return (
+            entry["permanent"] or time.time() - entry["fetched_at"] < self.ttl
+        )
+
+    @staticmethod
+    def conditional_headers(entry):
+        """Returns the headers used to revalidate the entry with the server."""
+        headers = {}
+        if entry is not None:
+            if entry["etag"]:
+                headers["If-None-Match"] = entry["etag"]
+            if entry["last_modified"]:
+                headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def revalidated(self, url):
+        """Marks the entry of the URL as fresh, after the server confirmed
+        that it has not changed (304 Not Modified)."""
+        with self._lock:
+            self._db.execute(
+                "UPDATE entries SET fetched_at = ? WHERE url = ?",
+                (time.time(), url),
+            )
+
+    def store(self, url, content, etag=None, last_modified=None):
+        """Saves the response content of the URL to the cache, evicting the
+        least recently used entries if the cache grows beyond its size cap.
+
+        Args:
+            url (str): the URL downloaded
+            content (bytes): the response content
+            etag (str, optional): the ETag header of the response
+            last_modified (str, optional): the Last-Modified header of the
+                                           response
+        """
+        if len(content) > self.max_bytes:
+            return
+        digest = hashlib.sha256(content).hexdigest()
+        body_path = self._body_path(digest)
+        if not os.path.exists(body_path):
+            os.makedirs(os.path.dirname(body_path), exist_ok=True)
+            # Write atomically, so that readers never see a partial body
+            temp_path = f"{body_path}.{os.getpid()}.{threading.get_ident()}"
+            with open(temp_path, "wb") as f:
+                f.write(content)
+            os.replace(temp_path, body_path)
+        now = time.time()
+        with self._lock:
+            previous = self._db.execute(
+                "SELECT digest FROM entries WHERE url = ?", (url,)
+            ).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    url,
+                    digest,
+                    len(content),
+                    etag,
+                    last_modified,
+                    int(self.is_immutable(url)),
+                    now,
+                    now,
+                ),
+            )
+            if previous is not None and previous[0] != digest:
+                self._delete_body_if_unused(previous[0])
+            self._evict()
+
+    def _delete_body_if_unused(self, digest):
+        in_use = self._db.execute(
+            "SELECT 1 FROM entries WHERE digest = ? LIMIT 1", (digest,)
+        ).fetchone()
+        if not in_use:
+            try:
+                os.remove(self._body_path(digest))
+            except FileNotFoundError:
+                pass
+
+    def _evict(self):
+        # Sizes are counted per entry, so bodies shared by several URLs are
+        # counted more than once; this errs on the side of a smaller cache
+        total = self._db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM entries"
+        ).fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for url, digest, size in self._db.execute(
+            "SELECT url, digest, size FROM entries ORDER BY accessed_at"
+        ).fetchall():
+            self._db.execute("DELETE FROM entries WHERE url = ?", (url,))
+            self._delete_body_if_unused(digest)
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def get_size(self):
+        """Returns the total size of the cached responses, in bytes."""
+        with self._lock:
+            return self._db.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM entries"
+            ).fetchone()[0]
+
+
+def configure(folder=None, max_bytes=None, ttl=None):
+    """
+    Enables the response cache, or disables it when folder is None. Call this
+    before any worker processes are started, so that they inherit the options.
+
+    Args:
+        folder (str, optional): the folder to store the cache in
+        max_bytes (int, optional): the size cap of the cache
+        ttl (float, optional): seconds for which mutable resources are served
+                               from the cache without revalidating them
+    """
+    global _cache
+    _config["folder"] = folder
+    if max_bytes is not None:
+        _config["max_bytes"] = max_bytes
+    if ttl is not None:
+        _config["ttl"] = ttl
+    _cache = None
+
+
+def get_cache():
+    """Returns the response cache of the current process, or None if the
+    cache is not enabled. Each process uses its own database connection."""
+    global _cache, _cache_pid
+    if not _config["folder"]:
+        return None
+    with _cache_lock:
+        if _cache is None or _cache_pid != os.getpid():
+            _cache = ResponseCache(
+                _config["folder"], _config["max_bytes"], _config["ttl"]
+            )
+            _cache_pid = os.getpid()
+        return _cache
@@ -0,0 +1,268 @@
+"""
+Shared HTTP client for the requests made to DailyMed.
+
+Each process holds a single requests.Session, so that connections are pooled
+and kept alive between requests, instead of a new TCP + TLS handshake being
+made for every index page, history and label download. Requests are made with
+connect/read timeouts and are retried with exponential backoff on 429 and 5xx
+responses.
+
+Requests are sent within the concurrency and rate limits of the rate limiter,
+shared by all processes, which backs off when DailyMed throttles them.
+
+The request counters are kept in shared memory, created when this module is
+first imported. Worker processes forked after that point update the same
+counters, so the totals reported by the parent process cover all workers.
+"""
+
+import multiprocessing
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+
+from utils import http_cache, metrics, rate_limiter
+from utils.logging import getLogger
+
+_logger = getLogger(__name__)
+
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+
+# The stage of the run downloading each kind of URL, for the metrics
+STAGE_URL_PATTERNS = [
+    ("index", "/spls.xml"),
+    ("history", "/history"),
+    ("labels", "/getFile.cfm"),
+]
+
+_config = {
+    "connect_timeout": 10,
+    "read_timeout": 120,
+    "max_retries": 5,
+    "backoff_factor": 0.5,
+    "pool_maxsize": 10,
+}
+
+_stats = {
+    name: multiprocessing.Value("q", 0)
+    for name in [
+        "requests",
+        "connections",
+        "retries",
+        "cache_hits",
+        "cache_revalidations",
+    ]
+}
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+# Whether the request of the current thread was throttled and retried
+_throttled = threading.local()
+
+
+def _increment(name):
+    with _stats[name].get_lock():
+        _stats[name].value += 1
+
+
+class _CountingRetry(Retry):
+    def increment(self, *args, **kwargs):
+        # Raises once the retries are exhausted, so only retries made count
+        retry = super().increment(*args, **kwargs)
+        _increment("retries")
+        response = kwargs.get("response")
+        if response is not None and (
+            response.status in rate_limiter.THROTTLE_STATUSES
+        ):
+            _throttled.value = True
+        return retry
+
+
+class _CountingPoolMixin:
+    def _new_conn(self):
+        _increment("connections")
+        return super()._new_conn()
+
+    def _make_request(self, *args, **kwargs):
+        # Called for each request sent, including retries and redirects
+        _increment("requests")
+        return super()._make_request(*args, **kwargs)
+
+
+class _CountingHTTPConnectionPool(_CountingPoolMixin, HTTPConnectionPool):
+    pass
+
+
+class _CountingHTTPSConnectionPool(_CountingPoolMixin, HTTPSConnectionPool):
+    pass
+
+
+class _CountingHTTPAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _CountingHTTPConnectionPool,
+            "https": _CountingHTTPSConnectionPool,
+        }
+
+
+def configure(**kwargs):
+    """
+    Sets the client options. Call this before any worker processes are
+    started, so that they inherit the options.
+
+    Args:
+        connect_timeout (float, optional): seconds to wait for a connection
+        read_timeout (float, optional): seconds to wait for response data
+        max_retries (int, optional): retries on connection errors and on
+                                     429/5xx responses
+        backoff_factor (float, optional): the backoff between retries is
+                                          backoff_factor * 2 ** (retry - 1)
+                                          seconds
+        pool_maxsize (int, optional): connections kept alive per host
+
+    Raises:
+        ValueError: When an unknown option is given
+    """
+    global _session
+    for key, value in kwargs.items():
+        if key not in _config:
+            raise ValueError(f"Unknown HTTP client option: {key}")
+        if value is not None:
+            _config[key] = value
+    # Start over with a session using the new options
+    _session = None
+
+
+def _make_session():
+    retry = _CountingRetry(
+        total=_config["max_retries"],
+        backoff_factor=_config["backoff_factor"],
+        status_forcelist=RETRY_STATUSES,
+        # Return the last response once the retries are exhausted, rather
+        # than raising, like a plain requests.get
+        raise_on_status=False,
+    )
+    adapter = _CountingHTTPAdapter(
+        max_retries=retry,
+        pool_connections=_config["pool_maxsize"],
+        pool_maxsize=_config["pool_maxsize"],
+    )
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_session():
+    """Returns the requests.Session of the current process, creating it on
+    first use. Sessions are never shared across processes."""
+    global _session, _session_pid
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            _session = _make_session()
+            _session_pid = os.getpid()
+        return _session
+
+
+def get_stage(url):
+    """Returns the stage of the run downloading the URL, e.g. "index"."""
+    for stage, pattern in STAGE_URL_PATTERNS:
+        if pattern in url:
+            return stage
+    return "other"
+
+
+def get(url):
+    """Makes a GET request with the shared session, following redirects.
+    When the response cache is enabled, fresh cached responses are returned
+    without a request, and stale ones are revalidated with the server.
+
+    Args:
+        url (str): the URL to download
+
+    Returns:
+        requests.Response: the response
+    """
+    stage = get_stage(url)
+    cache = http_cache.get_cache()
+    entry = None
+    if cache is not None:
+        entry = cache.lookup(url)
+        if entry is not None and cache.is_fresh(entry):
+            _increment("cache_hits")
+            metrics.inc("http_cache_hits_total", stage=stage)
+            return http_cache.CachedResponse(url, entry["content"])
+
+    start = rate_limiter.acquire()
+    _throttled.value = False
+    status = None
+    latency = None
+    try:
+        with metrics.timer("http_request_seconds", stage=stage):
+            r = get_session().get(
+                url,
+                allow_redirects=True,
+                timeout=(_config["connect_timeout"], _config["read_timeout"]),
+                headers=http_cache.ResponseCache.conditional_headers(entry),
+            )
+        status = r.status_code
+        # The time until the headers of each response, redirects included,
+        # were received: the body is only read after elapsed is measured
+        latency = sum(x.elapsed.total_seconds() for x in [*r.history, r])
+    except Exception as e:
+        metrics.count_error(stage, e)
+        raise
+    finally:
+        rate_limiter.release(start, stage, status, _throttled.value, latency)
+    metrics.inc("http_bytes_total", len(r.content), stage=stage)
+    if r.status_code >= 400:
+        metrics.count_error(stage, f"HTTP {r.status_code}")
+
+    if cache is not None:
+        if r.status_code == 304 and entry is not None:
+            # Not modified since it was cached
+            _increment("cache_revalidations")
+            cache.revalidated(url)
+            return http_cache.CachedResponse(url, entry["content"])
+        if r.status_code == 200:
+            cache.store(
+                url,
+                r.content,
+                etag=r.headers.get("ETag"),
+                last_modified=r.headers.get("Last-Modified"),
+            )
+    return r
+
+
+def get_stats():
+    """Returns the request counters, across all the processes.
+
+    Returns:
+        dict: the number of requests sent, new connections made, handshakes
+              saved by reusing connections, retries, and responses served
+              from the cache with and without revalidating them
+    """
+    stats = {name: value.value for name, value in _stats.items()}
+    stats["handshakes_saved"] = max(stats["requests"] - stats["connections"], 0)
+    return stats
+
+
+def log_stats():
+    stats = get_stats()
+    limiter_stats = rate_limiter.get_stats()
+    _logger.info(
+        f"HTTP requests: {stats['requests']}, "
+        f"new connections: {stats['connections']}, "
+        f"handshakes saved: {stats['handshakes_saved']}, "
+        f"retries: {stats['retries']}, "
+        f"cache hits: {stats['cache_hits']}, "
+        f"cache revalidations: {stats['cache_revalidations']}, "
+        f"concurrency limit: {limiter_stats['concurrency_limit']:.1f} "
+        f"({limiter_stats['decreases']} decreases)"
+    )
@@ -0,0 +1,117 @@
+"""
+Durable journal of the work completed by a run, used to resume the run after
+a crash or an interruption.
+
+Each stage records the items it completed: the index pages (with the set IDs
+found on them), the set id histories (with the history data) and the set IDs
+whose labels were processed. Records are committed as they are made, so the
+journal holds everything completed up to the moment the run stopped. When
+resuming, completed index pages and histories are read back from the journal
+instead of being downloaded again, and set IDs whose labels were processed
+are skipped.
+"""
+
+import json
+import sqlite3
+import threading
+
+from utils.logging import getLogger
+
+_logger = getLogger(__name__)
+
+INDEX_STAGE = "index"
+HISTORY_STAGE = "history"
+LABELS_STAGE = "labels"
+
+
+class ProgressJournal:
+    """
+    Used to record and look up the completed work of a run, in a SQLite file.
+    Safe to use from several threads at once.
+    """
+
+    def __init__(self, path, resume=False):
+        """
+        Args:
+            path (str): the journal file
+            resume (bool, optional): Whether to keep the work recorded by the
+                                     previous run. Otherwise the journal is
+                                     started over. Defaults to False.
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            path, timeout=60, check_same_thread=False, isolation_level=None
+        )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS completed ("
+            "stage TEXT NOT NULL, key TEXT NOT NULL, data TEXT, "
+            "PRIMARY KEY (stage, key))"
+        )
+        if resume:
+            counts = dict(
+                self._db.execute(
+                    "SELECT stage, COUNT(*) FROM completed GROUP BY stage"
+                ).fetchall()
+            )
+            _logger.info(
+                f"Resuming from {path}: "
+                f"{counts.get(INDEX_STAGE, 0)} index pages, "
+                f"{counts.get(HISTORY_STAGE, 0)} histories and "
+                f"{counts.get(LABELS_STAGE, 0)} set IDs with labels completed"
+            )
+        else:
+            self._db.execute("DELETE FROM completed")
+
+    def record(self, stage, key, data=None):
+        """Records the item as completed by the stage.
+
+        Args:
+            stage (str): the stage, e.g. INDEX_STAGE
+            key (str or int): the item completed, e.g. the page number
+            data (optional): JSON serializable data to keep with the item
+        """
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO completed VALUES (?, ?, ?)",
+                (stage, str(key), json.dumps(data)),
+            )
+
+    def get_completed(self, stage):
+        """Returns the keys of the items completed by the stage.
+
+        Args:
+            stage (str): the stage, e.g. INDEX_STAGE
+
+        Returns:
+            set[str]: the keys of the items
+        """
+        with self._lock:
+            return {
+                x[0]
+                for x in self._db.execute(
+                    "SELECT key FROM completed WHERE stage = ?", (stage,)
+                )
+            }
+
+    def get(self, stage, key):
+        """Returns the data recorded with the item, or None.
+
+        Args:
+            stage (str): the stage, e.g. INDEX_STAGE
+            key (str or int): the item completed, e.g. the page number
+
+        Returns:
+            the data recorded with the item
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT data FROM completed WHERE stage = ? AND key = ?",
+                (stage, str(key)),
+            ).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def close(self):
+        with self._lock:
+            self._db.close()
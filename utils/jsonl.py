@@ -0,0 +1,193 @@
+"""
+Streaming JSON Lines files of records, e.g. the index and history data of a
+run, optionally compressed with gzip or zstd.
+
+Records are written one per line as they are produced, and read back one at
+a time, so neither side holds the whole file in memory. The compression of a
+file is given by its extension: ".jsonl.gz" for gzip and ".jsonl.zst" for
+zstd. zstd compresses faster and smaller, but needs the zstandard package.
+"""
+
+import gzip
+import json
+import os
+import threading
+
+try:
+    import zstandard
+except ImportError:
+    # Optional dependency, only needed for zstd compressed files
+    zstandard = None
+
+# The extension of the files of each compression
+COMPRESSIONS = {None: ".jsonl", "gzip": ".jsonl.gz", "zstd": ".jsonl.zst"}
+
+# Favors speed, as the files are written while the stages run
+ZSTD_LEVEL = 3
+GZIP_LEVEL = 6
+
+
+def get_path(path, compression=None):
+    """Returns the path of the file, with the extension of the compression.
+
+    Args:
+        path (str): the path of the file, without extension
+        compression (str, optional): one of COMPRESSIONS. Defaults to None.
+
+    Raises:
+        ValueError: When the compression is unknown
+
+    Returns:
+        str: the path of the file
+    """
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Unknown compression: {compression}")
+    return path + COMPRESSIONS[compression]
+
+
+def get_compression(path):
+    """Returns the compression of the file, given by its extension.
+
+    Args:
+        path (str): the path of the file
+
+    Returns:
+        str: one of COMPRESSIONS, None for an uncompressed file
+    """
+    if path.endswith(".gz"):
+        return "gzip"
+    if path.endswith(".zst"):
+        return "zstd"
+    return None
+
+
+def _open(path, mode, compression):
+    if compression == "gzip":
+        return gzip.open(
+            path, mode + "t", encoding="utf-8", compresslevel=GZIP_LEVEL
+        )
+    if compression == "zstd":
+        if zstandard is None:
+            raise ImportError("zstandard is required for zstd compression")
+        return zstandard.open(
+            path,
+            mode + "t",
+            cctx=zstandard.ZstdCompressor(level=ZSTD_LEVEL),
+            encoding="utf-8",
+        )
+    return open(path, mode, encoding="utf-8")
+
+
+class JsonlWriter:
+    """
+    Used to write records to a JSON Lines file as they are produced. The
+    records are written to a partial file, which is moved to its final path
+    when the writer is closed, so that an interrupted run does not leave a
+    truncated file behind. Safe to use from several threads at once.
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path (str): the path of the file. Its extension sets the
+                        compression, see get_compression.
+        """
+        self.path = path
+        self.count = 0
+        self._closed = False
+        self._partial_path = f"{path}.partial"
+        self._lock = threading.Lock()
+        self._file = _open(self._partial_path, "w", get_compression(path))
+
+    def write(self, record):
+        """Writes the record, on a line of its own.
+
+        Args:
+            record: the JSON serializable record
+        """
+        line = json.dumps(record) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self.count += 1
+
+    def write_all(self, records):
+        """Writes each of the records.
+
+        Args:
+            records (iterable): the JSON serializable records
+        """
+        for record in records:
+            self.write(record)
+
+    def close(self, path=None):
+        """
+        Completes the file, and moves it to its final path.
+
+        Args:
+            path (str, optional): the final path, if it was not known when the
+                                  writer was created. It must have the same
+                                  compression. Defaults to the path given to
+                                  the writer.
+
+        Raises:
+            ValueError: When the final path has another compression
+
+        Returns:
+            str: the final path of the file
+        """
+        if self._closed:
+            return self.path
+        if path is not None:
+            if get_compression(path) != get_compression(self.path):
+                raise ValueError(f"Compression mismatch: {path}")
+            self.path = path
+        with self._lock:
+            self._file.close()
+            self._closed = True
+        os.replace(self._partial_path, self.path)
+        return self.path
+
+    def discard(self):
+        """Closes the writer, if not closed yet, and deletes the partial
+        file."""
+        if self._closed:
+            return
+        with self._lock:
+            self._file.close()
+            self._closed = True
+        os.remove(self._partial_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+
+def read_records(path):
+    """
+    Reads the records of a JSON Lines file, one at a time. Files written as
+    a single JSON list, as by earlier versions, are read too.
+
+    Args:
+        path (str): the path of the file. Its extension gives the
+                    compression, see get_compression.
+
+    Raises:
+        FileNotFoundError: When the file does not exist
+
+    Yields:
+        the records of the file, in order
+    """
+    if not os.path.exists(path):
+        raise FileNotFoundError(path)
+    with _open(path, "r", get_compression(path)) as f:
+        if path.endswith(".json"):
+            yield from json.load(f)
+            return
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
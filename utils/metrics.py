@@ -0,0 +1,366 @@
+"""
+Counters and latency histograms of the work done by each stage of a run.
+
+Each process records its metrics in memory. Worker processes write a snapshot
+of their metrics to the metrics folder after each task, through the
+flush_after decorator on the functions run in the process pools, and the
+parent process merges the snapshots with its own metrics at the end of the
+run. A forked worker starts from empty metrics, rather than from a copy of
+its parent's, so nothing is counted twice.
+
+Usage:
+    with metrics.timer("parse_seconds", stage="labels"):
+        ...
+    metrics.inc("http_bytes_total", len(content), stage="index")
+"""
+
+import bisect
+import contextlib
+import functools
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+
+from utils.logging import getLogger
+
+_logger = getLogger(__name__)
+
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = [
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+]
+
+# The type and description of each metric
+METRICS = {
+    "http_request_seconds": ("histogram", "Time taken by HTTP requests"),
+    "http_bytes_total": ("counter", "Bytes downloaded over HTTP"),
+    "http_cache_hits_total": ("counter", "Responses served from the cache"),
+    "unzip_seconds": ("histogram", "Time taken to read label zip files"),
+    "parse_seconds": ("histogram", "Time taken to parse downloaded data"),
+    "title_match_seconds": (
+        "histogram",
+        "Time taken to match the section titles of a label",
+    ),
+    "mongo_write_seconds": ("histogram", "Time taken by MongoDB writes"),
+    "items_total": ("counter", "Items processed by each stage"),
+    "errors_total": ("counter", "Errors by stage and type"),
+}
+
+PROMETHEUS_PREFIX = "dailymed_"
+
+_config = {"folder": None}
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_pid = os.getpid()
+# Identifies the snapshot of the process, as process ids can be reused
+_snapshot_id = uuid.uuid4().hex
+
+
+def configure(folder=None):
+    """
+    Enables the worker snapshots, written to the folder, or disables them
+    when folder is None. Call this before any worker processes are started,
+    so that they inherit the option. Snapshots of a previous run in the
+    folder are deleted.
+
+    Args:
+        folder (str, optional): the folder to write the snapshots to
+    """
+    _config["folder"] = folder
+    if folder:
+        shutil.rmtree(folder, ignore_errors=True)
+        os.makedirs(folder)
+
+
+def _check_pid():
+    # Start over with empty metrics in a forked process. Called with _lock
+    # held.
+    global _pid, _snapshot_id
+    if _pid != os.getpid():
+        _counters.clear()
+        _histograms.clear()
+        _pid = os.getpid()
+        _snapshot_id = uuid.uuid4().hex
+
+
+def _key(name, labels):
+    if name not in METRICS:
+        raise ValueError(f"Unknown metric: {name}")
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name, value=1, **labels):
+    """Adds the value to a counter.
+
+    Args:
+        name (str): the counter name, one of METRICS
+        value (float, optional): the value to add. Defaults to 1.
+        labels: the label values of the counter, e.g. stage="index"
+    """
+    key = _key(name, labels)
+    with _lock:
+        _check_pid()
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name, seconds, **labels):
+    """Records a duration in a histogram.
+
+    Args:
+        name (str): the histogram name, one of METRICS
+        seconds (float): the duration
+        labels: the label values of the histogram, e.g. stage="index"
+    """
+    key = _key(name, labels)
+    with _lock:
+        _check_pid()
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = {
+                # The last bucket counts the durations above all bounds
+                "buckets": [0] * (len(BUCKETS) + 1),
+                "sum": 0.0,
+                "count": 0,
+            }
+        histogram["buckets"][bisect.bisect_left(BUCKETS, seconds)] += 1
+        histogram["sum"] += seconds
+        histogram["count"] += 1
+
+
+@contextlib.contextmanager
+def timer(name, **labels):
+    """Records the time taken by the block in a histogram, including when it
+    raises."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def count_error(stage, error):
+    """Counts the error by stage and type.
+
+    Args:
+        stage (str): the stage, e.g. "labels"
+        error (Exception or str): the error, or its type
+    """
+    error_type = error if isinstance(error, str) else type(error).__name__
+    inc("errors_total", stage=stage, type=error_type)
+
+
+def _snapshot():
+    with _lock:
+        _check_pid()
+        return {
+            "counters": [
+                [name, dict(labels), value]
+                for (name, labels), value in _counters.items()
+            ],
+            "histograms": [
+                [
+                    name,
+                    dict(labels),
+                    dict(histogram, buckets=list(histogram["buckets"])),
+                ]
+                for (name, labels), histogram in _histograms.items()
+            ],
+        }
+
+
+def flush():
+    """Writes the snapshot of the metrics of the current process to the
+    metrics folder, if enabled."""
+    folder = _config["folder"]
+    if not folder:
+        return
+    snapshot = _snapshot()
+    path = os.path.join(folder, f"{os.getpid()}-{_snapshot_id}.json")
+    # Write atomically, so that a partial snapshot is never read
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(snapshot, f)
+    os.replace(f"{path}.tmp", path)
+
+
+def flush_after(fn):
+    """Decorates a function run in worker processes, so that the metrics of
+    the worker are written to the metrics folder after each call."""
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            flush()
+
+    return wrapper
+
+
+def _merge(snapshots):
+    counters = {}
+    histograms = {}
+    for snapshot in snapshots:
+        for name, labels, value in snapshot["counters"]:
+            key = _key(name, labels)
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, histogram in snapshot["histograms"]:
+            key = _key(name, labels)
+            merged = histograms.setdefault(
+                key,
+                {"buckets": [0] * (len(BUCKETS) + 1), "sum": 0.0, "count": 0},
+            )
+            merged["buckets"] = [
+                x + y for x, y in zip(merged["buckets"], histogram["buckets"])
+            ]
+            merged["sum"] += histogram["sum"]
+            merged["count"] += histogram["count"]
+    return counters, histograms
+
+
+def collect():
+    """
+    Returns the metrics of the current process merged with the snapshots of
+    the worker processes.
+
+    Returns:
+        (dict, dict): the counter values and the histograms, keyed by
+                      (name, labels)
+    """
+    snapshots = [_snapshot()]
+    folder = _config["folder"]
+    if folder and os.path.isdir(folder):
+        own_file = f"{os.getpid()}-{_snapshot_id}.json"
+        for file_name in sorted(os.listdir(folder)):
+            if file_name.endswith(".json") and file_name != own_file:
+                try:
+                    with open(os.path.join(folder, file_name)) as f:
+                        snapshots.append(json.load(f))
+                except (OSError, ValueError) as e:
+                    _logger.error(f"Unable to read metrics {file_name}: {e}")
+    return _merge(snapshots)
+
+
+def _quantile(histogram, q):
+    # The upper bound of the bucket holding the quantile, or None if it is
+    # above the largest bound
+    rank = q * histogram["count"]
+    total = 0
+    for bound, count in zip(BUCKETS, histogram["buckets"]):
+        total += count
+        if total >= rank:
+            return bound
+    return None
+
+
+def get_summary(counters, histograms):
+    """Returns the merged metrics as a JSON serializable summary."""
+    summary = {}
+    for (name, labels), value in sorted(counters.items()):
+        summary.setdefault(name, []).append(
+            {"labels": dict(labels), "value": value}
+        )
+    for (name, labels), histogram in sorted(histograms.items()):
+        count = histogram["count"]
+        summary.setdefault(name, []).append(
+            {
+                "labels": dict(labels),
+                "count": count,
+                "sum": histogram["sum"],
+                "mean": histogram["sum"] / count if count else 0,
+                # Upper bounds of the buckets holding the percentiles
+                "p50": _quantile(histogram, 0.5),
+                "p95": _quantile(histogram, 0.95),
+                "p99": _quantile(histogram, 0.99),
+            }
+        )
+    return summary
+
+
+def _escape(value):
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace('"', '\\"')
+        .replace("\n", "\\n")
+    )
+
+
+def _format_labels(labels, **extra):
+    labels = list(labels) + list(extra.items())
+    if not labels:
+        return ""
+    values = ",".join(f'{key}="{_escape(value)}"' for key, value in labels)
+    return f"{{{values}}}"
+
+
+def get_prometheus_text(counters, histograms):
+    """Returns the merged metrics in the Prometheus text exposition format,
+    as read by the node exporter textfile collector."""
+    lines = []
+    for name, (metric_type, description) in METRICS.items():
+        full_name = f"{PROMETHEUS_PREFIX}{name}"
+        if metric_type == "counter":
+            series = [(k, v) for k, v in counters.items() if k[0] == name]
+        else:
+            series = [(k, v) for k, v in histograms.items() if k[0] == name]
+        if not series:
+            continue
+        lines.append(f"# HELP {full_name} {description}")
+        lines.append(f"# TYPE {full_name} {metric_type}")
+        for (_, labels), value in sorted(series):
+            if metric_type == "counter":
+                lines.append(f"{full_name}{_format_labels(labels)} {value}")
+                continue
+            total = 0
+            for bound, count in zip(BUCKETS + ["+Inf"], value["buckets"]):
+                total += count
+                lines.append(
+                    f"{full_name}_bucket{_format_labels(labels, le=bound)} "
+                    f"{total}"
+                )
+            lines.append(
+                f"{full_name}_sum{_format_labels(labels)} {value['sum']}"
+            )
+            lines.append(
+                f"{full_name}_count{_format_labels(labels)} {value['count']}"
+            )
+    return "\n".join(lines) + "\n"
+
+
+def write_reports(json_path, prometheus_path):
+    """
+    Writes the metrics of the run, merged across the worker processes, as a
+    JSON summary and a Prometheus textfile.
+
+    Args:
+        json_path (str): the path of the JSON summary
+        prometheus_path (str): the path of the Prometheus textfile
+    """
+    counters, histograms = collect()
+    with open(json_path, "w") as f:
+        json.dump(get_summary(counters, histograms), f, indent=4)
+    # Write atomically, so that the textfile collector never reads a partial
+    # file
+    with open(f"{prometheus_path}.tmp", "w") as f:
+        f.write(get_prometheus_text(counters, histograms))
+    os.replace(f"{prometheus_path}.tmp", prometheus_path)
+    _logger.info(f"Metrics written to {json_path} and {prometheus_path}")
@@ -0,0 +1,219 @@
+"""
+Profiling of a run across the parent and worker processes, with cProfile.
+
+The parent process is profiled from start() to the end of the run. The
+functions run in the process pools are decorated with profile_worker, which
+profiles each call in the worker and writes the cumulative stats of the
+worker to the profile folder after each call. write_report merges the stats
+of all processes into one .pstats file, which can be opened with tools such
+as snakeviz, and a text report of the top functions by cumulative time.
+
+cProfile only profiles the thread that enabled it. The functions run in
+other threads of a process, e.g. to download the versions of a set ID
+concurrently, are decorated with profile_thread, which profiles each call
+with a profiler of its own. Their stats are merged into the stats of the
+process.
+
+Usage:
+    profiling.configure("tempdata/profile/workers")
+    profiling.start()
+    ...
+    profiling.write_report("profile.pstats", "profile.txt")
+"""
+
+import cProfile
+import functools
+import io
+import os
+import pstats
+import shutil
+import threading
+import uuid
+
+from utils.logging import getLogger
+
+_logger = getLogger(__name__)
+
+_config = {"folder": None}
+
+_profiler = None
+_profiler_pid = None
+# Whether the profiler of the current process is enabled, and in which thread
+_enabled = False
+_enabled_thread = None
+# The merged stats of the calls profiled by profile_thread in the process
+_thread_stats = None
+_thread_stats_lock = threading.Lock()
+# Identifies the stats of the process, as process ids can be reused
+_stats_id = uuid.uuid4().hex
+
+
+def configure(folder=None):
+    """
+    Enables the profiling of the worker processes, whose stats are written to
+    the folder, or disables it when folder is None. Call this before any
+    worker processes are started, so that they inherit the option. Stats of a
+    previous run in the folder, and of the current process, are deleted.
+
+    Args:
+        folder (str, optional): the folder to write the worker stats to
+    """
+    global _profiler_pid
+    # Start over with a new profiler in the current process
+    _stop()
+    _profiler_pid = None
+    _config["folder"] = folder
+    if folder:
+        shutil.rmtree(folder, ignore_errors=True)
+        os.makedirs(folder)
+
+
+def _get_profiler():
+    global _profiler, _profiler_pid, _enabled, _stats_id, _thread_stats
+    if _profiler_pid != os.getpid():
+        if _profiler is not None and _enabled:
+            # A forked process inherits the running profiler of its parent,
+            # whose stats are never written from this process
+            _profiler.disable()
+        _profiler = cProfile.Profile()
+        _profiler_pid = os.getpid()
+        _enabled = False
+        _stats_id = uuid.uuid4().hex
+        _thread_stats = None
+    return _profiler
+
+
+def start():
+    """Starts profiling the current thread of the current process."""
+    global _enabled, _enabled_thread
+    _get_profiler().enable()
+    _enabled = True
+    _enabled_thread = threading.get_ident()
+
+
+def _stop():
+    global _enabled
+    profiler = _get_profiler()
+    if _enabled:
+        profiler.disable()
+        _enabled = False
+    return profiler
+
+
+def profile_worker(fn):
+    """Decorates a function run in worker processes, so that its calls are
+    profiled when profiling is enabled, and the stats of the worker are
+    written to the profile folder after each call."""
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        folder = _config["folder"]
+        profiler = _get_profiler() if folder else None
+        if profiler is None or _enabled:
+            # Not profiling, or called from a process already being profiled
+            return fn(*args, **kwargs)
+        start()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _stop()
+            path = os.path.join(folder, f"{os.getpid()}-{_stats_id}.pstats")
+            # Write atomically, so that partial stats are never read
+            _get_stats(profiler).dump_stats(f"{path}.tmp")
+            os.replace(f"{path}.tmp", path)
+
+    return wrapper
+
+
+def profile_thread(fn):
+    """Decorates a function run in threads of its own, so that its calls are
+    profiled when profiling is enabled, and their stats merged into the
+    stats of the process. Calls from the thread already being profiled are
+    run as they are."""
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        global _thread_stats
+        _get_profiler()
+        if not _config["folder"] or (
+            _enabled and _enabled_thread == threading.get_ident()
+        ):
+            return fn(*args, **kwargs)
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            profiler.disable()
+            with _thread_stats_lock:
+                if _thread_stats is None:
+                    _thread_stats = pstats.Stats(profiler)
+                else:
+                    _thread_stats.add(profiler)
+
+    return wrapper
+
+
+def _get_stats(profiler):
+    # Returns the stats of the profiler merged with the thread stats, or None
+    # if nothing was profiled
+    stats = pstats.Stats(profiler) if profiler.getstats() else None
+    with _thread_stats_lock:
+        if _thread_stats is None:
+            return stats
+        if stats is None:
+            stats = pstats.Stats()
+        stats.add(_thread_stats)
+        return stats
+
+
+def collect():
+    """
+    Stops profiling the current process, and returns its stats merged with
+    the stats of the worker processes.
+
+    Returns:
+        pstats.Stats: the merged stats, or None if nothing was profiled
+    """
+    stats = _get_stats(_stop())
+    folder = _config["folder"]
+    if folder and os.path.isdir(folder):
+        for file_name in sorted(os.listdir(folder)):
+            if not file_name.endswith(".pstats"):
+                continue
+            path = os.path.join(folder, file_name)
+            try:
+                if stats is None:
+                    stats = pstats.Stats(path)
+                else:
+                    stats.add(path)
+            except Exception as e:
+                _logger.error(f"Unable to read profile {file_name}: {e}")
+    return stats
+
+
+def write_report(pstats_path, report_path, top=50):
+    """
+    Writes the profile of the run, merged across the worker processes, as a
+    .pstats file and a text report of the top functions by cumulative time.
+
+    Args:
+        pstats_path (str): the path of the .pstats file
+        report_path (str): the path of the text report
+        top (int, optional): the number of functions in the report.
+                             Defaults to 50.
+    """
+    stats = collect()
+    if stats is None:
+        _logger.info("Nothing was profiled")
+        return
+    stats.dump_stats(pstats_path)
+    report = io.StringIO()
+    stats.stream = report
+    stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(top)
+    with open(report_path, "w") as f:
+        f.write(report.getvalue())
+    _logger.info(
+        f"Profile written to {pstats_path} and {report_path}, with the top "
+        f"functions by cumulative time"
+    )
@@ -0,0 +1,293 @@
+"""
+Adaptive limiter of the requests made to DailyMed, shared by all processes.
+
+Two limits apply to each request:
+
+- A token bucket caps the request rate, when configured with a rate. The
+  requests are spaced evenly, without bursts.
+- An adaptive limit caps the requests in flight across all processes. It is
+  adjusted with AIMD (additive increase, multiplicative decrease): each
+  request completed with a healthy latency raises the limit by 1/limit, i.e.
+  by about one per round of requests, up to max_concurrency. A throttled
+  (429/503) or failed request, or a latency rising above latency_tolerance
+  times the lowest latency seen for the same stage, halves the limit, down
+  to 1. Requests that started before the last decrease do not decrease it
+  again, so a burst of throttled responses only halves it once.
+
+The latency is the time until the response headers are received, rather
+than the time the whole request took, so that the size of the label zip
+files, which can vary by orders of magnitude, does not count as a slower
+server.
+
+The state is kept in shared memory, created when this module is first
+imported. Worker processes forked after that point share the same limits,
+which is why the pools are created with scheduling.process_pool; workers
+started with spawn or forkserver would each get limits of their own.
+
+The requests in flight are also counted per process, so that the slots held
+by a process that exited without releasing them, e.g. a crashed worker, are
+reclaimed once no request has completed for RECLAIM_INTERVAL seconds. A
+process is taken as alive until its parent reaps it, and the slots are only
+counted for the first MAX_TRACKED_PROCESSES processes holding slots at once.
+"""
+
+import ctypes
+import multiprocessing
+import os
+import time
+
+from utils.logging import getLogger
+
+_logger = getLogger(__name__)
+
+# Responses sent by a server that is throttling the requests
+THROTTLE_STATUSES = [429, 503]
+
+# The stages whose latencies are tracked apart, as returned by
+# http_client.get_stage
+STAGES = ["index", "history", "labels", "other"]
+
+_config = {
+    "initial_concurrency": 8,
+    "max_concurrency": 32,
+    # Requests per second across all processes, or None for no limit
+    "rate": None,
+    "latency_tolerance": 2.0,
+    # The weight of each latency in the moving average of the stage
+    "latency_smoothing": 0.2,
+}
+
+# Indexes of the values in the shared state
+_LIMIT = 0
+_IN_FLIGHT = 1
+_TOKENS = 2
+_LAST_REFILL = 3
+_LAST_DECREASE = 4
+_DECREASES = 5
+
+# The seconds without a request completed after which the slots of exited
+# processes are reclaimed
+RECLAIM_INTERVAL = 1
+
+# The most processes whose requests in flight are counted at once
+MAX_TRACKED_PROCESSES = 256
+
+_condition = multiprocessing.Condition()
+_state = multiprocessing.RawArray(ctypes.c_double, 6)
+# The moving average and the lowest moving average of the latency of each
+# stage, or 0 before the first request
+_latencies = multiprocessing.RawArray(ctypes.c_double, 2 * len(STAGES))
+# The pid of each process with requests in flight, and how many it has
+_slot_pids = multiprocessing.RawArray(ctypes.c_int, MAX_TRACKED_PROCESSES)
+_slot_counts = multiprocessing.RawArray(ctypes.c_int, MAX_TRACKED_PROCESSES)
+
+
+def _reset():
+    with _condition:
+        _state[_LIMIT] = _config["initial_concurrency"]
+        _state[_TOKENS] = 1
+        _state[_LAST_REFILL] = time.monotonic()
+        _state[_LAST_DECREASE] = 0
+        _state[_DECREASES] = 0
+        for i in range(len(_latencies)):
+            _latencies[i] = 0
+        _condition.notify_all()
+
+
+def configure(**kwargs):
+    """
+    Sets the limiter options, and starts over from the initial concurrency.
+    Call this before any worker processes are started, so that they inherit
+    the options.
+
+    Args:
+        initial_concurrency (int, optional): the requests in flight allowed
+                                             at first
+        max_concurrency (int, optional): the most requests in flight allowed
+        rate (float, optional): the most requests per second, or None for no
+                                limit
+        latency_tolerance (float, optional): the ratio of the latency to the
+                                             lowest latency seen above which
+                                             the concurrency is decreased
+        latency_smoothing (float, optional): the weight of each latency in
+                                             the moving average
+
+    Raises:
+        ValueError: When an unknown option or invalid value is given
+    """
+    for key, value in kwargs.items():
+        if key not in _config:
+            raise ValueError(f"Unknown rate limiter option: {key}")
+        if value is not None or key == "rate":
+            _config[key] = value
+    if (
+        not isinstance(_config["max_concurrency"], int)
+        or _config["max_concurrency"] < 1
+    ):
+        raise ValueError("Max concurrency must be a positive integer")
+    if _config["rate"] is not None and _config["rate"] <= 0:
+        raise ValueError("Rate must be positive")
+    _config["initial_concurrency"] = max(
+        1, min(_config["initial_concurrency"], _config["max_concurrency"])
+    )
+    _reset()
+
+
+def _take_token(now):
+    # Returns 0 if a token was taken, or the seconds until the next one
+    rate = _config["rate"]
+    if rate is None:
+        return 0
+    _state[_TOKENS] = min(
+        1, _state[_TOKENS] + (now - _state[_LAST_REFILL]) * rate
+    )
+    _state[_LAST_REFILL] = now
+    if _state[_TOKENS] >= 1:
+        _state[_TOKENS] -= 1
+        return 0
+    return (1 - _state[_TOKENS]) / rate
+
+
+def _count_slots(pid, count):
+    # Adds count to the requests in flight of the process, if tracked
+    free = None
+    for i in range(MAX_TRACKED_PROCESSES):
+        if _slot_counts[i] and _slot_pids[i] == pid:
+            _slot_counts[i] = max(_slot_counts[i] + count, 0)
+            return
+        if free is None and not _slot_counts[i]:
+            free = i
+    if count > 0 and free is not None:
+        _slot_pids[free] = pid
+        _slot_counts[free] = count
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _reclaim_slots():
+    # Releases the requests in flight of the processes that exited
+    for i in range(MAX_TRACKED_PROCESSES):
+        if not _slot_counts[i] or _is_alive(_slot_pids[i]):
+            continue
+        _logger.warning(
+            f"Reclaimed {_slot_counts[i]} requests in flight of exited "
+            f"process {_slot_pids[i]}"
+        )
+        _state[_IN_FLIGHT] = max(_state[_IN_FLIGHT] - _slot_counts[i], 0)
+        _slot_counts[i] = 0
+
+
+def acquire():
+    """
+    Waits until a request can be sent, within the concurrency limit and the
+    rate limit, and counts it as in flight. Each call must be followed by a
+    call to release.
+
+    Returns:
+        float: the time the request was allowed, to pass to release
+    """
+    with _condition:
+        while True:
+            now = time.monotonic()
+            if _state[_IN_FLIGHT] < int(_state[_LIMIT]):
+                wait = _take_token(now)
+                if not wait:
+                    _state[_IN_FLIGHT] += 1
+                    _count_slots(os.getpid(), 1)
+                    return now
+                _condition.wait(wait)
+            elif not _condition.wait(RECLAIM_INTERVAL):
+                # No request completed for a while, which may be because a
+                # process holding slots exited without releasing them
+                _reclaim_slots()
+
+
+def _is_latency_rising(stage, latency):
+    # Updates the moving average latency of the stage, and returns whether
+    # it rose beyond the tolerance
+    i = 2 * (STAGES.index(stage) if stage in STAGES else len(STAGES) - 1)
+    average = _latencies[i]
+    if average:
+        average += _config["latency_smoothing"] * (latency - average)
+    else:
+        average = latency
+    _latencies[i] = average
+    lowest = _latencies[i + 1] = min(_latencies[i + 1] or average, average)
+    if average <= _config["latency_tolerance"] * lowest:
+        return False
+    # Take the higher latency as the new normal once it is acted on, so that
+    # a server that stays slower only decreases the limit once
+    _latencies[i + 1] = average / _config["latency_tolerance"]
+    return True
+
+
+def release(start, stage, status=None, throttled=False, latency=None):
+    """
+    Counts the request as completed, and adapts the concurrency limit to its
+    outcome.
+
+    Args:
+        start (float): the time returned by acquire
+        stage (str): the stage of the request, one of STAGES
+        status (int, optional): the response status, or None if the request
+                                failed
+        throttled (bool, optional): whether the request was throttled before
+                                    it completed, e.g. by a retried 429
+        latency (float, optional): the seconds until the response headers
+                                   were received, by default the seconds
+                                   since start
+    """
+    now = time.monotonic()
+    if latency is None:
+        latency = now - start
+    with _condition:
+        _state[_IN_FLIGHT] = max(_state[_IN_FLIGHT] - 1, 0)
+        _count_slots(os.getpid(), -1)
+        healthy = (
+            status is not None
+            and status < 500
+            and status not in THROTTLE_STATUSES
+            and not throttled
+        )
+        if healthy and not _is_latency_rising(stage, latency):
+            _state[_LIMIT] = min(
+                _config["max_concurrency"],
+                _state[_LIMIT] + 1 / _state[_LIMIT],
+            )
+        elif start >= _state[_LAST_DECREASE]:
+            # Only the requests sent under the current limit decrease it
+            _state[_LIMIT] = max(1, _state[_LIMIT] / 2)
+            _state[_LAST_DECREASE] = now
+            _state[_DECREASES] += 1
+            reason = "a rising latency" if healthy else f"status {status}"
+            _logger.debug(
+                f"Decreased the concurrency limit to {_state[_LIMIT]:.1f} "
+                f"after a {stage} request with {reason}"
+            )
+        _condition.notify_all()
+
+
+def get_stats():
+    """Returns the state of the limiter, across all the processes.
+
+    Returns:
+        dict: the concurrency limit, the requests in flight and the number
+              of times the limit was decreased
+    """
+    with _condition:
+        return {
+            "concurrency_limit": _state[_LIMIT],
+            "in_flight": int(_state[_IN_FLIGHT]),
+            "decreases": int(_state[_DECREASES]),
+        }
+
+
+_reset()
@@ -0,0 +1,78 @@
+"""
+Scheduling of tasks of uneven size over a pool of workers.
+
+Tasks are submitted longest first (the LPT rule), so that the longest tasks
+do not start last and keep one worker busy after the others have run out of
+work. Each task is submitted on its own, rather than in chunks, and results
+are returned as soon as they complete, so that a slow task does not hold
+back the results of the tasks that finished after it.
+
+The worker processes are forked, whatever the default start method of the
+platform, as they share the rate limiter and the request counters through
+memory inherited from the main process.
+"""
+
+import concurrent.futures
+import multiprocessing
+
+_FORK_CONTEXT = multiprocessing.get_context("fork")
+
+
+def process_pool(max_workers=None):
+    """Returns a process pool whose workers are forked from this process.
+
+    Args:
+        max_workers (int, optional): the number of worker processes, by
+                                     default the number of CPUs
+
+    Returns:
+        concurrent.futures.ProcessPoolExecutor: the pool
+    """
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=max_workers, mp_context=_FORK_CONTEXT
+    )
+
+
+def order_longest_first(items, get_cost):
+    """Returns the items ordered by decreasing expected cost. Items of the
+    same cost keep their order.
+
+    Args:
+        items (list): the items to order
+        get_cost (Callable): returns the expected cost of an item
+
+    Returns:
+        list: the items, longest first
+    """
+    return sorted(items, key=get_cost, reverse=True)
+
+
+def map_longest_first(executor, fn, items, get_cost):
+    """
+    Runs fn over the items in the executor, submitting the items longest
+    first, and yields the results as they complete.
+
+    Args:
+        executor (concurrent.futures.Executor): the executor to run fn in
+        fn (Callable): the function to run over each item
+        items (list): the items
+        get_cost (Callable): returns the expected cost of an item, e.g. the
+                             number of versions of a set ID
+
+    Raises:
+        Exception: the exception raised by fn for an item, once its task
+                   completes. The pending tasks are cancelled.
+
+    Yields:
+        tuple: each item and the result of fn for it, in completion order
+    """
+    futures = {
+        executor.submit(fn, item): item
+        for item in order_longest_first(items, get_cost)
+    }
+    try:
+        for future in concurrent.futures.as_completed(futures):
+            yield futures[future], future.result()
+    finally:
+        for future in futures:
+            future.cancel()